@@ -2,8 +2,8 @@ from nonebot import on_message, logger, get_driver, require, get_plugin_config
 require("nonebot_plugin_localstore")
 from nonebot.plugin import PluginMetadata
 from nonebot.adapters.onebot.v11 import MessageEvent, Bot, Message, MessageSegment
-from .chat import should_reply_in_group, get_chat_reply_with_tools
-from .context import get_context, add_message, clear_context, load_contexts
+from .chat import should_reply_in_group, get_chat_reply_with_tools, is_silent_reply
+from .context import get_context, add_message, add_reply, clear_context, load_contexts, get_message, select_thread
 from .manager import chat_manager
 from .commands import *
 from .send2root import *
@@ -11,9 +11,19 @@ from .image2txt import *
 from .config import *
 import asyncio
 import random
-import json
 from .mcp_manager import *
-from typing import Dict, Set
+from .dispatcher import outbound_dispatcher
+from .ratelimit import outbound_limiter
+from .debounce import private_debouncer
+from .judge import windowed_judge, group_prefilter, judgment_batcher
+from .classifier import judgment_classifier
+from .speculative import speculative_replier
+from .scheduler import request_priority, session_scope, PRIORITY_AMBIENT, AdmissionRejected
+from .errors import classify_error, error_tracker, ERROR_LABELS, CONTEXT_ERRORS
+from .tokens import estimate_messages_tokens
+from .memory import memory_store
+from .usage import usage_ledger
+from typing import Dict, List, Set
 
 __plugin_meta__ = PluginMetadata(
     name="pxchat",
@@ -31,52 +41,29 @@ load_contexts()
 get_plugin_config(PluginConfig)
 # 创建消息处理器，不限制规则，在handle中自行判断
 chat = on_message(priority=50, block=False)
+# 群聊超出每日Token配额且设置为降级时，主动参与的活跃度乘以该系数
+QUOTA_DOWNGRADE_FACTOR = 0.5
 
-async def send_split_messages(chat_handler, message: str, event: MessageEvent = None, delay_range: tuple = (2, 3)):
+async def send_split_messages(bot: Bot, event: MessageEvent, key: str, reply: List[str], at_sender: bool = False, delay_range: tuple = (2, 3)):
     """
     分段发送消息，支持@回复
-    :param chat_handler: 聊天处理器
-    :param message: 要发送的消息
-    :param event: 消息事件，用于@回复
+    交给出站调度器按会话顺序发送，不在处理器中等待延迟
+    :param bot: 发送使用的Bot
+    :param event: 消息事件，用于确定发送目标
+    :param key: 会话key
+    :param reply: 已解析好的回复分段
+    :param at_sender: 第一段是否需要@触发用户
     :param delay_range: 每段消息之间的延迟时间范围（秒）
     """
-    if not message:
-        return
-
-    segments = []
-    
-    # 尝试解析JSON格式
-    try:
-        data = json.loads(message)
-        if isinstance(data, dict) and "reply" in data and isinstance(data["reply"], list):
-            segments = [segment for segment in data["reply"] if segment and segment.strip()]
-    except (json.JSONDecodeError, TypeError) as e:
-        # 如果不是JSON，直接使用原消息
-        error_msg = f"处理聊天请求时发生异常:\n {str(e)}"
-        await send_error_to_super_users(error_msg, event)
-        return
-
+    segments = [segment for segment in reply if segment and segment.strip()]
     if not segments:
         return
 
     # 如果被@且是群聊，第一段需要@触发用户
-    if event and hasattr(event, 'group_id') and event.group_id and event.is_tome():
-        first_segment = segments[0]
-        # 构建@消息
-        at_message = Message(f"[CQ:at,qq={event.user_id}] {first_segment}")
-        await chat_handler.send(at_message)
-        
-        # 发送剩余段落
-        for segment in segments[1:]:
-            await chat_handler.send(segment)
-            if segment != segments[-1]:  # 不是最后一段就延迟
-                await asyncio.sleep(random.uniform(*delay_range))
-    else:
-        # 普通分段发送
-        for i, segment in enumerate(segments):
-            await chat_handler.send(segment)
-            if i < len(segments) - 1:
-                await asyncio.sleep(random.uniform(*delay_range))
+    if at_sender:
+        segments[0] = Message(f"[CQ:at,qq={event.user_id}] {segments[0]}")
+
+    outbound_dispatcher.enqueue(bot, event, key, segments, delay_range)
 
 @chat.handle()
 async def _(bot: Bot, event: MessageEvent):
@@ -103,6 +90,9 @@ async def _(bot: Bot, event: MessageEvent):
         key = user_id
         is_group = False
     
+    # 语义缓存和用量记账按会话区分
+    session_scope.set(key)
+
     user_msg2 = str(event.get_plaintext())
     # 过滤掉命令消息
     if user_msg2.startswith("px "):
@@ -119,15 +109,17 @@ async def _(bot: Bot, event: MessageEvent):
 
     # 群聊特殊处理
     if is_group:
-        # 记录用户信息到上下文（即使不触发AI回复）
-        user_info = f"用户{user_id}({event.sender.nickname if event.sender else '未知用户'})说："
-        user_message_with_info = f"{user_info}: {user_msg}"
+        # 记录用户信息到上下文（即使不触发AI回复），发送者前缀在请求时渲染
+        nickname = event.sender.nickname if event.sender else '未知用户'
         
-        # 添加到上下文
-        add_message(key, "user", user_message_with_info)
+        # 添加到上下文，记录消息ID和回复关系用于按对话线索挑选上下文
+        reply_to = str(event.reply.message_id) if event.reply else None
+        add_message(key, "user", user_msg, message_id=str(event.message_id), user_id=user_id, nickname=nickname, reply_to=reply_to)
+        memory_store.observe(user_id, user_msg)
 
         # 判断是否需要回复
         should_reply = False
+        speculative = None
         
         # 情况1: 被@了必须回复
         if event.is_tome():
@@ -137,18 +129,61 @@ async def _(bot: Bot, event: MessageEvent):
             group_manager.renew_probability(group_id_str)
         # 情况2: 没有被@，根据活跃度和AI判断
         else:
-            # 获取当前活跃度
+            # 主动参与产生的调用（判断、推测生成和回复）都按低优先级排队
+            request_priority.set(PRIORITY_AMBIENT)
+            # 获取当前活跃度，超出当天Token配额时降级或跳过主动参与
             dynamic_probability = group_manager.get_probability(group_id_str)
+            quota_action = usage_ledger.quota_action(group_id_str)
+            if quota_action == "skip":
+                logger.info(f"群组 {group_id_str} 超出每日Token配额，跳过主动参与")
+                dynamic_probability = 0
+            elif quota_action == "downgrade":
+                dynamic_probability *= QUOTA_DOWNGRADE_FACTOR
             if random.random() < dynamic_probability:
-                # AI判断是否应该回复
-                try:
-                    should_reply = await should_reply_in_group(get_context(key))
-                except Exception as e:
-                    error_msg = f"群聊对话判断异常:\n {str(e)}" 
-                    await send_error_to_super_users(error_msg, event)
-                    should_reply = False  # 出错则不回复
+                # 先用本地规则过滤，能直接判断的不再调用AI
+                prefiltered = group_prefilter.check(group_id_str, event)
+                if prefiltered is not None:
+                    should_reply = prefiltered
+                else:
+                    # AI判断是否应该回复，短时间内的多条消息合并为一次判断
+                    # 回复比例高的群可同时推测生成回复，判断为不需要时取消
+                    # 合并判断模式下由回复调用自己决定是否发言，只需一次调用
+                    # 降级时只用简短的判断调用，不推测生成、不合并判断
+                    if quota_action == "downgrade":
+                        judge = lambda: judgment_classifier.judge(
+                            get_context(key), lambda messages: judgment_batcher.judge(group_id_str, messages)
+                        )
+                    elif chat_manager.get_group_judge_mode() == "fused":
+                        judge = lambda: judgment_classifier.judge(
+                            get_context(key),
+                            lambda messages: speculative_replier.fused_judge(
+                                group_id_str,
+                                lambda: get_chat_reply_with_tools(
+                                    build_reply_messages(bot, event, key, user_id, True), True, allow_silence=True
+                                ),
+                            ),
+                        )
+                    else:
+                        judge = lambda: speculative_replier.judge(
+                            group_id_str,
+                            lambda: judgment_classifier.judge(
+                                get_context(key), lambda messages: judgment_batcher.judge(group_id_str, messages)
+                            ),
+                            lambda: get_chat_reply_with_tools(build_reply_messages(bot, event, key, user_id, True), True),
+                        )
+                    try:
+                        should_reply = await windowed_judge.submit(group_id_str, judge)
+                    except AdmissionRejected as e:
+                        logger.info(f"群组 {group_id_str} 判断被准入控制丢弃: {e}")
+                        should_reply = False
+                    except Exception as e:
+                        error_msg = f"群聊对话判断异常:\n {str(e)}" 
+                        await send_error_to_super_users(error_msg, event)
+                        should_reply = False  # 出错则不回复
                 if should_reply:
                     logger.info(f"AI判断需要参与群聊讨论")
+                    # 取走判断时推测生成的回复（如果有）
+                    speculative = speculative_replier.take(group_id_str)
                     # 续租群聊活跃度
                     group_manager.renew_probability(group_id_str)
                 else:
@@ -157,30 +192,95 @@ async def _(bot: Bot, event: MessageEvent):
         if not should_reply:
             return
     else:
+        speculative = None
+        # 私聊连发的消息等待窗口结束后合并为一条
+        if chat_manager.is_private_debounce_enabled():
+            user_msg = await private_debouncer.submit(key, user_msg)
+            if user_msg is None:
+                return
         # 私聊直接记录
         add_message(key, "user", user_msg)
+        memory_store.observe(user_id, user_msg)
 
     # 调用聊天接口（群聊和私聊使用不同的系统提示词）
     try:
-        # 获取回复，没有开启MCP的话会切换到普通对话
-        reply = await get_chat_reply_with_tools(get_context(key), is_group)
+        # 优先使用判断时推测生成的回复
+        if speculative:
+            reply = await speculative
+        else:
+            # 获取回复，没有开启MCP的话会切换到普通对话
+            reply = await get_chat_reply_with_tools(build_reply_messages(bot, event, key, user_id, is_group), is_group)
         
-        # 添加机器人回复 - 记录原始回复内容
-        add_message(key, "assistant", reply)
+        # 模型选择不发言时不记录也不发送
+        if is_silent_reply(reply):
+            logger.info("模型选择不发言")
+            return
+
+        # 添加机器人回复 - 记录解析好的分段，群聊中记录回复的是哪条消息
+        add_reply(key, reply, reply_to=str(event.message_id) if is_group else None)
 
-        # 分段发送主回复，传入event用于@回复
-        await send_split_messages(chat, reply, event if is_group else None)
+        # 分段发送主回复，群聊中被@时第一段@触发用户
+        await send_split_messages(bot, event, key, reply, at_sender=is_group and event.is_tome())
+        if is_group:
+            group_prefilter.record_reply(group_id_str)
 
+    except AdmissionRejected as e:
+        # 负载过高被丢弃，不是上下文的问题，保留对话
+        logger.warning(f"会话 {key} 的回复被准入控制丢弃: {e}")
+        if request_priority.get() != PRIORITY_AMBIENT:
+            await chat.send("现在消息有点多，稍后再试试吧")
     except Exception as e:
-        error_msg = f"处理聊天请求时发生异常:\n {str(e)}"
-        # 清除上下文
-        clear_context(key)
-        # 发送异常信息给超级用户
-        await send_error_to_super_users(error_msg, event)
+        kind = classify_error(e)
+        error_tracker.record_error(kind)
+        error_msg = f"处理聊天请求时发生异常({ERROR_LABELS[kind]}):\n {str(e)}"
+        if kind in CONTEXT_ERRORS:
+            # 只有上下文本身有问题时才清除，重发同样的上下文必然再次失败
+            error_tracker.record("cleared")
+            error_tracker.record("cleared_tokens", estimate_messages_tokens(get_context(key)))
+            clear_context(key)
+        else:
+            # 临时错误、配置问题等与对话无关，保留上下文，下一条消息可以继续
+            error_tracker.record("kept")
+        # 发送异常信息给超级用户，同类的非上下文错误在告警间隔内只发一次
+        if error_tracker.should_alert(kind):
+            await send_error_to_super_users(error_msg, event)
         # 给用户返回统一回复
         await chat.send("抱歉，处理消息时出现了问题，已通知管理员")
 
 
+def build_reply_messages(bot: Bot, event: MessageEvent, key: str, user_id: str, is_group: bool) -> list:
+    """
+    构建回复请求的消息列表，推测生成、合并判断和正常回复都经由这里，保证同一条消息的回复使用相同的提示
+    群聊按当前消息所在的对话线索挑选上下文，并附带与触发用户相关的长期记忆
+    """
+    if is_group:
+        quoted, targets = get_thread_hints(bot, event, key)
+        messages = select_thread(key, str(event.message_id), quoted, targets)
+    else:
+        messages = get_context(key)
+    return memory_store.with_memory(user_id, messages)
+
+
+def get_thread_hints(bot: Bot, event: MessageEvent, key: str):
+    """
+    从消息的回复和@中取出对话线索
+    :return: (被回复消息已不在上下文中时的引用文本, 被@的其他用户)
+    """
+    quoted = None
+    if event.reply and get_message(key, str(event.reply.message_id)) is None:
+        sender = event.reply.sender
+        if str(sender.user_id) == bot.self_id:
+            speaker = "你(px)"
+        else:
+            speaker = f"用户{sender.user_id}({sender.nickname or '未知用户'})"
+        quoted = f"{speaker}: {event.reply.message.extract_plain_text()}"
+    targets = {
+        str(seg.data.get("qq")) for seg in event.message
+        if seg.type == "at" and str(seg.data.get("qq")) not in (bot.self_id, "all")
+    }
+    return quoted, targets
+
+
 # 检查
 async def event_proc(event: MessageEvent):
     # 检查图片识别功能是否开启
@@ -203,6 +303,9 @@ async def event_proc(event: MessageEvent):
                 # 识别图片内容
                 recognition_msg += "\n".join(recognition_list)
                 logger.info(f"识别结果: {recognition_msg}")
+            except AdmissionRejected as e:
+                logger.info(f"图片识别被准入控制丢弃: {e}")
+                recognition_msg += "\n[图片未识别]"
             except Exception as e:
                 error_msg = f"图片识别失败: {str(e)}"
                 logger.info(error_msg)
@@ -365,4 +468,10 @@ driver = get_driver()
 async def shutdown_hook():
     """Driver 关闭时清理定时任务"""
     if group_manager:
-        await group_manager.shutdown()
\ No newline at end of file
+        await group_manager.shutdown()
+    # 先停止出站限流，再尽量发完排队中的消息，否则发送会卡在限流上直到超时
+    await outbound_limiter.shutdown()
+    await outbound_dispatcher.shutdown()
+    await windowed_judge.shutdown()
+    # 保存尚未写入的用量记录
+    usage_ledger.flush()
\ No newline at end of file
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+import numpy as np
+from .manager import chat_manager
+from .vectorizer import HashingVectorizer, normalize_text
+
+
+def is_cacheable(messages: list) -> bool:
+    """带工具调用过程或开启搜索的回复依赖外部实时信息，不缓存"""
+    if chat_manager.is_search_enabled():
+        return False
+    return not any(msg.get("role") == "tool" or msg.get("tool_calls") for msg in messages)
+
+
+class ResponseCache:
+    """
+    回复精确缓存：以 (模型, 系统提示词, 规范化后的最近N条消息) 的哈希为键，
+    常见问题直接返回缓存的回复，按TTL过期、按LRU淘汰
+    """
+
+    def __init__(self):
+        # { 键: {"reply": 回复, "tokens": 生成时消耗的Token, "expires": 过期时间} }
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._stats = {
+            "lookups": 0,       # 查询次数
+            "hits": 0,          # 命中次数
+            "bypassed": 0,      # 工具调用、搜索等不适合缓存而跳过的次数
+            "saved_tokens": 0,  # 命中省下的Token
+        }
+
+    def make_key(self, model: str, system_prompt: str, messages: list) -> Optional[str]:
+        """
+        计算缓存键，不适合缓存的请求返回None
+        """
+        config = chat_manager.get_response_cache()
+        if not config["enabled"]:
+            return None
+        if not is_cacheable(messages):
+            self._stats["bypassed"] += 1
+            return None
+        recent = [(msg.get("role"), normalize_text(str(msg.get("content", "")))) for msg in messages[-config["last_n"]:]]
+        # 注入的系统消息（如用户记忆）因人而异，也要计入键
+        notes = [msg.get("content") for msg in messages if msg.get("role") == "system"]
+        raw = json.dumps([model, system_prompt, notes, recent], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """查询缓存，过期条目顺便删除"""
+        self._stats["lookups"] += 1
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["expires"] < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        self._stats["hits"] += 1
+        self._stats["saved_tokens"] += entry["tokens"]
+        return entry["reply"]
+
+    def put(self, key: str, reply: str, tokens: int):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        config = chat_manager.get_response_cache()
+        self._entries[key] = {"reply": reply, "tokens": tokens, "expires": time.monotonic() + config["ttl"]}
+        self._entries.move_to_end(key)
+        while len(self._entries) > config["max_entries"]:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> int:
+        """清空缓存，返回清除的条目数"""
+        count = len(self._entries)
+        self._entries.clear()
+        return count
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取缓存统计信息"""
+        lookups = self._stats["lookups"]
+        return {
+            **self._stats,
+            "entries": len(self._entries),
+            "hit_rate": self._stats["hits"] / lookups if lookups else 0.0,
+        }
+
+
+class SemanticCache:
+    """
+    语义回复缓存：最新一条用户消息离线向量化后，在同一会话最近回答过的问题中
+    做余弦相似度查找，超过阈值时复用之前的回答
+    """
+
+    def __init__(self, dim: int = 1 << 12):
+        # 短问句用较小的维度即可，单条向量16KB
+        self._vectorizer = HashingVectorizer(dim=dim)
+        # { "会话key": {"vectors": 向量矩阵, "replies": 回复, "tokens": Token, "created": 写入时间, "used": 最近使用时间} }
+        self._scopes: Dict[str, Dict[str, Any]] = {}
+        self._stats = {
+            "lookups": 0,
+            "hits": 0,
+            "saved_tokens": 0,
+            "evicted": 0,
+            "similarity_total": 0.0,  # 命中时相似度之和，用于计算平均值
+        }
+
+    def question_of(self, messages: list) -> Optional[str]:
+        """取最新一条用户消息作为问题，太短的问题依赖上下文、注入了用户记忆的回答因人而异，都不参与语义缓存"""
+        if not messages or messages[-1].get("role") != "user":
+            return None
+        if any(msg.get("role") == "system" for msg in messages):
+            return None
+        question = str(messages[-1].get("content", ""))
+        if len(normalize_text(question)) < chat_manager.get_semantic_cache()["min_length"]:
+            return None
+        return question
+
+    def _expire(self, index: Dict[str, Any], ttl: float):
+        """删除过期条目"""
+        keep = index["created"] + ttl >= time.monotonic()
+        if not keep.all():
+            self._stats["evicted"] += int((~keep).sum())
+            self._select(index, keep)
+
+    @staticmethod
+    def _select(index: Dict[str, Any], keep: np.ndarray):
+        index["vectors"] = index["vectors"][keep]
+        index["created"] = index["created"][keep]
+        index["used"] = index["used"][keep]
+        index["replies"] = [reply for reply, kept in zip(index["replies"], keep) if kept]
+        index["tokens"] = [tokens for tokens, kept in zip(index["tokens"], keep) if kept]
+
+    def get(self, scope: str, question: str) -> Optional[str]:
+        """查找语义相近的已回答问题，返回之前的回答"""
+        config = chat_manager.get_semantic_cache()
+        index = self._scopes.get(scope)
+        self._stats["lookups"] += 1
+        if index is None:
+            return None
+        self._expire(index, config["ttl"])
+        if not len(index["replies"]):
+            return None
+
+        # 向量均已L2归一化，点积即余弦相似度
+        similarities = index["vectors"] @ self._vectorizer.transform_dense(question)
+        best = int(np.argmax(similarities))
+        similarity = float(similarities[best])
+        if similarity < config["threshold"]:
+            return None
+
+        index["used"][best] = time.monotonic()
+        self._stats["hits"] += 1
+        self._stats["saved_tokens"] += index["tokens"][best]
+        self._stats["similarity_total"] += similarity
+        return index["replies"][best]
+
+    def put(self, scope: str, question: str, reply: str, tokens: int):
+        """写入一条问答，超出容量时淘汰最久未使用的条目"""
+        config = chat_manager.get_semantic_cache()
+        vector = self._vectorizer.transform_dense(question)[np.newaxis, :]
+        now = time.monotonic()
+        index = self._scopes.get(scope)
+        if index is None:
+            self._scopes[scope] = {
+                "vectors": vector,
+                "replies": [reply],
+                "tokens": [tokens],
+                "created": np.array([now]),
+                "used": np.array([now]),
+            }
+            return
+
+        index["vectors"] = np.vstack([index["vectors"], vector])
+        index["replies"].append(reply)
+        index["tokens"].append(tokens)
+        index["created"] = np.append(index["created"], now)
+        index["used"] = np.append(index["used"], now)
+        overflow = len(index["replies"]) - config["max_entries"]
+        if overflow > 0:
+            keep = np.ones(len(index["replies"]), dtype=bool)
+            keep[np.argsort(index["used"])[:overflow]] = False
+            self._stats["evicted"] += overflow
+            self._select(index, keep)
+
+    def clear(self) -> int:
+        """清空缓存，返回清除的条目数"""
+        count = sum(len(index["replies"]) for index in self._scopes.values())
+        self._scopes.clear()
+        return count
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取语义缓存统计信息"""
+        lookups, hits = self._stats["lookups"], self._stats["hits"]
+        return {
+            "lookups": lookups,
+            "hits": hits,
+            "saved_tokens": self._stats["saved_tokens"],
+            "evicted": self._stats["evicted"],
+            "entries": sum(len(index["replies"]) for index in self._scopes.values()),
+            "scopes": len(self._scopes),
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "similarity_avg": self._stats["similarity_total"] / hits if hits else 0.0,
+        }
+
+
+# 全局回复缓存实例
+response_cache = ResponseCache()
+# 全局语义缓存实例
+semantic_cache = SemanticCache()
@@ -1,10 +1,63 @@
-from openai import BadRequestError, AsyncOpenAI
+from openai import BadRequestError
 from nonebot import logger
 from .manager import chat_manager
 from .mcp_manager import mcp_client  # 导入MCP管理器
+from .router import provider_router
+from .errors import MalformedReplyError, error_tracker
+from .scheduler import AdmissionRejected, session_scope
+from .cache import response_cache, semantic_cache, is_cacheable
+from .segments import parse_reply, get_format_instructions
+from contextvars import ContextVar
+from typing import Dict, List, Optional
 import asyncio
 import json
 
+# 当前调用链的Token消耗记录，调用方在任务内设置一个列表即可收集该任务产生的总Token数
+usage_recorder: ContextVar[Optional[List[int]]] = ContextVar("usage_recorder", default=None)
+
+# { "调用类型": {"calls": 调用次数, "prompt_tokens": 提示Token, "cached_tokens": 命中服务商前缀缓存的Token} }
+_prefix_cache_stats: Dict[str, Dict[str, int]] = {}
+
+def record_usage(label: str, response) -> int:
+    """记录一次调用的Token消耗，返回总Token数"""
+    total_tokens = 0
+    if hasattr(response, 'usage') and response.usage:
+        usage_info = response.usage
+        prompt_tokens = getattr(usage_info, 'prompt_tokens', 0) or 0
+        completion_tokens = getattr(usage_info, 'completion_tokens', 0)
+        total_tokens = getattr(usage_info, 'total_tokens', 0) or 0
+        # 服务商前缀缓存命中的Token数，不支持的服务商没有该字段
+        details = getattr(usage_info, 'prompt_tokens_details', None)
+        cached_tokens = getattr(details, 'cached_tokens', 0) or 0
+        stats = _prefix_cache_stats.setdefault(label, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0})
+        stats["calls"] += 1
+        stats["prompt_tokens"] += prompt_tokens
+        stats["cached_tokens"] += cached_tokens
+        logger.info(f"{label}Token消耗 - 提示Token: {prompt_tokens} (缓存命中: {cached_tokens}), 补全Token: {completion_tokens}, 总计: {total_tokens}")
+    recorder = usage_recorder.get()
+    if recorder is not None:
+        recorder.append(total_tokens)
+    return total_tokens
+
+def get_prefix_cache_stats() -> Dict[str, Dict[str, int]]:
+    """获取各类调用的服务商前缀缓存命中统计"""
+    return {label: dict(stats) for label, stats in _prefix_cache_stats.items()}
+
+# 群聊是否主动参与的判断原则，判断调用和合并判断的回复调用共用
+GROUP_JUDGMENT_RULES = """
+【需要回复的情况】
+1. 有人直接发出提问或寻求建议（即使没at你）
+2. 有人表达了困惑或需要帮助
+3. 有人分享有趣内容，适合互动回应
+4. 话题与你相关或你有独特见解
+
+【不需要回复的情况】
+1. 其他人正在相互对话
+2. 话题与你完全无关
+4. 对话已经有很多人参与，不缺互动
+5. 如果出现了at的内容，注意不是at你
+"""
+
 def get_current_time() -> str:
     """获取当前时间"""
     import datetime
@@ -32,9 +85,28 @@ local_available_functions = {
     "get_current_time": get_current_time
 }
 
-async def get_chat_reply_with_tools(messages: list, is_group: bool = False) -> str:
+# 工具规划阶段的固定指令
+TOOL_PLANNING_PROMPT = "请仅判断是否需要调用工具，若需要则直接调用，不需要则回复NO"
+
+# 上一次组装的工具列表: (MCP工具签名, 工具列表)
+_tool_schema_cache: tuple = ("", [])
+
+def get_tool_schemas(mcp_tools: list) -> list:
+    """
+    组装工具列表：本地工具在前，MCP工具按名称排序，
+    工具未变化时复用同一个列表，保证每次请求的工具定义逐字节一致，便于服务商前缀缓存命中
+    """
+    global _tool_schema_cache
+    ordered = sorted(mcp_tools, key=lambda tool: tool["function"]["name"])
+    signature = json.dumps(ordered, ensure_ascii=False, sort_keys=True)
+    if _tool_schema_cache[0] != signature:
+        _tool_schema_cache = (signature, local_tools + json.loads(signature))
+    return _tool_schema_cache[1]
+
+async def get_chat_reply_with_tools(messages: list, is_group: bool = False, allow_silence: bool = False) -> List[str]:
     """
     结合function call和分段回复的聊天回复函数 - 使用消息副本处理工具调用
+    allow_silence: 允许模型返回空回复表示不参与（群聊合并判断模式）
     """
     # 检查全局开关
     if not chat_manager.is_chat_enabled():
@@ -43,10 +115,10 @@ async def get_chat_reply_with_tools(messages: list, is_group: bool = False) -> s
     # 检查MCP功能是否启用
     if not chat_manager.is_mcp_enabled():
         logger.info("MCP功能未启用，使用普通聊天模式")
-        return await get_chat_reply(messages, is_group)
+        return await get_chat_reply(messages, is_group, allow_silence)
     
-    # 获取当前AI配置
-    ai_config = chat_manager.get_current_ai_config()
+    # 获取工具规划阶段的AI配置
+    ai_config = chat_manager.get_stage_ai_config("tool")
     
     if not ai_config:
         raise Exception("未配置服务，请使用 'px ai add' 命令添加配置")
@@ -56,7 +128,7 @@ async def get_chat_reply_with_tools(messages: list, is_group: bool = False) -> s
         processing_messages = messages.copy()
         
         # 获取工具列表
-        all_tools = local_tools.copy()  # 先添加本地工具
+        mcp_tools = []
         
         # 检查是否有启用的MCP服务器
         enabled_servers = chat_manager.get_enabled_mcp_servers()
@@ -64,29 +136,21 @@ async def get_chat_reply_with_tools(messages: list, is_group: bool = False) -> s
             try:
                 mcp_tools_list = await mcp_client.get_tools()
                 mcp_tools = mcp_client.get_openai_tools_format()
-                all_tools.extend(mcp_tools)
-                logger.info(f"MCP功能已启用，可用工具总数: {len(all_tools)} (本地: {len(local_tools)}, MCP: {len(mcp_tools)})")
+                logger.info(f"MCP功能已启用，可用工具总数: {len(local_tools) + len(mcp_tools)} (本地: {len(local_tools)}, MCP: {len(mcp_tools)})")
             except Exception as e:
                 logger.warning(f"获取MCP工具失败，将只使用本地工具: {e}")
         else:
             logger.info("没有启用的MCP服务器，只使用本地工具")
-        
-        # 动态创建客户端
-        client = AsyncOpenAI(
-            api_key=ai_config.get("api_key", ""),
-            base_url=ai_config.get("api_url", ""),
-        )
+        all_tools = get_tool_schemas(mcp_tools)
         
         # 第一阶段：Function Call处理（使用异步调用）
         logger.info("开始工具调用判断")
-        response = await client.chat.completions.create(
-            model=ai_config.get("model", ""),
+        # 固定指令放在系统消息中，问题放在最后，保持请求前缀稳定
+        response = await provider_router.create(
+            "tool",
             messages=[
-                {
-                    "role": "user",
-                    "content": "请仅判断是否需要调用工具，若需要则直接调用，不需要则回复NO\n" +
-                                f"问题: {processing_messages[-1]['content']}"
-                }
+                {"role": "system", "content": TOOL_PLANNING_PROMPT},
+                {"role": "user", "content": f"问题: {processing_messages[-1]['content']}"},
             ],
             tools=all_tools,
             tool_choice="auto",
@@ -97,12 +161,7 @@ async def get_chat_reply_with_tools(messages: list, is_group: bool = False) -> s
         tool_calls = message.tool_calls
         
         # 记录Token消耗
-        if hasattr(response, 'usage') and response.usage:
-            usage_info = response.usage
-            prompt_tokens = getattr(usage_info, 'prompt_tokens', 0)
-            completion_tokens = getattr(usage_info, 'completion_tokens', 0)
-            total_tokens = getattr(usage_info, 'total_tokens', 0)
-            logger.info(f"Function Call判断Token消耗 - 提示Token: {prompt_tokens}, 补全Token: {completion_tokens}, 总计: {total_tokens}")
+        record_usage("Function Call判断", response)
         
         # 如果有工具调用，执行调用（在副本上进行）
         if tool_calls:
@@ -162,23 +221,28 @@ async def get_chat_reply_with_tools(messages: list, is_group: bool = False) -> s
                             "content": error_msg
                         })
         
-        # 第二阶段：使用处理后的消息副本生成最终回复
-        tmp_record = "\n".join(str(msg) for msg in processing_messages[-5:])
-        logger.info(f"最近5条处理消息记录（含工具调用过程）:\n{tmp_record}")
-        # 使用 processing_messages（包含工具调用过程）来生成最终回复
-        logger.info(f"调用原有逻辑生成格式化回复")
-        final_reply = await get_chat_reply(processing_messages, is_group)
-        
-        # 但只将最终回复添加到原始消息中，不包含工具调用过程
-        return final_reply
-        
+    except AdmissionRejected:
+        # 被准入控制丢弃时不能回退再发一次，否则又排进同一个已满的队列
+        raise
     except Exception as e:
         logger.error(f"get_chat_reply_with_tools 发生异常: {e}")
         # 如果工具调用失败，回退到普通聊天模式
         logger.info("工具调用失败，回退到普通聊天模式")
-        return await get_chat_reply(messages, is_group)
+        return await get_chat_reply(messages, is_group, allow_silence)
+    
+    # 第二阶段：使用处理后的消息副本生成最终回复
+    # 最终回复的错误直接交给调用方分类处理，不再回退重复生成
+    tmp_record = "\n".join(str(msg) for msg in processing_messages[-5:])
+    logger.info(f"最近5条处理消息记录（含工具调用过程）:\n{tmp_record}")
+    # 使用 processing_messages（包含工具调用过程）来生成最终回复
+    logger.info(f"调用原有逻辑生成格式化回复")
+    final_reply = await get_chat_reply(processing_messages, is_group, allow_silence)
+    
+    # 但只将最终回复添加到原始消息中，不包含工具调用过程
+    return final_reply
 
-def get_reply_format(is_group: bool = False):
+def get_reply_format(is_group: bool = False, allow_silence: bool = False, reply_format: str = "json"):
+    silence, instructions = get_format_instructions(reply_format)
     base_format = ""
     if is_group:
         base_format += """
@@ -187,19 +251,11 @@ def get_reply_format(is_group: bool = False):
     - 保持自然，像普通群成员一样参与讨论
     - 不要表现得像机器人，要有自己的观点和性格
 """
-    base_format += """
-请严格按照以下JSON格式回复，不要包含任何其他内容：
-{
-  "reply": [
-    "第一段内容",
-    "第二段内容",
-    "可能还有更多段..."
-  ]
-}
-
-内容要求：
-1. 不要使用markdown格式，只返回纯JSON
-2. 回复段数随机，80%的情况下保持一段内容，保持简洁
+    if is_group and allow_silence:
+        base_format += """
+没有人at你，你需要先判断是否要主动参与对话：
+""" + GROUP_JUDGMENT_RULES + "\n" + silence
+    base_format += instructions + """2. 回复段数随机，80%的情况下保持一段内容，保持简洁
 3. 在以下情况下必须分段：
    - 内容明显切换主题（比如从问题分析转到个人建议）
    - 包含代码块、示例或需要突出显示的部分
@@ -210,40 +266,71 @@ def get_reply_format(is_group: bool = False):
 """    
     return base_format
 
-def get_system_prompt(is_group: bool = False):
+# { (人设, 是否群聊, 是否允许沉默, 回复格式): 系统提示词 }，人设变化时自然换用新键
+_system_prompts: Dict[tuple, str] = {}
+
+def get_system_prompt(is_group: bool = False, allow_silence: bool = False):
+    """获取系统提示词，同一配置下每次返回完全相同的文本作为稳定前缀"""
     personality = chat_manager.get_personality()
-    return personality + get_reply_format(is_group)
+    reply_format = chat_manager.get_reply_wire_format()
+    cache_key = (personality, is_group, allow_silence, reply_format)
+    prompt = _system_prompts.get(cache_key)
+    if prompt is None:
+        prompt = personality + get_reply_format(is_group, allow_silence, reply_format)
+        _system_prompts[cache_key] = prompt
+    return prompt
+
+def is_silent_reply(reply: List[str]) -> bool:
+    """检查回复是否为不发言（没有任何分段）"""
+    return not any(segment.strip() for segment in reply)
 
-async def get_chat_reply(messages: list, is_group: bool = False) -> str:
+async def get_chat_reply(messages: list, is_group: bool = False, allow_silence: bool = False) -> List[str]:
     """
     messages: [{"role": "user|assistant|system", "content": str}, ...]
     is_group: 是否为群聊环境
+    allow_silence: 允许返回空回复表示不参与
+    返回解析好的回复分段，空列表表示不发言
     """
     # 检查全局开关
     if not chat_manager.is_chat_enabled():
         raise Exception("聊天功能当前已关闭")
     
-    # 获取当前AI配置
-    ai_config = chat_manager.get_current_ai_config()
+    # 获取回复阶段的AI配置
+    ai_config = chat_manager.get_stage_ai_config("reply")
     
     if not ai_config:
         raise Exception("未配置服务，请使用 'px ai add' 命令添加配置")
     
     try:
-        # 动态创建客户端
-        client = AsyncOpenAI(
-            api_key=ai_config.get("api_key", ""),
-            base_url=ai_config.get("api_url", ""),
-        )
-        
-        # 构建请求参数
+        system_prompt = get_system_prompt(is_group, allow_silence)
+
+        # 常见问题优先使用缓存的回复
+        cache_key = response_cache.make_key(ai_config.get("model", ""), system_prompt, messages)
+        if cache_key:
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                logger.info("命中回复缓存")
+                return list(cached)
+
+        # 同一会话里意思相近的问题复用之前的回答；合并判断模式需要模型自己决定是否发言，不复用
+        question, scope = None, session_scope.get()
+        if scope and not allow_silence and chat_manager.get_semantic_cache()["enabled"] and is_cacheable(messages):
+            question = semantic_cache.question_of(messages)
+            if question:
+                cached = semantic_cache.get(scope, question)
+                if cached is not None:
+                    logger.info("命中语义缓存")
+                    return list(cached)
+
+        # 构建请求参数，分段格式不需要JSON模式
+        reply_format = chat_manager.get_reply_wire_format()
         request_params = {
-            "model": ai_config.get("model", ""),
-            "messages": [{"role": "system", "content": get_system_prompt(is_group)}] + messages,
-            "response_format": {
+            "messages": [{"role": "system", "content": system_prompt}] + messages,
+        }
+        if reply_format == "json":
+            request_params["response_format"] = {
                 'type': 'json_object'
             }
-        }
         
         # 只有在搜索功能启用时才添加搜索参数
         if chat_manager.is_search_enabled():
@@ -252,37 +339,56 @@ async def get_chat_reply(messages: list, is_group: bool = False) -> str:
                 "search_options": {"forced_search": True}
             }
         
-        # 直接使用异步调用
-        reply_obj = await client.chat.completions.create(**request_params)
-        reply = reply_obj.choices[0].message.content
-        
-        # 获取并记录Token消耗
-        if hasattr(reply_obj, 'usage') and reply_obj.usage:
-            usage_info = reply_obj.usage
-            prompt_tokens = getattr(usage_info, 'prompt_tokens', 0)
-            completion_tokens = getattr(usage_info, 'completion_tokens', 0)
-            total_tokens = getattr(usage_info, 'total_tokens', 0)
-            logger.info(f"对话Token消耗 - 提示Token: {prompt_tokens}, 补全Token: {completion_tokens}, 总计: {total_tokens}")
-
-        if not reply:
-            raise Exception("AI返回了空回复")
+        # 回复格式无法修复时重新生成一次
+        for attempt in range(2):
+            reply_obj = await provider_router.create("reply", **request_params)
+            reply = reply_obj.choices[0].message.content
             
-        return reply
+            # 记录Token消耗
+            tokens = record_usage("对话", reply_obj)
+
+            if not reply:
+                raise Exception("AI返回了空回复")
+
+            segments, exact = parse_reply(reply, reply_format)
+            if segments is not None:
+                if not exact:
+                    error_tracker.record("repaired")
+                if cache_key:
+                    response_cache.put(cache_key, segments, tokens)
+                if question and not is_silent_reply(segments):
+                    semantic_cache.put(scope, question, segments, tokens)
+                return list(segments)
+            logger.warning(f"回复格式无法解析: {reply[:200]}")
+            if attempt == 0:
+                error_tracker.record("regenerated")
+        raise MalformedReplyError(f"AI回复格式异常，重新生成后仍无法解析\n{reply[:200]}")
         
     except BadRequestError as e:
-        # 处理请求错误
-        error_msg = f"对话请求异常\n{e}"
-        raise Exception(error_msg)
-    except Exception as e:
-        # 重新抛出其他异常
-        raise e
+        # 保留异常类型，由调用方判断是否需要清除上下文
+        logger.error(f"对话请求异常: {e}")
+        raise
+
+def build_judge_content(messages: list) -> str:
+    """将最近10条群聊记录整理为判断用的文本"""
+    judge_content = []
+    for msg in messages[-10:]:
+        if msg["role"] == "user":
+            judge_content.append(f"{msg['content']}")
+        else:
+            # 上下文中的回复已带有解析好的分段
+            segments = getattr(msg, "segments", None)
+            if segments is None:
+                segments = parse_reply(msg["content"], chat_manager.get_reply_wire_format())[0] or ['']
+            judge_content.append(f"你(px)回复说: {segments}")
+    return "\n".join(judge_content)
 
 async def should_reply_in_group(messages: list) -> bool:
     """
     判断在群聊中是否应该回复（当没有被@时）
     """
-    # 获取当前AI配置
-    ai_config = chat_manager.get_current_ai_config()
+    # 获取判断阶段的AI配置
+    ai_config = chat_manager.get_stage_ai_config("judge")
     
     if not ai_config:
         return False
@@ -291,52 +397,23 @@ async def should_reply_in_group(messages: list) -> bool:
         # 构建判断提示词
         judgment_prompt = """
 你是一个在群聊中的参与者，需要判断是否要主动参与对话。请基于以下原则判断：
-
-【需要回复的情况】
-1. 有人直接发出提问或寻求建议（即使没at你）
-2. 有人表达了困惑或需要帮助
-3. 有人分享有趣内容，适合互动回应
-4. 话题与你相关或你有独特见解
-
-【不需要回复的情况】
-1. 其他人正在相互对话
-2. 话题与你完全无关
-4. 对话已经有很多人参与，不缺互动
-5. 如果出现了at的内容，注意不是at你
-
+""" + GROUP_JUDGMENT_RULES + """
 请分析最近的对话，判断是否需要你参与
 只回复 "YES" 或 "NO"，不要其他内容。
 """
         
-        client = AsyncOpenAI(
-            api_key=ai_config.get("api_key", ""),
-            base_url=ai_config.get("api_url", ""),
-        )
-        
-        judge_content = []
-        for msg in messages[-10:]:
-            if msg["role"] == "user":
-                judge_content.append(f"{msg['content']}")
-            else:
-                data = json.loads(msg['content'])
-                judge_content.append(f"你(px)回复说: {data.get('reply', [''])}")
-        content = "\n".join(judge_content)
+        content = build_judge_content(messages)
         
-        completion_obj = await client.chat.completions.create(
-            model=ai_config.get("model", ""),
+        completion_obj = await provider_router.create(
+            "judge",
             messages=[{"role": "system", "content": chat_manager.get_personality() + judgment_prompt}, {"role": "user", "content": "群聊记录\n" + content}],
             max_tokens=10
         )
         
         judgment = completion_obj.choices[0].message.content
 
-        # 获取并记录Token消耗
-        if hasattr(completion_obj, 'usage') and completion_obj.usage:
-            usage_info = completion_obj.usage
-            prompt_tokens = getattr(usage_info, 'prompt_tokens', 0)
-            completion_tokens = getattr(usage_info, 'completion_tokens', 0)
-            total_tokens = getattr(usage_info, 'total_tokens', 0)
-            logger.info(f"判断Token消耗 - 提示Token: {prompt_tokens}, 补全Token: {completion_tokens}, 总计: {total_tokens}")
+        # 记录Token消耗
+        record_usage("判断", completion_obj)
 
         logger.info(f"群聊回复判断结果: {judgment.strip().upper()}")
 
@@ -345,4 +422,48 @@ async def should_reply_in_group(messages: list) -> bool:
         return judgment == "YES"
         
     except Exception as e:
-        raise e
\ No newline at end of file
+        raise e
+
+async def should_reply_in_groups(batch: Dict[str, list]) -> Dict[str, bool]:
+    """
+    一次请求批量判断多个群聊是否应该回复
+    batch: { "群号": 群聊上下文 }
+    返回: { "群号": 是否回复 }，模型没有给出结论的群不在结果中
+    """
+    ai_config = chat_manager.get_stage_ai_config("judge")
+    
+    if not ai_config:
+        return {group_id: False for group_id in batch}
+    
+    judgment_prompt = """
+你同时是多个群聊中的参与者，需要分别判断是否要在每个群主动参与对话。请基于以下原则判断：
+""" + GROUP_JUDGMENT_RULES + """
+每个群的记录互不相关，请分别分析每个群最近的对话
+严格按照以下JSON格式回复，键为群号，值为 "YES" 或 "NO"，不要其他内容：
+{"群号1": "YES", "群号2": "NO"}
+"""
+    
+    content = "\n\n".join(
+        f"【群号 {group_id}】群聊记录\n{build_judge_content(messages)}" for group_id, messages in batch.items()
+    )
+    
+    completion_obj = await provider_router.create(
+        "judge",
+        messages=[{"role": "system", "content": chat_manager.get_personality() + judgment_prompt}, {"role": "user", "content": content}],
+        response_format={'type': 'json_object'},
+        max_tokens=12 * len(batch) + 20
+    )
+    
+    record_usage("批量判断", completion_obj)
+    
+    data = json.loads(completion_obj.choices[0].message.content or "")
+    if not isinstance(data, dict):
+        raise ValueError("批量判断返回的不是JSON对象")
+    
+    results = {}
+    for group_id in batch:
+        value = data.get(group_id, data.get(f"群号{group_id}"))
+        if isinstance(value, str) and value.strip().upper() in ("YES", "NO"):
+            results[group_id] = value.strip().upper() == "YES"
+    logger.info(f"批量判断结果: {results}")
+    return results
@@ -0,0 +1,225 @@
+import asyncio
+import json
+import os
+import random
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+import numpy as np
+from nonebot import logger
+import nonebot_plugin_localstore as store
+from .manager import chat_manager
+from .chat import build_judge_content
+from .vectorizer import HashingVectorizer
+
+SAMPLES_FILE = store.get_plugin_data_file("px_judge_samples.jsonl")
+MODEL_FILE = store.get_plugin_data_file("px_judge_model.npz")
+MAX_SAMPLES = 5000       # 样本文件最多保留的条数
+SAMPLE_SLACK = 500       # 超出上限这么多条后才压缩一次样本文件，避免每条样本都重写文件
+MIN_TRAIN_SAMPLES = 50   # 训练所需的最少样本数
+
+
+class JudgmentClassifier:
+    """
+    群聊参与判断的本地蒸馏模型
+    记录AI判断的 (群聊窗口, YES/NO) 作为训练样本，离线训练哈希n-gram + 逻辑回归模型，
+    高置信度时代替AI判断以节省调用
+    """
+
+    def __init__(self):
+        self._vectorizer = HashingVectorizer()
+        self._weights: Optional[np.ndarray] = None
+        self._bias = 0.0
+        self._report: Dict[str, Any] = {}
+        # 样本文件中的条数，首次记录时统计
+        self._sample_count: Optional[int] = None
+        self._stats = {
+            "llm_calls": 0,       # 交给AI判断的次数
+            "saved": 0,           # 本地模型直接判断、省掉的AI调用次数
+            "shadow_total": 0,    # AI判断时同时有本地预测的次数
+            "shadow_agree": 0,    # 其中本地预测与AI一致的次数
+        }
+        self._load_model()
+
+    def _features(self, content: str) -> Tuple[np.ndarray, np.ndarray]:
+        """整段窗口和最后两条消息分开取特征，后者对是否回复影响更大"""
+        lines = content.split("\n")
+        return self._vectorizer.transform_sparse([("W", content), ("L", "\n".join(lines[-2:]))])
+
+    def _load_model(self):
+        if not os.path.exists(MODEL_FILE):
+            return
+        try:
+            data = np.load(MODEL_FILE)
+            if int(data["dim"]) != self._vectorizer.dim:
+                logger.warning("本地判断模型维度不匹配，需要重新训练")
+                return
+            self._weights = data["weights"]
+            self._bias = float(data["bias"])
+            self._report = json.loads(str(data["report"]))
+            logger.info("本地判断模型加载成功")
+        except Exception as e:
+            logger.error(f"加载本地判断模型失败: {e}")
+
+    def has_model(self) -> bool:
+        return self._weights is not None
+
+    def predict(self, content: str) -> Optional[float]:
+        """返回需要回复的概率，没有模型时返回None"""
+        if self._weights is None:
+            return None
+        indices, values = self._features(content)
+        logit = float(np.dot(self._weights[indices], values)) + self._bias
+        return float(1.0 / (1.0 + np.exp(-logit)))
+
+    def record(self, content: str, label: bool):
+        """追加一条训练样本，样本文件超出上限时只保留最近的样本"""
+        try:
+            if self._sample_count is None:
+                self._sample_count = 0
+                if os.path.exists(SAMPLES_FILE):
+                    with open(SAMPLES_FILE, "r", encoding="utf-8") as f:
+                        self._sample_count = sum(1 for _ in f)
+            with open(SAMPLES_FILE, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"text": content, "label": int(label)}, ensure_ascii=False) + "\n")
+            self._sample_count += 1
+            if self._sample_count > MAX_SAMPLES + SAMPLE_SLACK:
+                self._load_samples()
+        except Exception as e:
+            logger.error(f"记录判断样本失败: {e}")
+
+    async def judge(self, messages: list, llm_judge: Callable[[list], Awaitable[bool]]) -> bool:
+        """
+        判断是否参与群聊：按模式先尝试本地模型，否则调用AI判断并记录样本
+        :param messages: 群聊上下文
+        :param llm_judge: AI判断函数
+        """
+        content = build_judge_content(messages)
+        mode = chat_manager.get_judge_classifier_mode()
+        probability = self.predict(content)
+
+        if probability is not None and mode != "off":
+            confidence = max(probability, 1 - probability)
+            if mode == "replace" or confidence >= chat_manager.get_judge_classifier_threshold():
+                self._stats["saved"] += 1
+                decision = probability >= 0.5
+                logger.info(f"本地模型判断结果: {'YES' if decision else 'NO'} (置信度 {confidence:.2f})")
+                return decision
+
+        self._stats["llm_calls"] += 1
+        decision = await llm_judge(messages)
+        if probability is not None:
+            self._stats["shadow_total"] += 1
+            if (probability >= 0.5) == decision:
+                self._stats["shadow_agree"] += 1
+        self.record(content, decision)
+        return decision
+
+    def _load_samples(self) -> List[Dict[str, Any]]:
+        """
+        读取样本并在超出上限时压缩样本文件，只在事件循环中调用，
+        与 record 的追加写入不会交错；压缩先写临时文件再替换，中途出错不会丢失原文件
+        """
+        if not os.path.exists(SAMPLES_FILE):
+            return []
+        samples = []
+        with open(SAMPLES_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    samples.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        # 只保留最近的样本，顺便压缩样本文件
+        if len(samples) > MAX_SAMPLES:
+            samples = samples[-MAX_SAMPLES:]
+            temp_file = f"{SAMPLES_FILE}.tmp"
+            with open(temp_file, "w", encoding="utf-8") as f:
+                for sample in samples:
+                    f.write(json.dumps(sample, ensure_ascii=False) + "\n")
+            os.replace(temp_file, SAMPLES_FILE)
+        self._sample_count = len(samples)
+        return samples
+
+    def _fit(self, features: List[Tuple[np.ndarray, np.ndarray]], labels: np.ndarray,
+             epochs: int = 300, lr: float = 4.0, l2: float = 1e-5) -> Tuple[np.ndarray, float]:
+        """稀疏特征上的加权逻辑回归（全批量梯度下降，按类别频率平衡权重）"""
+        n = len(features)
+        dim = self._vectorizer.dim
+        rows = np.concatenate([np.full(len(idx), i, dtype=np.int64) for i, (idx, _) in enumerate(features)])
+        cols = np.concatenate([idx for idx, _ in features])
+        vals = np.concatenate([val for _, val in features]).astype(np.float64)
+
+        positives = labels.sum()
+        sample_weights = np.where(labels == 1, n / (2 * max(positives, 1)), n / (2 * max(n - positives, 1)))
+
+        weights = np.zeros(dim, dtype=np.float64)
+        bias = 0.0
+        for _ in range(epochs):
+            logits = np.bincount(rows, weights=weights[cols] * vals, minlength=n) + bias
+            probs = 1.0 / (1.0 + np.exp(-logits))
+            errors = (probs - labels) * sample_weights / n
+            grad = np.bincount(cols, weights=errors[rows] * vals, minlength=dim) + l2 * weights
+            weights -= lr * grad
+            bias -= lr * errors.sum()
+        return weights.astype(np.float32), bias
+
+    def _evaluate(self, weights: np.ndarray, bias: float, features, labels: np.ndarray) -> Dict[str, float]:
+        threshold = chat_manager.get_judge_classifier_threshold()
+        probs = np.array([1.0 / (1.0 + np.exp(-(float(np.dot(weights[idx], val)) + bias))) for idx, val in features])
+        predictions = (probs >= 0.5).astype(int)
+        confident = np.maximum(probs, 1 - probs) >= threshold
+        return {
+            "agreement": float((predictions == labels).mean()) if len(labels) else 0.0,
+            "coverage": float(confident.mean()) if len(labels) else 0.0,
+            "confident_agreement": float((predictions[confident] == labels[confident]).mean()) if confident.any() else 0.0,
+        }
+
+    def _train_sync(self, samples: List[Dict[str, Any]]) -> Dict[str, Any]:
+        labels = np.array([int(sample["label"]) for sample in samples], dtype=np.float64)
+        if len(samples) < MIN_TRAIN_SAMPLES:
+            raise ValueError(f"样本不足，当前 {len(samples)} 条，至少需要 {MIN_TRAIN_SAMPLES} 条")
+        if labels.min() == labels.max():
+            raise ValueError("样本中只有一种判断结果，无法训练")
+
+        features = [self._features(sample["text"]) for sample in samples]
+
+        # 留出20%评估与AI判断的一致率
+        order = list(range(len(samples)))
+        random.Random(42).shuffle(order)
+        split = int(len(order) * 0.8)
+        train_ids, test_ids = order[:split], order[split:]
+        weights, bias = self._fit([features[i] for i in train_ids], labels[train_ids])
+        report = self._evaluate(weights, bias, [features[i] for i in test_ids], labels[test_ids])
+
+        # 用全部样本训练最终模型
+        weights, bias = self._fit(features, labels)
+        report.update({
+            "samples": len(samples),
+            "positive_rate": float(labels.mean()),
+        })
+        np.savez(MODEL_FILE, weights=weights, bias=bias, dim=self._vectorizer.dim, report=json.dumps(report))
+        self._weights, self._bias, self._report = weights, bias, report
+        return report
+
+    async def train(self) -> Dict[str, Any]:
+        """在线程池中重新训练模型，返回评估报告；样本在事件循环中读取，线程中不碰样本文件"""
+        samples = self._load_samples()
+        return await asyncio.get_running_loop().run_in_executor(None, self._train_sync, samples)
+
+    def count_samples(self) -> int:
+        if not os.path.exists(SAMPLES_FILE):
+            return 0
+        with open(SAMPLES_FILE, "r", encoding="utf-8") as f:
+            return sum(1 for _ in f)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取本地模型统计信息"""
+        shadow_total = self._stats["shadow_total"]
+        return {
+            **self._stats,
+            "has_model": self.has_model(),
+            "shadow_agreement": self._stats["shadow_agree"] / shadow_total if shadow_total else 0.0,
+            "report": self._report,
+        }
+
+
+# 全局本地判断模型实例
+judgment_classifier = JudgmentClassifier()
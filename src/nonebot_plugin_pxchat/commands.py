@@ -1,10 +1,27 @@
+import re
 from nonebot import on_command, get_bot
 from nonebot.adapters.onebot.v11 import MessageEvent, Message
 from nonebot.params import CommandArg
 from nonebot.rule import to_me
-from .manager import chat_manager
+from .manager import chat_manager, AI_STAGES
 from .send2root import send_forward_message, create_text_node, send_long_message
 from .mcp_manager import mcp_client
+from .dispatcher import outbound_dispatcher
+from .ratelimit import outbound_limiter, provider_limiter
+from .debounce import private_debouncer
+from .judge import windowed_judge, group_prefilter, judgment_batcher
+from .classifier import judgment_classifier
+from .speculative import speculative_replier, benchmark_judge_flows
+from .context import get_context, compact_all_contexts, get_compaction_stats, benchmark_memory
+from .router import provider_router
+from .scheduler import admission_scheduler
+from .errors import error_tracker, ERROR_LABELS
+from .tokens import DEFAULT_CONTEXT_WINDOW, DEFAULT_COMPLETION_BUDGET
+from .cache import response_cache, semantic_cache
+from .chat import get_prefix_cache_stats
+from .memory import memory_store
+from .segments import REPLY_FORMATS, SEGMENT_DELIMITER
+from .usage import usage_ledger, USAGE_WINDOWS, USAGE_DIMENSIONS, QUOTA_ACTIONS
 
 # 权限检查函数
 async def check_super_user(event: MessageEvent) -> bool:
@@ -23,6 +40,14 @@ probability_cmd = on_command("px prob", rule=to_me(), priority=10, block=True)
 search_cmd = on_command("px search", rule=to_me(), priority=10, block=True)
 image_cmd = on_command("px image", rule=to_me(), priority=10, block=True)
 mcp_cmd = on_command("px mcp", rule=to_me(), priority=10, block=True)
+limit_cmd = on_command("px limit", rule=to_me(), priority=10, block=True)
+debounce_cmd = on_command("px debounce", rule=to_me(), priority=10, block=True)
+judge_cmd = on_command("px judge", rule=to_me(), priority=10, block=True)
+cache_cmd = on_command("px cache", rule=to_me(), priority=10, block=True)
+memory_cmd = on_command("px memory", rule=to_me(), priority=10, block=True)
+thread_cmd = on_command("px thread", rule=to_me(), priority=10, block=True)
+compact_cmd = on_command("px compact", rule=to_me(), priority=10, block=True)
+usage_cmd = on_command("px usage", rule=to_me(), priority=10, block=True)
 
 
 @about_cmd.handle()
@@ -39,12 +64,32 @@ PX Chat 管理命令
 • px group - 查看已启用群组
 • px group add <群号> - 启用群组
 • px group del <群号> - 禁用群组
+• px thread on/off - 群聊按回复链挑选上下文
+• px thread set <Token预算> <发言条数>
+• px compact - 上下文压缩统计
+• px compact on/off - 合并重复、截断超长、缩短旧识图结果
+• px compact set <单条字数> <识图保留条数> <摘要字数>
+• px compact run - 立即压缩全部上下文
+• px compact bench [条数] - 上下文存储内存测试
 
 🔧 AI配置管理
 • px ai - 查看AI配置
 • px ai add <名称> <key> <url> <模型>
 • px ai del <名称> - 删除配置
 • px ai switch <名称> - 切换聊天配置
+• px ai stage - 查看各阶段模型
+• px ai stage <judge/tool/summary/reply> <名称/default>
+• px ai route on/off - 多服务商路由与故障切换
+• px ai route pool <名称...> - 设置候选配置
+• px ai route timeout <秒> - 单次调用超时
+• px ai hedge on/off - 慢请求对冲
+• px ai hedge set <分位数> <比例上限>
+• px ai queue on/off - 调用优先级排队
+• px ai queue set <并发上限> <排队上限>
+• px ai limit <名称> <rpm> <tpm> - 服务商限额
+• px ai window <名称> <窗口Token> [回复预留] - 上下文窗口
+• px ai price <名称> <输入价> <输出价> [缓存输入价] - 价格表
+• px ai format <json/delimited> - 回复格式
 • px image switch <名称> - 切换图片识别配置
 
 ⚙️ 功能开关
@@ -55,6 +100,8 @@ PX Chat 管理命令
 • px mcp server <服务器名> on/off - 开关单个MCP服务器
 • px mcp refresh - 刷新MCP工具缓存
 • px mcp tools - 查看可用MCP工具
+• px debounce on/off - 私聊连发合并
+• px debounce set <秒> [最短] [最长] - 合并等待窗口
 
 🎭 人设配置
 • px personality - 查看人设
@@ -63,6 +110,48 @@ PX Chat 管理命令
 📊 群活跃概率设置
 • px prob - 查看触发概率
 • px prob set <0.0-1.0>
+• px judge - 查看群聊判断统计
+• px judge window on/off - 短时间内多条消息合并判断
+• px judge window <秒> <条数> <每分钟上限>
+• px judge filter on/off - 本地前置过滤
+• px judge filter add/del yes/no <正则>
+• px judge filter name <名字...>
+• px judge filter question on/off - 问号或"吗"结尾时直接回复
+• px judge model - 本地判断模型状态
+• px judge model train - 重新训练本地判断模型
+• px judge model mode off/gate/replace
+• px judge model threshold <0.5-1.0>
+• px judge speculate on/off - 判断时推测生成回复
+• px judge speculate rate <0.0-1.0> <最少判断次数>
+• px judge flow two_step/fused - 判断流程
+• px judge bench <群号> [轮数] - 对比两种判断流程
+• px judge batch on/off - 跨群批量判断
+• px judge batch set <等待秒> <最多群数>
+
+🚦 出站限流
+• px limit - 查看限流配置
+• px limit global/group <每秒条数> <突发上限>
+• px limit weight <群号> <权重>
+
+💾 回复缓存
+• px cache - 查看缓存统计
+• px cache on/off - 常见问题精确缓存
+• px cache set <有效期秒> <最多条数> <最近消息数>
+• px cache semantic on/off - 相似问题语义缓存
+• px cache semantic set <相似度0-1> <每会话条数>
+• px cache clear - 清空缓存
+
+📒 长期记忆
+• px memory - 查看记忆统计
+• px memory on/off - 用户长期记忆
+• px memory set <条数> <Token预算> <每N条提取>
+• px memory list/clear <QQ号> - 查看/清除用户记忆
+
+💰 用量统计
+• px usage [1h/today/24h/7d/30d] [scope/provider/model/stage] - 用量排行
+• px usage quota - 查看群聊每日配额
+• px usage quota <群号> <每日Token> - 设置配额，0为取消
+• px usage quota action <downgrade/skip> - 超出配额时的处理
 
 使用 'px <命令>' 查看详细用法
         """.strip()
@@ -119,14 +208,19 @@ async def handle_ai_config(event: MessageEvent, args: Message = CommandArg()):
         if not configs:
             await ai_cmd.finish("当前没有AI配置")
         
+        stage_lines = "\n".join(
+            f"{label}({stage}): {chat_manager.get_stage_ai_config(stage).get('name', '无')}" for stage, label in AI_STAGES.items()
+        )
         messages = []
         messages.append(await create_text_node("AI配置", get_bot().self_id, 
-                     f"AI配置管理\n\n当前使用: {current_config.get('name', '无')}\n共 {len(configs)} 个配置"))
+                     f"AI配置管理\n\n当前使用: {current_config.get('name', '无')}\n共 {len(configs)} 个配置\n\n各阶段模型:\n{stage_lines}"))
         
         for i, config in enumerate(configs):
             is_current = " ✅" if config.get("name") == current_config.get("name") else ""
             safe_key = config['api_key'][:6] + '***' if len(config['api_key']) > 6 else '***'
             content = f"{config['name']}{is_current}\n接口: {config['api_url']}\n模型: {config['model']}\n密钥: {safe_key}"
+            if config.get("rpm") or config.get("tpm"):
+                content += f"\n限额: {config.get('rpm') or '不限'} 次/分钟, {config.get('tpm') or '不限'} Token/分钟"
             messages.append(await create_text_node("配置详情", get_bot().self_id, content))
         
         await send_forward_message(user_id=event.user_id, group_id=getattr(event, "group_id", None), messages=messages)
@@ -164,8 +258,167 @@ async def handle_ai_config(event: MessageEvent, args: Message = CommandArg()):
             await ai_cmd.finish(f"✅ 已切换到配置: {name}")
         else:
             await ai_cmd.finish(f"⚠️ 未找到配置: {name}")
+    elif action == "stage":
+        if len(parts) == 1:
+            overrides = chat_manager.get_stage_ai_config_names()
+            content = "各阶段模型（未指定时使用当前聊天配置）\n"
+            for stage, label in AI_STAGES.items():
+                config = chat_manager.get_stage_ai_config(stage)
+                source = "" if stage in overrides else " (默认)"
+                content += f"{label}({stage}): {config.get('name', '无')}{source}\n"
+            await ai_cmd.finish(content.strip())
+        if len(parts) < 3 or parts[1] not in AI_STAGES:
+            await ai_cmd.finish("用法: px ai stage <judge/tool/summary/reply> <名称/default>")
+        stage, name = parts[1], parts[2]
+        if name == "default":
+            chat_manager.set_stage_ai_config(stage, None)
+            await ai_cmd.finish(f"✅ {AI_STAGES[stage]}阶段已恢复使用当前聊天配置")
+        elif chat_manager.set_stage_ai_config(stage, name):
+            await ai_cmd.finish(f"✅ {AI_STAGES[stage]}阶段已使用配置: {name}")
+        else:
+            await ai_cmd.finish(f"⚠️ 未找到配置: {name}")
+    elif action == "route":
+        routing = chat_manager.get_provider_routing()
+        if len(parts) == 1:
+            status = "✅开启" if routing["enabled"] else "❌关闭"
+            pool = ", ".join(routing["pool"]) or "无"
+            await ai_cmd.finish(
+                f"多服务商路由: {status}\n候选池: {pool}\n"
+                f"调用超时: {routing['timeout']}秒\n连续失败{routing['failure_threshold']}次后暂停{routing['cooldown']}秒\n\n"
+                "用法:\n• px ai route on/off\n• px ai route pool <名称...>\n• px ai route timeout <秒>"
+            )
+        sub = parts[1]
+        if sub in ("on", "off"):
+            enabled = sub == "on"
+            if chat_manager.update_provider_routing(enabled=enabled):
+                await ai_cmd.finish(f"✅ 已{'开启' if enabled else '关闭'}多服务商路由")
+            await ai_cmd.finish(f"⚠️ 多服务商路由已是{'开启' if enabled else '关闭'}状态")
+        elif sub == "pool" and len(parts) >= 3:
+            names = {c.get("name") for c in chat_manager.get_ai_configs()}
+            missing = [name for name in parts[2:] if name not in names]
+            if missing:
+                await ai_cmd.finish(f"⚠️ 未找到配置: {', '.join(missing)}")
+            chat_manager.update_provider_routing(pool=parts[2:])
+            await ai_cmd.finish(f"✅ 候选池已设置为: {', '.join(parts[2:])}")
+        elif sub == "timeout" and len(parts) >= 3:
+            try:
+                timeout = float(parts[2])
+            except ValueError:
+                await ai_cmd.finish("⚠️ 超时时间必须是数字")
+            if timeout <= 0:
+                await ai_cmd.finish("⚠️ 超时时间必须大于0")
+            chat_manager.update_provider_routing(timeout=timeout)
+            await ai_cmd.finish(f"✅ 调用超时已设置为 {timeout} 秒")
+        else:
+            await ai_cmd.finish("用法:\n• px ai route on/off\n• px ai route pool <名称...>\n• px ai route timeout <秒>")
+    elif action == "hedge":
+        hedging = chat_manager.get_request_hedging()
+        if len(parts) == 1:
+            status = "✅开启" if hedging["enabled"] else "❌关闭"
+            await ai_cmd.finish(
+                f"对冲请求: {status}\n"
+                f"首选配置超过最近延迟P{hedging['percentile'] * 100:.0f}（至少{hedging['min_delay']}秒）未返回时，向候选池下一个配置发出相同请求\n"
+                f"对冲比例上限: {hedging['max_ratio']:.0%}\n\n"
+                "用法:\n• px ai hedge on/off\n• px ai hedge set <分位数0-1> <比例上限0-1>"
+            )
+        sub = parts[1]
+        if sub in ("on", "off"):
+            enabled = sub == "on"
+            if chat_manager.update_request_hedging(enabled=enabled):
+                await ai_cmd.finish(f"✅ 已{'开启' if enabled else '关闭'}对冲请求（需开启多服务商路由并设置候选池）")
+            await ai_cmd.finish(f"⚠️ 对冲请求已是{'开启' if enabled else '关闭'}状态")
+        elif sub == "set" and len(parts) >= 4:
+            try:
+                percentile, max_ratio = float(parts[2]), float(parts[3])
+            except ValueError:
+                await ai_cmd.finish("⚠️ 参数必须是数字")
+            if not (0 < percentile < 1 and 0 <= max_ratio <= 1):
+                await ai_cmd.finish("⚠️ 分位数需在0-1之间，比例上限需在0-1之间")
+            chat_manager.update_request_hedging(percentile=percentile, max_ratio=max_ratio)
+            await ai_cmd.finish(f"✅ 对冲阈值已设置为P{percentile * 100:.0f}，比例上限 {max_ratio:.0%}")
+        else:
+            await ai_cmd.finish("用法:\n• px ai hedge on/off\n• px ai hedge set <分位数0-1> <比例上限0-1>")
+    elif action == "limit":
+        if len(parts) < 4:
+            await ai_cmd.finish("用法: px ai limit <名称> <每分钟请求数> <每分钟Token数>\n0表示不限")
+        try:
+            rpm, tpm = int(parts[2]), int(parts[3])
+        except ValueError:
+            await ai_cmd.finish("⚠️ 限额必须是整数")
+        if rpm < 0 or tpm < 0:
+            await ai_cmd.finish("⚠️ 限额不能为负数")
+        if chat_manager.set_ai_config_limits(parts[1], rpm, tpm):
+            await ai_cmd.finish(f"✅ 配置 {parts[1]} 限额已设置为 {rpm or '不限'} 次/分钟, {tpm or '不限'} Token/分钟")
+        await ai_cmd.finish(f"⚠️ 未找到配置: {parts[1]}")
+    elif action == "window":
+        if len(parts) < 3:
+            await ai_cmd.finish(f"用法: px ai window <名称> <上下文窗口Token> [回复预留Token]\n未设置时按窗口{DEFAULT_CONTEXT_WINDOW}、预留{DEFAULT_COMPLETION_BUDGET}预检")
+        try:
+            context_window = int(parts[2])
+            completion_reserve = int(parts[3]) if len(parts) >= 4 else DEFAULT_COMPLETION_BUDGET
+        except ValueError:
+            await ai_cmd.finish("⚠️ Token数必须是整数")
+        if completion_reserve < 1 or context_window <= completion_reserve:
+            await ai_cmd.finish("⚠️ 上下文窗口必须大于回复预留")
+        if chat_manager.set_ai_config_window(parts[1], context_window, completion_reserve):
+            await ai_cmd.finish(f"✅ 配置 {parts[1]} 上下文窗口已设置为 {context_window} Token, 回复预留 {completion_reserve} Token")
+        await ai_cmd.finish(f"⚠️ 未找到配置: {parts[1]}")
+    elif action == "price":
+        if len(parts) < 4:
+            await ai_cmd.finish("用法: px ai price <名称> <输入价> <输出价> [缓存输入价]\n价格为每百万Token的价格，缓存输入价不填时按输入价计")
+        try:
+            prompt, completion = float(parts[2]), float(parts[3])
+            cached = float(parts[4]) if len(parts) >= 5 else None
+        except ValueError:
+            await ai_cmd.finish("⚠️ 价格必须是数字")
+        if min(prompt, completion, cached if cached is not None else 0) < 0:
+            await ai_cmd.finish("⚠️ 价格不能为负数")
+        if chat_manager.set_ai_config_prices(parts[1], prompt, completion, cached):
+            cached_text = f", 缓存输入 {cached}" if cached is not None else ""
+            await ai_cmd.finish(f"✅ 配置 {parts[1]} 价格已设置为 输入 {prompt}, 输出 {completion}{cached_text} (每百万Token)")
+        await ai_cmd.finish(f"⚠️ 未找到配置: {parts[1]}")
+    elif action == "format":
+        if len(parts) == 1:
+            current = chat_manager.get_reply_wire_format()
+            await ai_cmd.finish(
+                f"回复格式: {REPLY_FORMATS[current]}({current})\n"
+                "• json - JSON信封，开启服务商的JSON模式\n"
+                f"• delimited - 纯文本，段与段之间用单独一行的 {SEGMENT_DELIMITER} 分隔，输出更短，不依赖JSON模式"
+            )
+        if parts[1] not in REPLY_FORMATS:
+            await ai_cmd.finish("用法: px ai format <json/delimited>")
+        if chat_manager.set_reply_wire_format(parts[1]):
+            await ai_cmd.finish(f"✅ 回复格式已切换为 {REPLY_FORMATS[parts[1]]}")
+        await ai_cmd.finish(f"回复格式已经是 {REPLY_FORMATS[parts[1]]}")
+    elif action == "queue":
+        admission = chat_manager.get_admission_control()
+        if len(parts) == 1:
+            status = "✅开启" if admission["enabled"] else "❌关闭"
+            await ai_cmd.finish(
+                f"调用准入控制: {status}\n"
+                f"每个配置并发上限: {admission['max_concurrency']}, 排队上限: {admission['max_queue']}\n"
+                "优先级: 私聊/@ > 工具调用 > 群聊判断 > 图片识别，排队满时先丢弃低优先级\n\n"
+                "用法:\n• px ai queue on/off\n• px ai queue set <并发上限> <排队上限>"
+            )
+        sub = parts[1]
+        if sub in ("on", "off"):
+            enabled = sub == "on"
+            if chat_manager.update_admission_control(enabled=enabled):
+                await ai_cmd.finish(f"✅ 已{'开启' if enabled else '关闭'}调用准入控制")
+            await ai_cmd.finish(f"⚠️ 调用准入控制已是{'开启' if enabled else '关闭'}状态")
+        elif sub == "set" and len(parts) >= 4:
+            try:
+                max_concurrency, max_queue = int(parts[2]), int(parts[3])
+            except ValueError:
+                await ai_cmd.finish("⚠️ 参数必须是整数")
+            if max_concurrency < 1 or max_queue < 0:
+                await ai_cmd.finish("⚠️ 并发上限至少为1，排队上限不能为负数")
+            chat_manager.update_admission_control(max_concurrency=max_concurrency, max_queue=max_queue)
+            await ai_cmd.finish(f"✅ 并发上限已设置为 {max_concurrency}，排队上限 {max_queue}")
+        else:
+            await ai_cmd.finish("用法:\n• px ai queue on/off\n• px ai queue set <并发上限> <排队上限>")
     else:
-        await ai_cmd.finish("用法:\n• px ai - 查看配置\n• px ai add <名称> <key> <url> <模型>\n• px ai del <名称>\n• px ai switch <名称>")
+        await ai_cmd.finish("用法:\n• px ai - 查看配置\n• px ai add <名称> <key> <url> <模型>\n• px ai del <名称>\n• px ai switch <名称>\n• px ai stage <阶段> <名称/default>\n• px ai route - 多服务商路由\n• px ai hedge - 对冲请求\n• px ai queue - 调用准入控制\n• px ai limit <名称> <rpm> <tpm>\n• px ai window <名称> <窗口Token> [回复预留]\n• px ai price <名称> <输入价> <输出价> [缓存输入价]\n• px ai format <json/delimited>")
 
 
 @switch_cmd.handle()
@@ -313,6 +566,8 @@ async def handle_status(event: MessageEvent):
     current_config = chat_manager.get_current_ai_config()
     current_image_config = chat_manager.get_current_image_recognition_config()
     status_info.append(f"🔧 聊天配置: {current_config.get('name', '无')}")
+    for stage, name in chat_manager.get_stage_ai_config_names().items():
+        status_info.append(f"  {AI_STAGES.get(stage, stage)}阶段: {name}")
     status_info.append(f"🖼️ 图片配置: {current_image_config.get('name', '无')}")
     
     # 如果有MCP工具缓存，显示工具数量
@@ -325,6 +580,116 @@ async def handle_status(event: MessageEvent):
                 status_info.append("🛠️ MCP工具: 无可用工具")
     except Exception:
         status_info.append("🛠️ MCP工具: 获取失败")
+    status_info.append("")
+
+    # 出站消息队列
+    dispatch_stats = outbound_dispatcher.get_stats()
+    status_info.append("📤 出站消息队列")
+    status_info.append(f"排队回复: {dispatch_stats['queued']}条 (发送中会话: {dispatch_stats['active_chats']}个)")
+    status_info.append(f"已送达: {dispatch_stats['delivered']}/{dispatch_stats['enqueued']}条回复, {dispatch_stats['segments']}段")
+    status_info.append(f"发送失败: {dispatch_stats['failed']}段")
+    status_info.append(f"首段延迟: 平均{dispatch_stats['first_latency_avg']:.2f}s, P95 {dispatch_stats['first_latency_p95']:.2f}s")
+    status_info.append(f"完整送达: 平均{dispatch_stats['full_latency_avg']:.2f}s, P95 {dispatch_stats['full_latency_p95']:.2f}s")
+    status_info.append("")
+
+    # 出站限流
+    limit_stats = outbound_limiter.get_stats()
+    status_info.append("🚦 出站限流")
+    status_info.append(f"放行调用: {limit_stats['granted']}次, 排队中: {limit_stats['waiting']}个")
+    status_info.append(f"被限流: {limit_stats['throttled']}次, 平均延迟{limit_stats['delay_avg']:.2f}s, 最长{limit_stats['delay_max']:.2f}s")
+    if limit_stats["top_throttled"]:
+        top_text = ", ".join(f"{key}({count})" for key, count in limit_stats["top_throttled"])
+        status_info.append(f"  限流最多: {top_text}")
+
+    status_info.append("")
+
+    # 服务商健康状态
+    route_stats = provider_router.get_stats()
+    routing = chat_manager.get_provider_routing()
+    status_info.append(f"🧭 服务商路由: {'✅开启' if routing['enabled'] else '❌关闭'}")
+    status_info.append(f"调用: {route_stats['requests']}次, 故障切换: {route_stats['failovers']}次, 改道: {route_stats['rerouted']}次")
+    if chat_manager.get_request_hedging()["enabled"]:
+        status_info.append(f"对冲请求: {route_stats['hedged']}次, 其中对冲先返回: {route_stats['hedge_wins']}次")
+    for name, provider in route_stats["providers"].items():
+        ewma = f"{provider['ewma']:.2f}s" if provider["ewma"] is not None else "-"
+        p95 = f"{provider['p95']:.2f}s" if provider["p95"] is not None else "-"
+        state = f", 暂停中({provider['cooldown']:.0f}s)" if provider["cooldown"] > 0 else ""
+        status_info.append(f"  {name}: {provider['requests']}次, 错误率{provider['error_rate']:.0%}, 延迟{ewma}, P95 {p95}{state}")
+    for name, limited in provider_limiter.get_stats().items():
+        blocked = f", 暂停中({limited['blocked']:.0f}s)" if limited["blocked"] > 0 else ""
+        status_info.append(
+            f"  {name}限流: 排队{limited['throttled']}次(平均{limited['delay_avg']:.2f}s), "
+            f"429 {limited['rate_limited']}次, 重试{limited['retries']}次{blocked}"
+        )
+
+    # 错误处理
+    errors = error_tracker.get_stats()
+    status_info.append("")
+    status_info.append("🩹 错误处理")
+    status_info.append(f"临时错误重试: {errors['retries']}次, 重试后成功: {errors['recovered']}次")
+    status_info.append(f"回复修复: {errors['repaired']}次, 重新生成: {errors['regenerated']}次")
+    status_info.append(f"清除上下文: {errors['cleared']}次(约{errors['cleared_tokens']} Token), 保留上下文: {errors['kept']}次")
+    status_info.append(f"管理员告警: {errors['alerts']}次, 合并的重复告警: {errors['suppressed']}次")
+    if errors["trimmed"]:
+        status_info.append(f"发送前预检裁剪: {errors['trimmed']}次(约{errors['trimmed_tokens']} Token)")
+    if errors["errors"]:
+        status_info.append("  " + ", ".join(f"{ERROR_LABELS.get(kind, kind)}({count})" for kind, count in errors["errors"].items()))
+
+    # 回复缓存
+    if chat_manager.get_response_cache()["enabled"] or chat_manager.get_semantic_cache()["enabled"]:
+        status_info.append("")
+    if chat_manager.get_response_cache()["enabled"]:
+        cache_stats = response_cache.get_stats()
+        status_info.append(f"💾 回复缓存: {cache_stats['entries']}条, 命中率{cache_stats['hit_rate']:.1%}, 节省Token: {cache_stats['saved_tokens']}")
+    if chat_manager.get_semantic_cache()["enabled"]:
+        semantic_stats = semantic_cache.get_stats()
+        status_info.append(f"🧠 语义缓存: {semantic_stats['entries']}条, 命中率{semantic_stats['hit_rate']:.1%}, 节省Token: {semantic_stats['saved_tokens']}")
+
+    # 上下文压缩
+    compaction_stats = get_compaction_stats()
+    if compaction_stats:
+        removed_bytes = sum(stats["bytes"] for stats in compaction_stats.values())
+        removed_tokens = sum(stats["tokens"] for stats in compaction_stats.values())
+        status_info.append("")
+        status_info.append(f"🗜️ 上下文压缩: {len(compaction_stats)}个会话, 减少{removed_bytes}字节(约{removed_tokens} Token)")
+
+    # 长期记忆
+    if chat_manager.get_long_term_memory()["enabled"]:
+        memory_stats = memory_store.get_stats()
+        status_info.append("")
+        status_info.append(f"📒 长期记忆: {memory_stats['memories']}条 ({memory_stats['users']}位用户), 注入: {memory_stats['recalled']}条(约{memory_stats['injected_tokens']} Token)")
+
+    # 服务商前缀缓存
+    prefix_stats = get_prefix_cache_stats()
+    prompt_total = sum(stats["prompt_tokens"] for stats in prefix_stats.values())
+    if prompt_total:
+        cached_total = sum(stats["cached_tokens"] for stats in prefix_stats.values())
+        status_info.append("")
+        status_info.append(f"📌 前缀缓存: 命中{cached_total}/{prompt_total} 提示Token ({cached_total / prompt_total:.1%})")
+        for label, stats in prefix_stats.items():
+            if stats["prompt_tokens"]:
+                status_info.append(f"  {label}: {stats['calls']}次, 命中率{stats['cached_tokens'] / stats['prompt_tokens']:.1%}")
+
+    # Token用量
+    today = usage_ledger.summary("today")
+    if today["calls"]:
+        status_info.append("")
+        status_info.append(
+            f"💰 今日用量: {today['calls']}次调用, {today['prompt_tokens'] + today['completion_tokens']} Token, 费用约{today['cost']:.4f}"
+        )
+
+    # 调用准入控制
+    if chat_manager.get_admission_control()["enabled"]:
+        admission_stats = admission_scheduler.get_stats()
+        active = ", ".join(f"{name}({count})" for name, count in admission_stats["active"].items()) or "无"
+        status_info.append("")
+        status_info.append("🎫 调用准入控制")
+        status_info.append(f"进行中: {active}, 排队: {admission_stats['depth']}个 (峰值{admission_stats['peak_depth']})")
+        for label, stats in admission_stats["classes"].items():
+            status_info.append(
+                f"  {label}: 放行{stats['admitted']}次, 丢弃{stats['shed']}次, 排队{stats['waiting']}个, "
+                f"等待平均{stats['wait_avg']:.2f}s, P95 {stats['wait_p95']:.2f}s"
+            )
 
     content = "\n".join(status_info)
     await send_long_message("系统完整状态", content, user_id=event.user_id, group_id=getattr(event, "group_id", None))
@@ -483,4 +848,579 @@ async def handle_mcp(event: MessageEvent, args: Message = CommandArg()):
         except Exception as e:
             await mcp_cmd.finish(f"❌ 获取工具列表失败")
     else:
-        await mcp_cmd.finish("用法:\n• px mcp on/off\n• px mcp server <服务器名> on/off\n• px mcp refresh - 刷新缓存\n• px mcp tools - 查看工具")
\ No newline at end of file
+        await mcp_cmd.finish("用法:\n• px mcp on/off\n• px mcp server <服务器名> on/off\n• px mcp refresh - 刷新缓存\n• px mcp tools - 查看工具")
+
+@limit_cmd.handle()
+async def handle_limit(event: MessageEvent, args: Message = CommandArg()):
+    if not await check_super_user(event):
+        await limit_cmd.finish("你没有权限")
+    
+    arg_text = args.extract_plain_text().strip()
+    usage = "用法:\n• px limit global <每秒条数> <突发上限>\n• px limit group <每秒条数> <突发上限>\n• px limit weight <群号> <权重>"
+    
+    if not arg_text:
+        limit = chat_manager.get_outbound_rate_limit()
+        content = "🚦 出站限流配置\n"
+        content += f"全局: {limit['global_rate']}条/秒, 突发{limit['global_burst']}条\n"
+        content += f"单会话: {limit['group_rate']}条/秒, 突发{limit['group_burst']}条\n\n"
+        content += usage
+        await limit_cmd.finish(content)
+    
+    parts = arg_text.split()
+    
+    if parts[0] in ("global", "group") and len(parts) >= 3:
+        try:
+            rate, burst = float(parts[1]), int(parts[2])
+        except ValueError:
+            await limit_cmd.finish("速率必须是数字，突发上限必须是整数")
+        if chat_manager.set_outbound_rate_limit(parts[0], rate, burst):
+            scope = "全局" if parts[0] == "global" else "单会话"
+            await limit_cmd.finish(f"✅ 已设置{scope}限流: {rate}条/秒, 突发{burst}条")
+        else:
+            await limit_cmd.finish("速率必须大于0，突发上限至少为1")
+    elif parts[0] == "weight" and len(parts) >= 3:
+        try:
+            weight = float(parts[2])
+        except ValueError:
+            await limit_cmd.finish("权重必须是一个数字")
+        if weight <= 0:
+            await limit_cmd.finish("权重必须大于0")
+        if chat_manager.set_group_send_weight(parts[1], weight):
+            await limit_cmd.finish(f"✅ 已设置群聊 {parts[1]} 发送权重为: {weight}")
+        else:
+            await limit_cmd.finish("⚠️ 权重未更改")
+    else:
+        await limit_cmd.finish(usage)
+
+
+
+@debounce_cmd.handle()
+async def handle_debounce(event: MessageEvent, args: Message = CommandArg()):
+    if not await check_super_user(event):
+        await debounce_cmd.finish("你没有权限")
+    
+    arg_text = args.extract_plain_text().strip()
+    usage = "用法:\n• px debounce on/off\n• px debounce set <基础窗口秒> [最短秒] [最长秒]"
+    
+    if not arg_text:
+        status = "✅开启" if chat_manager.is_private_debounce_enabled() else "❌关闭"
+        window = chat_manager.get_private_debounce_window()
+        stats = private_debouncer.get_stats()
+        content = f"私聊连发合并: {status}\n"
+        content += f"等待窗口: 基础{window['base']}s, 自适应范围 {window['min']}s ~ {window['max']}s\n"
+        content += f"已处理消息: {stats['messages']}条, 合并掉: {stats['merged']}条\n\n"
+        content += usage
+        await debounce_cmd.finish(content)
+    
+    parts = arg_text.split()
+    
+    if parts[0] == "on":
+        if chat_manager.set_private_debounce_enabled(True):
+            await debounce_cmd.finish("✅ 已开启私聊连发合并")
+        else:
+            await debounce_cmd.finish("⚠️ 私聊连发合并已是开启状态")
+    elif parts[0] == "off":
+        if chat_manager.set_private_debounce_enabled(False):
+            await debounce_cmd.finish("✅ 已关闭私聊连发合并")
+        else:
+            await debounce_cmd.finish("⚠️ 私聊连发合并已是关闭状态")
+    elif parts[0] == "set" and len(parts) >= 2:
+        try:
+            values = [float(value) for value in parts[1:4]]
+        except ValueError:
+            await debounce_cmd.finish("窗口时间必须是数字")
+        if chat_manager.set_private_debounce_window(*values):
+            window = chat_manager.get_private_debounce_window()
+            await debounce_cmd.finish(f"✅ 已设置等待窗口: 基础{window['base']}s, 范围 {window['min']}s ~ {window['max']}s")
+        else:
+            await debounce_cmd.finish("窗口需满足 0 < 最短 <= 基础 <= 最长")
+    else:
+        await debounce_cmd.finish(usage)
+
+
+
+@judge_cmd.handle()
+async def handle_judge(event: MessageEvent, args: Message = CommandArg()):
+    if not await check_super_user(event):
+        await judge_cmd.finish("你没有权限")
+    
+    arg_text = args.extract_plain_text().strip()
+    usage = (
+        "用法:\n• px judge window on/off\n• px judge window <窗口秒> <最多条数> <每群每分钟判断上限>"
+        "\n• px judge filter on/off\n• px judge filter add/del yes/no <正则>\n• px judge filter name <名字...>\n• px judge filter question on/off"
+        "\n• px judge model [train]\n• px judge model mode off/gate/replace\n• px judge model threshold <0.5-1.0>"
+        "\n• px judge speculate on/off\n• px judge speculate rate <0.0-1.0> <最少判断次数>"
+        "\n• px judge flow two_step/fused\n• px judge bench <群号> [轮数]"
+        "\n• px judge batch on/off\n• px judge batch set <等待秒> <最多群数>"
+    )
+    
+    if not arg_text:
+        window = chat_manager.get_group_judge_window()
+        stats = windowed_judge.get_stats()
+        content = "🧠 群聊回复判断\n"
+        flow_names = {"two_step": "先判断再回复", "fused": "回复时同时判断"}
+        content += f"判断流程: {flow_names[chat_manager.get_group_judge_mode()]}\n"
+        content += f"合并窗口: {'✅开启' if chat_manager.is_group_judge_window_enabled() else '❌关闭'} ({window['interval']}s 或 {window['max_messages']}条, 每群每分钟最多判断{window['max_per_minute']}次)\n"
+        content += f"进入窗口消息: {stats['messages']}条, 关闭窗口: {stats['windows']}个\n"
+        content += f"实际判断: {stats['judgments']}次, 超频跳过: {stats['capped']}次\n\n"
+        rules = chat_manager.get_group_prefilter()
+        filter_stats = group_prefilter.get_stats()
+        content += f"前置过滤: {'✅开启' if rules['enabled'] else '❌关闭'}\n"
+        content += f"直接判定: {filter_stats['short_circuited']}次 (YES {filter_stats['yes']}, NO {filter_stats['no']}), 交给AI: {filter_stats['passed']}次\n"
+        for label, count in filter_stats["hits"].items():
+            content += f"  {label}: {count}\n"
+        content += f"机器人名字: {', '.join(rules['bot_names']) or '无'}\n"
+        content += f"最短长度: {rules['min_length']}, 回复冷却: {rules['cooldown']}s, 提问直接回复: {'是' if rules['question_yes'] else '否'}\n"
+        content += f"YES规则: {rules['yes_patterns']}\nNO规则: {rules['no_patterns']}\n\n"
+        speculative = chat_manager.get_speculative_reply()
+        spec_stats = speculative_replier.get_stats()
+        content += f"推测式回复: {'✅开启' if speculative['enabled'] else '❌关闭'} (回复比例≥{speculative['min_reply_rate']:.0%}, 至少{speculative['min_samples']}次判断)\n"
+        content += f"推测生成: {spec_stats['speculated']}次, 采用: {spec_stats['used']}次, 取消: {spec_stats['cancelled']}次, 丢弃: {spec_stats['discarded']}次\n"
+        content += f"采用Token: {spec_stats['used_tokens']}, 浪费Token: {spec_stats['wasted_tokens']}, 节省时间: {spec_stats['saved_seconds']:.1f}s\n\n"
+        content += f"合并判断调用: {spec_stats['fused_calls']}次, 选择不发言: {spec_stats['fused_silent']}次\n\n"
+        batch = chat_manager.get_group_judge_batch()
+        batch_stats = judgment_batcher.get_stats()
+        content += f"跨群批量判断: {'✅开启' if batch['enabled'] else '❌关闭'} (等待{batch['window']}s, 最多{batch['max_groups']}个群)\n"
+        content += f"判断请求: {batch_stats['requests']}次, 批量请求: {batch_stats['batches']}次, 批量得出: {batch_stats['batched']}次, 回退单独判断: {batch_stats['fallbacks']}次\n\n"
+        content += usage
+        await send_long_message("群聊判断", content, user_id=event.user_id, group_id=getattr(event, "group_id", None))
+        return
+    
+    parts = arg_text.split()
+    
+    if parts[0] == "window" and len(parts) == 2 and parts[1] in ("on", "off"):
+        if chat_manager.set_group_judge_window_enabled(parts[1] == "on"):
+            await judge_cmd.finish(f"✅ 已{'开启' if parts[1] == 'on' else '关闭'}判断合并窗口")
+        else:
+            await judge_cmd.finish("⚠️ 判断合并窗口状态未更改")
+    elif parts[0] == "window" and len(parts) >= 4:
+        try:
+            interval, max_messages, max_per_minute = float(parts[1]), int(parts[2]), int(parts[3])
+        except ValueError:
+            await judge_cmd.finish("窗口秒数必须是数字，条数和上限必须是整数")
+        if chat_manager.set_group_judge_window(interval, max_messages, max_per_minute):
+            await judge_cmd.finish(f"✅ 已设置判断窗口: {interval}s 或 {max_messages}条, 每分钟最多{max_per_minute}次")
+        else:
+            await judge_cmd.finish("窗口秒数不能为负，条数和上限至少为1")
+    elif parts[0] == "filter" and len(parts) >= 2:
+        action = parts[1]
+        rules = chat_manager.get_group_prefilter()
+        if action in ("on", "off"):
+            if chat_manager.update_group_prefilter(enabled=action == "on"):
+                await judge_cmd.finish(f"✅ 已{'开启' if action == 'on' else '关闭'}前置过滤")
+            else:
+                await judge_cmd.finish("⚠️ 前置过滤状态未更改")
+        elif action == "question" and len(parts) >= 3 and parts[2] in ("on", "off"):
+            if chat_manager.update_group_prefilter(question_yes=parts[2] == "on"):
+                await judge_cmd.finish(f"✅ 已{'开启' if parts[2] == 'on' else '关闭'}提问直接回复")
+            else:
+                await judge_cmd.finish("⚠️ 提问直接回复状态未更改")
+        elif action == "name" and len(parts) >= 3:
+            chat_manager.update_group_prefilter(bot_names=parts[2:])
+            await judge_cmd.finish(f"✅ 已设置机器人名字: {', '.join(parts[2:])}")
+        elif action in ("add", "del") and len(parts) >= 4 and parts[2] in ("yes", "no"):
+            field = f"{parts[2]}_patterns"
+            pattern = " ".join(parts[3:])
+            patterns = list(rules[field])
+            if action == "add":
+                if pattern in patterns:
+                    await judge_cmd.finish("⚠️ 规则已存在")
+                try:
+                    re.compile(pattern)
+                except re.error as e:
+                    await judge_cmd.finish(f"正则无效: {e}")
+                patterns.append(pattern)
+            else:
+                if pattern not in patterns:
+                    await judge_cmd.finish("⚠️ 未找到该规则")
+                patterns.remove(pattern)
+            chat_manager.update_group_prefilter(**{field: patterns})
+            await judge_cmd.finish(f"✅ 已{'添加' if action == 'add' else '删除'}{parts[2].upper()}规则: {pattern}")
+        else:
+            await judge_cmd.finish(usage)
+    elif parts[0] == "speculate" and len(parts) >= 2:
+        action = parts[1]
+        if action in ("on", "off"):
+            if chat_manager.update_speculative_reply(enabled=action == "on"):
+                await judge_cmd.finish(f"✅ 已{'开启' if action == 'on' else '关闭'}推测式回复")
+            else:
+                await judge_cmd.finish("⚠️ 推测式回复状态未更改")
+        elif action == "rate" and len(parts) >= 4:
+            try:
+                min_reply_rate, min_samples = float(parts[2]), int(parts[3])
+            except ValueError:
+                await judge_cmd.finish("回复比例必须是数字，判断次数必须是整数")
+            if not 0 <= min_reply_rate <= 1 or min_samples < 1:
+                await judge_cmd.finish("回复比例必须在 0.0 到 1.0 之间，判断次数至少为1")
+            chat_manager.update_speculative_reply(min_reply_rate=min_reply_rate, min_samples=min_samples)
+            await judge_cmd.finish(f"✅ 回复比例≥{min_reply_rate:.0%}且至少{min_samples}次判断的群将推测生成回复")
+        else:
+            await judge_cmd.finish(usage)
+    elif parts[0] == "batch" and len(parts) >= 2:
+        action = parts[1]
+        if action in ("on", "off"):
+            if chat_manager.update_group_judge_batch(enabled=action == "on"):
+                await judge_cmd.finish(f"✅ 已{'开启' if action == 'on' else '关闭'}跨群批量判断")
+            else:
+                await judge_cmd.finish("⚠️ 跨群批量判断状态未更改")
+        elif action == "set" and len(parts) >= 4:
+            try:
+                window, max_groups = float(parts[2]), int(parts[3])
+            except ValueError:
+                await judge_cmd.finish("等待时间必须是数字，群数必须是整数")
+            if window < 0 or max_groups < 2:
+                await judge_cmd.finish("等待时间不能为负，群数至少为2")
+            chat_manager.update_group_judge_batch(window=window, max_groups=max_groups)
+            await judge_cmd.finish(f"✅ 已设置批量判断: 等待{window}s, 最多{max_groups}个群")
+        else:
+            await judge_cmd.finish(usage)
+    elif parts[0] == "flow" and len(parts) >= 2:
+        if parts[1] not in ("two_step", "fused"):
+            await judge_cmd.finish("判断流程只能是 two_step/fused")
+        if chat_manager.set_group_judge_mode(parts[1]):
+            await judge_cmd.finish(f"✅ 已切换判断流程: {parts[1]}")
+        else:
+            await judge_cmd.finish("⚠️ 判断流程未更改")
+    elif parts[0] == "bench" and len(parts) >= 2:
+        messages = get_context(f"group_{parts[1]}")
+        if not messages:
+            await judge_cmd.finish(f"⚠️ 群聊 {parts[1]} 没有上下文记录")
+        try:
+            rounds = int(parts[2]) if len(parts) >= 3 else 3
+        except ValueError:
+            await judge_cmd.finish("轮数必须是整数")
+        rounds = max(1, min(rounds, 10))
+        await judge_cmd.send(f"⏳ 开始对比判断流程，每种流程 {rounds} 轮...")
+        try:
+            report = await benchmark_judge_flows(messages, rounds)
+        except Exception as e:
+            await judge_cmd.finish(f"❌ 对比失败: {e}")
+        content = f"⚖️ 判断流程对比（群 {parts[1]}，每轮平均）\n"
+        for name, label in (("two_step", "先判断再回复"), ("fused", "回复时同时判断")):
+            result = report[name]
+            content += f"\n{label}\n调用: {result['calls']:.1f}次, Token: {result['tokens']:.0f}, 耗时: {result['seconds']:.2f}s, 发言率: {result['reply_rate']:.0%}\n"
+        await send_long_message("判断流程对比", content, user_id=event.user_id, group_id=getattr(event, "group_id", None))
+    elif parts[0] == "model":
+        if len(parts) == 1:
+            stats = judgment_classifier.get_stats()
+            report = stats["report"]
+            mode_names = {"off": "关闭(仅收集样本)", "gate": "高置信度代替AI", "replace": "完全代替AI"}
+            content = "🤖 本地判断模型\n"
+            content += f"模式: {mode_names[chat_manager.get_judge_classifier_mode()]}, 置信度阈值: {chat_manager.get_judge_classifier_threshold()}\n"
+            content += f"已收集样本: {judgment_classifier.count_samples()}条, 模型: {'已训练' if stats['has_model'] else '未训练'}\n"
+            content += f"AI判断: {stats['llm_calls']}次, 本地直接判断(节省调用): {stats['saved']}次\n"
+            content += f"运行中与AI一致率: {stats['shadow_agreement']:.1%} ({stats['shadow_agree']}/{stats['shadow_total']})\n"
+            if report:
+                content += f"训练样本: {report['samples']}条, YES占比: {report['positive_rate']:.1%}\n"
+                content += f"留出集一致率: {report['agreement']:.1%}, 高置信覆盖率: {report['coverage']:.1%}, 高置信一致率: {report['confident_agreement']:.1%}"
+            await send_long_message("本地判断模型", content, user_id=event.user_id, group_id=getattr(event, "group_id", None))
+            return
+        action = parts[1]
+        if action == "train":
+            await judge_cmd.send("⏳ 开始训练本地判断模型...")
+            try:
+                report = await judgment_classifier.train()
+            except Exception as e:
+                await judge_cmd.finish(f"❌ 训练失败: {e}")
+            await judge_cmd.finish(
+                f"✅ 训练完成\n样本: {report['samples']}条\n与AI一致率: {report['agreement']:.1%}\n"
+                f"高置信覆盖率: {report['coverage']:.1%} (预计可节省的AI判断比例)\n高置信一致率: {report['confident_agreement']:.1%}"
+            )
+        elif action == "mode" and len(parts) >= 3:
+            if parts[2] not in ("off", "gate", "replace"):
+                await judge_cmd.finish("模式只能是 off/gate/replace")
+            if parts[2] != "off" and not judgment_classifier.has_model():
+                await judge_cmd.finish("⚠️ 还没有训练好的模型，请先使用 px judge model train")
+            if chat_manager.set_judge_classifier_mode(parts[2]):
+                await judge_cmd.finish(f"✅ 已切换本地判断模型模式: {parts[2]}")
+            else:
+                await judge_cmd.finish("⚠️ 模式未更改")
+        elif action == "threshold" and len(parts) >= 3:
+            try:
+                threshold = float(parts[2])
+            except ValueError:
+                await judge_cmd.finish("阈值必须是一个数字")
+            if not 0.5 <= threshold <= 1:
+                await judge_cmd.finish("阈值必须在 0.5 到 1.0 之间")
+            if chat_manager.set_judge_classifier_threshold(threshold):
+                await judge_cmd.finish(f"✅ 已设置置信度阈值为: {threshold}")
+            else:
+                await judge_cmd.finish("⚠️ 阈值未更改")
+        else:
+            await judge_cmd.finish(usage)
+    else:
+        await judge_cmd.finish(usage)
+
+
+@cache_cmd.handle()
+async def handle_cache(event: MessageEvent, args: Message = CommandArg()):
+    if not await check_super_user(event):
+        await cache_cmd.finish("你没有权限")
+    
+    arg_text = args.extract_plain_text().strip()
+    usage = (
+        "用法:\n• px cache on/off\n• px cache set <有效期秒> <最多条数> <最近消息数>\n"
+        "• px cache semantic on/off\n• px cache semantic set <相似度0-1> <每会话条数>\n• px cache clear"
+    )
+    
+    if not arg_text:
+        config = chat_manager.get_response_cache()
+        stats = response_cache.get_stats()
+        status = "✅开启" if config["enabled"] else "❌关闭"
+        content = f"回复精确缓存: {status}\n"
+        content += f"有效期: {config['ttl']:.0f}s, 最多: {config['max_entries']}条, 按最近{config['last_n']}条消息匹配\n"
+        content += f"缓存条目: {stats['entries']}条\n"
+        content += f"查询: {stats['lookups']}次, 命中: {stats['hits']}次 ({stats['hit_rate']:.1%})\n"
+        content += f"跳过(工具/搜索): {stats['bypassed']}次, 节省Token: {stats['saved_tokens']}\n\n"
+        semantic = chat_manager.get_semantic_cache()
+        semantic_stats = semantic_cache.get_stats()
+        content += f"语义缓存: {'✅开启' if semantic['enabled'] else '❌关闭'}\n"
+        content += f"相似度阈值: {semantic['threshold']}, 每会话最多: {semantic['max_entries']}条, 有效期: {semantic['ttl']:.0f}s\n"
+        content += f"缓存问答: {semantic_stats['entries']}条 ({semantic_stats['scopes']}个会话), 淘汰: {semantic_stats['evicted']}条\n"
+        content += f"查询: {semantic_stats['lookups']}次, 命中: {semantic_stats['hits']}次 ({semantic_stats['hit_rate']:.1%}), "
+        content += f"平均相似度: {semantic_stats['similarity_avg']:.2f}, 节省Token: {semantic_stats['saved_tokens']}\n\n"
+        content += usage
+        await cache_cmd.finish(content)
+    
+    parts = arg_text.split()
+    
+    if parts[0] in ("on", "off"):
+        enabled = parts[0] == "on"
+        if chat_manager.update_response_cache(enabled=enabled):
+            await cache_cmd.finish(f"✅ 已{'开启' if enabled else '关闭'}回复缓存")
+        else:
+            await cache_cmd.finish(f"⚠️ 回复缓存已是{'开启' if enabled else '关闭'}状态")
+    elif parts[0] == "set" and len(parts) >= 4:
+        try:
+            ttl, max_entries, last_n = float(parts[1]), int(parts[2]), int(parts[3])
+        except ValueError:
+            await cache_cmd.finish("参数必须是数字")
+        if ttl <= 0 or max_entries < 1 or last_n < 1:
+            await cache_cmd.finish("有效期必须大于0，条数和消息数至少为1")
+        chat_manager.update_response_cache(ttl=ttl, max_entries=max_entries, last_n=last_n)
+        await cache_cmd.finish(f"✅ 已设置缓存: 有效期{ttl:.0f}s, 最多{max_entries}条, 按最近{last_n}条消息匹配")
+    elif parts[0] == "semantic" and len(parts) >= 2:
+        if parts[1] in ("on", "off"):
+            enabled = parts[1] == "on"
+            if chat_manager.update_semantic_cache(enabled=enabled):
+                await cache_cmd.finish(f"✅ 已{'开启' if enabled else '关闭'}语义缓存")
+            else:
+                await cache_cmd.finish(f"⚠️ 语义缓存已是{'开启' if enabled else '关闭'}状态")
+        elif parts[1] == "set" and len(parts) >= 4:
+            try:
+                threshold, max_entries = float(parts[2]), int(parts[3])
+            except ValueError:
+                await cache_cmd.finish("参数必须是数字")
+            if not 0 < threshold <= 1 or max_entries < 1:
+                await cache_cmd.finish("相似度需在0-1之间，条数至少为1")
+            chat_manager.update_semantic_cache(threshold=threshold, max_entries=max_entries)
+            await cache_cmd.finish(f"✅ 已设置语义缓存: 相似度阈值{threshold}, 每会话最多{max_entries}条")
+        else:
+            await cache_cmd.finish(usage)
+    elif parts[0] == "clear":
+        await cache_cmd.finish(f"✅ 已清空 {response_cache.clear()} 条精确缓存, {semantic_cache.clear()} 条语义缓存")
+    else:
+        await cache_cmd.finish(usage)
+
+
+@memory_cmd.handle()
+async def handle_memory(event: MessageEvent, args: Message = CommandArg()):
+    if not await check_super_user(event):
+        await memory_cmd.finish("你没有权限")
+
+    arg_text = args.extract_plain_text().strip()
+    usage = "用法:\n• px memory on/off\n• px memory set <条数> <Token预算> <每N条提取>\n• px memory list <QQ号>\n• px memory clear <QQ号>"
+
+    if not arg_text:
+        config = chat_manager.get_long_term_memory()
+        stats = memory_store.get_stats()
+        status = "✅开启" if config["enabled"] else "❌关闭"
+        content = f"用户长期记忆: {status}\n"
+        content += f"每次最多注入: {config['top_k']}条, Token预算: {config['token_budget']}, 最低相似度: {config['min_similarity']}\n"
+        content += f"每{config['extract_every']}条消息提取一次, 每位用户最多: {config['max_per_user']}条\n"
+        content += f"记忆: {stats['memories']}条 ({stats['users']}位用户)\n"
+        content += f"提取: {stats['extractions']}次 (失败{stats['failures']}次), 新增: {stats['added']}条, 合并: {stats['merged']}条\n"
+        content += f"检索: {stats['recalls']}次, 注入: {stats['recalled']}条, 约{stats['injected_tokens']} Token\n\n"
+        content += usage
+        await memory_cmd.finish(content)
+
+    parts = arg_text.split()
+
+    if parts[0] in ("on", "off"):
+        enabled = parts[0] == "on"
+        if chat_manager.update_long_term_memory(enabled=enabled):
+            await memory_cmd.finish(f"✅ 已{'开启' if enabled else '关闭'}长期记忆")
+        else:
+            await memory_cmd.finish(f"⚠️ 长期记忆已是{'开启' if enabled else '关闭'}状态")
+    elif parts[0] == "set" and len(parts) >= 4:
+        try:
+            top_k, token_budget, extract_every = int(parts[1]), int(parts[2]), int(parts[3])
+        except ValueError:
+            await memory_cmd.finish("参数必须是整数")
+        if top_k < 1 or token_budget < 1 or extract_every < 1:
+            await memory_cmd.finish("参数至少为1")
+        chat_manager.update_long_term_memory(top_k=top_k, token_budget=token_budget, extract_every=extract_every)
+        await memory_cmd.finish(f"✅ 已设置长期记忆: 最多注入{top_k}条, Token预算{token_budget}, 每{extract_every}条消息提取一次")
+    elif parts[0] == "list" and len(parts) >= 2:
+        memories = memory_store.get_memories(parts[1])
+        if not memories:
+            await memory_cmd.finish(f"用户 {parts[1]} 暂无记忆")
+        content = "\n".join(f"{i + 1}. {memory}" for i, memory in enumerate(memories))
+        await send_long_message(f"用户 {parts[1]} 的记忆 ({len(memories)}条)", content, user_id=event.user_id, group_id=getattr(event, "group_id", None))
+    elif parts[0] == "clear" and len(parts) >= 2:
+        await memory_cmd.finish(f"✅ 已清除用户 {parts[1]} 的 {memory_store.clear(parts[1])} 条记忆")
+    else:
+        await memory_cmd.finish(usage)
+
+
+@thread_cmd.handle()
+async def handle_thread(event: MessageEvent, args: Message = CommandArg()):
+    if not await check_super_user(event):
+        await thread_cmd.finish("你没有权限")
+
+    arg_text = args.extract_plain_text().strip()
+    usage = "用法:\n• px thread on/off\n• px thread set <Token预算> <发言条数>"
+
+    if not arg_text:
+        config = chat_manager.get_thread_context()
+        status = "✅开启" if config["enabled"] else "❌关闭"
+        content = f"群聊回复链上下文: {status}\n"
+        content += f"上下文Token预算: {config['token_budget']}, 优先保留发送者和被@用户最近{config['recent_turns']}条发言\n\n"
+        content += usage
+        await thread_cmd.finish(content)
+
+    parts = arg_text.split()
+
+    if parts[0] in ("on", "off"):
+        enabled = parts[0] == "on"
+        if chat_manager.update_thread_context(enabled=enabled):
+            await thread_cmd.finish(f"✅ 已{'开启' if enabled else '关闭'}群聊回复链上下文")
+        else:
+            await thread_cmd.finish(f"⚠️ 群聊回复链上下文已是{'开启' if enabled else '关闭'}状态")
+    elif parts[0] == "set" and len(parts) >= 3:
+        try:
+            token_budget, recent_turns = int(parts[1]), int(parts[2])
+        except ValueError:
+            await thread_cmd.finish("参数必须是整数")
+        if token_budget < 100 or recent_turns < 0:
+            await thread_cmd.finish("Token预算至少为100，发言条数不能为负")
+        chat_manager.update_thread_context(token_budget=token_budget, recent_turns=recent_turns)
+        await thread_cmd.finish(f"✅ 已设置: 上下文Token预算{token_budget}, 保留最近{recent_turns}条发言")
+    else:
+        await thread_cmd.finish(usage)
+
+
+@compact_cmd.handle()
+async def handle_compact(event: MessageEvent, args: Message = CommandArg()):
+    if not await check_super_user(event):
+        await compact_cmd.finish("你没有权限")
+
+    arg_text = args.extract_plain_text().strip()
+    usage = "用法:\n• px compact on/off\n• px compact set <单条字数> <识图保留条数> <摘要字数>\n• px compact run\n• px compact bench [条数]"
+
+    if not arg_text:
+        config = chat_manager.get_context_compaction()
+        status = "✅开启" if config["enabled"] else "❌关闭"
+        content = f"上下文压缩: {status}\n"
+        content += f"单条最多: {config['max_chars']}字, 识图结果保留{config['caption_turns']}条消息后缩短为{config['caption_chars']}字摘要\n"
+        stats = get_compaction_stats()
+        if stats:
+            content += "\n各会话压缩统计:\n"
+            for key, item in sorted(stats.items(), key=lambda kv: kv[1]["bytes"], reverse=True)[:10]:
+                content += f"• {key}: 合并{item['collapsed']}条, 截断{item['truncated']}条, 缩短识图{item['aged']}条, "
+                content += f"减少{item['bytes']}字节(约{item['tokens']} Token)\n"
+        content += "\n" + usage
+        await compact_cmd.finish(content)
+
+    parts = arg_text.split()
+
+    if parts[0] in ("on", "off"):
+        enabled = parts[0] == "on"
+        if chat_manager.update_context_compaction(enabled=enabled):
+            await compact_cmd.finish(f"✅ 已{'开启' if enabled else '关闭'}上下文压缩")
+        else:
+            await compact_cmd.finish(f"⚠️ 上下文压缩已是{'开启' if enabled else '关闭'}状态")
+    elif parts[0] == "set" and len(parts) >= 4:
+        try:
+            max_chars, caption_turns, caption_chars = int(parts[1]), int(parts[2]), int(parts[3])
+        except ValueError:
+            await compact_cmd.finish("参数必须是整数")
+        if max_chars < 50 or caption_turns < 0 or caption_chars < 5:
+            await compact_cmd.finish("单条字数至少为50，保留条数不能为负，摘要字数至少为5")
+        chat_manager.update_context_compaction(max_chars=max_chars, caption_turns=caption_turns, caption_chars=caption_chars)
+        await compact_cmd.finish(f"✅ 已设置: 单条最多{max_chars}字, 识图结果保留{caption_turns}条后缩短为{caption_chars}字")
+    elif parts[0] == "run":
+        removed = compact_all_contexts()
+        await compact_cmd.finish(f"✅ 已压缩全部上下文, 减少{removed['bytes']}字节(约{removed['tokens']} Token)")
+    elif parts[0] == "bench":
+        try:
+            count = int(parts[1]) if len(parts) >= 2 else 100_000
+        except ValueError:
+            await compact_cmd.finish("条数必须是整数")
+        if not 1000 <= count <= 1_000_000:
+            await compact_cmd.finish("条数需在1000-1000000之间")
+        result = benchmark_memory(count)
+        content = f"📏 {result['count']}条群聊消息的内存占用:\n"
+        content += f"字典存储: {result['dict_bytes'] / 1024 / 1024:.1f}MB\n"
+        content += f"紧凑记录: {result['record_bytes'] / 1024 / 1024:.1f}MB\n"
+        content += f"节省: {result['saved_ratio']:.1%}"
+        await compact_cmd.finish(content)
+    else:
+        await compact_cmd.finish(usage)
+
+
+@usage_cmd.handle()
+async def handle_usage(event: MessageEvent, args: Message = CommandArg()):
+    if not await check_super_user(event):
+        await usage_cmd.finish("你没有权限")
+
+    parts = args.extract_plain_text().strip().split()
+    usage = (
+        "用法:\n• px usage [1h/today/24h/7d/30d] [scope/provider/model/stage]\n"
+        "• px usage quota <群号> <每日Token>\n• px usage quota action <downgrade/skip>"
+    )
+
+    if parts and parts[0] == "quota":
+        quota = chat_manager.get_usage_quota()
+        if len(parts) == 1:
+            content = f"群聊每日Token配额, 超出时: {QUOTA_ACTIONS[quota['action']]}\n"
+            if not quota["groups"]:
+                content += "未设置任何群的配额\n"
+            for group_id, limit in quota["groups"].items():
+                content += f"群 {group_id}: 今日 {usage_ledger.get_today_tokens(f'group_{group_id}')}/{limit} Token\n"
+            await usage_cmd.finish(content.strip())
+        if parts[1] == "action" and len(parts) >= 3:
+            if parts[2] not in QUOTA_ACTIONS:
+                await usage_cmd.finish("用法: px usage quota action <downgrade/skip>")
+            chat_manager.update_usage_quota(action=parts[2])
+            await usage_cmd.finish(f"✅ 超出配额时将{QUOTA_ACTIONS[parts[2]]}")
+        if len(parts) < 3:
+            await usage_cmd.finish(usage)
+        try:
+            daily_tokens = int(parts[2])
+        except ValueError:
+            await usage_cmd.finish("⚠️ Token数必须是整数")
+        if daily_tokens < 0:
+            await usage_cmd.finish("⚠️ Token数不能为负数")
+        if not chat_manager.set_group_usage_quota(parts[1], daily_tokens):
+            await usage_cmd.finish(f"⚠️ 群 {parts[1]} 的配额没有变化")
+        if daily_tokens:
+            await usage_cmd.finish(f"✅ 群 {parts[1]} 每日Token配额已设置为 {daily_tokens}")
+        await usage_cmd.finish(f"✅ 已取消群 {parts[1]} 的配额")
+
+    window = parts[0] if parts else "today"
+    dimension = parts[1] if len(parts) >= 2 else "scope"
+    if window not in USAGE_WINDOWS or dimension not in USAGE_DIMENSIONS:
+        await usage_cmd.finish(usage)
+
+    total = usage_ledger.summary(window)
+    content = f"{USAGE_WINDOWS[window][0]}用量\n"
+    content += f"调用: {total['calls']}次, 提示Token: {total['prompt_tokens']} (缓存命中{total['cached_tokens']}), "
+    content += f"补全Token: {total['completion_tokens']}, 费用约: {total['cost']:.4f}\n"
+    ranked = usage_ledger.top(window, dimension)
+    if ranked:
+        content += f"\n按{USAGE_DIMENSIONS[dimension][0]}排行:\n"
+        for name, stats in ranked:
+            tokens = stats["prompt_tokens"] + stats["completion_tokens"]
+            content += f"{name}: {tokens} Token ({stats['calls']}次), 费用约{stats['cost']:.4f}\n"
+    await usage_cmd.finish(content.strip())
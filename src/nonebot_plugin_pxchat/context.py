@@ -1,48 +1,392 @@
 import json
 import os
-from typing import List, Dict
+import random
+import re
+import sys
+import tracemalloc
+from typing import Any, List, Dict, Iterable, Optional, Tuple
 import nonebot_plugin_localstore as store
+from .manager import chat_manager
+from .tokens import estimate_tokens, estimate_messages_tokens
+from .segments import format_segments, parse_reply
 
 CONTEXT_FILE = store.get_plugin_data_file("px_chat_context.json")
 MAX_CONTEXT_LENGTH = 20  # 每个对话最大消息数
+# 超出上限后再多攒几条才一次性裁剪回上限，而不是每条消息都滑动窗口，
+# 使历史的开头在多轮对话中保持不变，服务商的前缀缓存可以命中
+CONTEXT_TRIM_SLACK = 8
 
-# { "user_id_or_group_id": [{"role": "user|assistant|system", "content": "..."}] }
-_contexts: Dict[str, List[Dict[str, str]]] = {}
+# 消息角色，记录中只存下标
+ROLES = ("user", "assistant", "system")
+ROLE_INDEX = {role: index for index, role in enumerate(ROLES)}
+# 消息中的图片识别结果，到下一张图片的结果或消息结尾为止
+IMAGE_RESULT_PATTERN = re.compile(r"\[图片(\d+)的识别结果\](.*?)(?=\n\[图片\d+的识别结果\]|\Z)", re.S)
+
+
+class RenderedReply(dict):
+    """渲染后的机器人回复，额外带着解析好的分段，判断等环节无需再解析正文"""
+
+    __slots__ = ("segments",)
+
+
+class ContextMessage:
+    """
+    上下文中的一条消息
+    群聊发送者的 (QQ号, 昵称) 全局共用一份，正文只存一次，
+    "用户xxx(昵称)说：" 前缀和 OpenAI 格式的字典在请求时才渲染；
+    机器人的回复只存解析好的分段，按当前回复格式渲染
+    """
+
+    __slots__ = ("role", "sender", "content", "message_id", "reply_to", "repeat", "segments")
+
+    def __init__(self, role: int, content: str, sender: Optional[Tuple[str, Optional[str]]] = None,
+                 message_id: Optional[str] = None, reply_to: Optional[str] = None, repeat: int = 1,
+                 segments: Optional[List[str]] = None):
+        self.role = role
+        self.sender = sender
+        self.content = content
+        self.message_id = message_id
+        self.reply_to = reply_to
+        self.repeat = repeat
+        self.segments = segments
+
+    @property
+    def user_id(self) -> Optional[str]:
+        return self.sender[0] if self.sender else None
+
+    def text(self) -> str:
+        """渲染发送给模型的消息文本"""
+        if self.segments is not None:
+            return format_segments(self.segments, chat_manager.get_reply_wire_format())
+        content = self.content
+        if self.sender and self.sender[1] is not None:
+            content = f"用户{self.sender[0]}({self.sender[1]})说：: {content}"
+        if self.repeat > 1:
+            content = f"{content.rstrip()} ×{self.repeat}"
+        return content
+
+    def render(self) -> Dict[str, str]:
+        if self.segments is None:
+            return {"role": ROLES[self.role], "content": self.text()}
+        rendered = RenderedReply(role=ROLES[self.role], content=self.text())
+        rendered.segments = self.segments
+        return rendered
+
+    def to_json(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = {"role": ROLES[self.role], "content": self.content}
+        if self.sender:
+            data["user_id"] = self.sender[0]
+            if self.sender[1] is not None:
+                data["nickname"] = self.sender[1]
+        if self.message_id is not None:
+            data["message_id"] = self.message_id
+        if self.reply_to is not None:
+            data["reply_to"] = self.reply_to
+        if self.repeat > 1:
+            data["repeat"] = self.repeat
+        if self.segments is not None:
+            data["segments"] = self.segments
+        return data
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "ContextMessage":
+        # 旧格式的消息只有 role 和 content，前缀已包含在正文中，回复是 JSON 文本，加载时解析一次
+        sender = _intern_sender(data["user_id"], data.get("nickname")) if data.get("user_id") else None
+        content, segments = data["content"], data.get("segments")
+        if segments is None and data["role"] == "assistant":
+            segments = parse_reply(content, "json")[0]
+            if segments is not None:
+                content = ""
+        return cls(ROLE_INDEX[data["role"]], content, sender,
+                   data.get("message_id"), data.get("reply_to"), data.get("repeat", 1), segments)
+
+
+# { "user_id_or_group_id": [上下文消息] }
+_contexts: Dict[str, List[ContextMessage]] = {}
+# { "user_id_or_group_id": { "消息ID": 上下文中的消息 } }，按消息ID直接定位回复链
+_message_index: Dict[str, Dict[str, ContextMessage]] = {}
+# { (QQ号, 昵称): 同一个元组 }，同一发送者的所有消息共用
+_senders: Dict[Tuple[str, Optional[str]], Tuple[str, Optional[str]]] = {}
+# { "user_id_or_group_id": {"collapsed": 合并的重复消息, "truncated": 截断的消息, "aged": 缩短的识图结果, "bytes": 减少的字节, "tokens": 减少的Token} }
+_compaction_stats: Dict[str, Dict[str, int]] = {}
+
+def _intern_sender(user_id: str, nickname: Optional[str]) -> Tuple[str, Optional[str]]:
+    sender = (sys.intern(str(user_id)), sys.intern(str(nickname)) if nickname is not None else None)
+    return _senders.setdefault(sender, sender)
+
+def _build_index(key: str):
+    # 合并重复消息时登记的别名，只要对应的消息还在上下文中就保留
+    alive = {id(msg) for msg in _contexts.get(key, [])}
+    index = {message_id: msg for message_id, msg in _message_index.get(key, {}).items() if id(msg) in alive}
+    index.update({msg.message_id: msg for msg in _contexts.get(key, []) if msg.message_id is not None})
+    _message_index[key] = index
 
 def load_contexts():
     global _contexts
+    _contexts = {}
     if os.path.exists(CONTEXT_FILE):
         try:
             with open(CONTEXT_FILE, "r", encoding="utf-8") as f:
-                _contexts = json.load(f)
+                _contexts = {key: [ContextMessage.from_json(msg) for msg in messages] for key, messages in json.load(f).items()}
         except Exception:
             _contexts = {}
+    _message_index.clear()
+    for key in _contexts:
+        _build_index(key)
 
 def save_contexts():
     with open(CONTEXT_FILE, "w", encoding="utf-8") as f:
-        json.dump(_contexts, f, ensure_ascii=False, indent=2)
+        json.dump({key: [msg.to_json() for msg in messages] for key, messages in _contexts.items()}, f, ensure_ascii=False, indent=2)
 
 def get_context(key: str) -> List[Dict[str, str]]:
-    return _contexts.get(key, [])
+    """获取会话上下文，渲染为发送给模型的消息格式"""
+    return [msg.render() for msg in _contexts.get(key, [])]
 
-def add_message(key: str, role: str, content: str):
+def add_message(key: str, role: str, content: str, message_id: Optional[str] = None, user_id: Optional[str] = None,
+                nickname: Optional[str] = None, reply_to: Optional[str] = None):
+    """
+    添加一条消息
+    :param message_id: 消息ID，用于回复链查找
+    :param user_id: 发送者QQ号
+    :param nickname: 发送者昵称，群聊消息提供时渲染 "用户xxx(昵称)说：" 前缀
+    :param reply_to: 回复的消息ID
+    """
     context = _contexts.get(key, [])
-    context.append({"role": role, "content": content})
-    if len(context) > MAX_CONTEXT_LENGTH:
+    sender = _intern_sender(user_id, nickname) if user_id is not None else None
+    compaction = chat_manager.get_context_compaction()
+    if compaction["enabled"] and role == "user":
+        # 与上一条内容相同的消息合并为 "xxx ×N"
+        if context and _collapse(key, context[-1], content, sender):
+            if message_id is not None:
+                _message_index.setdefault(key, {})[message_id] = context[-1]
+            save_contexts()
+            return
+        content = _truncate(key, content, compaction["max_chars"])
+
+    _append(key, context, ContextMessage(ROLE_INDEX[role], content, sender, message_id, reply_to))
+
+def add_reply(key: str, segments: List[str], reply_to: Optional[str] = None):
+    """
+    添加一条机器人回复
+    :param segments: 解析好的回复分段
+    :param reply_to: 回复的消息ID
+    """
+    entry = ContextMessage(ROLE_INDEX["assistant"], "", reply_to=reply_to, segments=list(segments))
+    _append(key, _contexts.get(key, []), entry)
+
+def _append(key: str, context: List[ContextMessage], entry: ContextMessage):
+    context.append(entry)
+    if len(context) > MAX_CONTEXT_LENGTH + CONTEXT_TRIM_SLACK:
         context = context[-MAX_CONTEXT_LENGTH:]
-    _contexts[key] = context
+        _contexts[key] = context
+        _build_index(key)
+    else:
+        _contexts[key] = context
+        if entry.message_id is not None:
+            _message_index.setdefault(key, {})[entry.message_id] = entry
+    # 每条消息只在恰好过了保留轮数时缩短一次识图结果，更早的历史保持不变
+    compaction = chat_manager.get_context_compaction()
+    if compaction["enabled"] and len(context) > compaction["caption_turns"]:
+        _age_captions(key, context[-1 - compaction["caption_turns"]], compaction["caption_chars"])
     save_contexts()
 
 def clear_context(key: str):
     if key in _contexts:
         del _contexts[key]
+        _message_index.pop(key, None)
         save_contexts()
 
+def _record_compaction(key: str, kind: str, before: str, after: str):
+    stats = _compaction_stats.setdefault(key, {"collapsed": 0, "truncated": 0, "aged": 0, "bytes": 0, "tokens": 0})
+    stats[kind] += 1
+    stats["bytes"] += len(before.encode("utf-8")) - len(after.encode("utf-8"))
+    stats["tokens"] += estimate_tokens(before) - estimate_tokens(after)
+
+def _collapse(key: str, previous: ContextMessage, content: str, sender: Optional[Tuple[str, Optional[str]]]) -> bool:
+    """
+    新消息与上一条用户消息发送者和正文都相同时并入上一条，返回是否已合并
+    不同用户发的相同内容不合并，否则后一条的消息ID会指向前一个用户的记录，回复对象随之错位
+    """
+    body = content.strip()
+    if previous.role != ROLE_INDEX["user"] or previous.sender != sender or not body or previous.content.strip() != body:
+        return False
+    # 被合并的整条消息都省掉了，只多了计数后缀
+    before = ContextMessage(previous.role, content, sender).text()
+    suffix = f" ×{previous.repeat}" if previous.repeat > 1 else ""
+    previous.repeat += 1
+    _record_compaction(key, "collapsed", before + suffix, f" ×{previous.repeat}")
+    return True
+
+def _truncate(key: str, content: str, max_chars: int) -> str:
+    """超长消息截断并标注截掉的字数，识图结果由 _age_captions 单独缩短"""
+    if len(content) <= max_chars or IMAGE_RESULT_PATTERN.search(content):
+        return content
+    truncated = f"{content[:max_chars]}…[已截断{len(content) - max_chars}字]"
+    _record_compaction(key, "truncated", content, truncated)
+    return truncated
+
+def _age_captions(key: str, entry: ContextMessage, caption_chars: int):
+    """将过了保留轮数的识图结果缩短为一行摘要"""
+    if entry.role != ROLE_INDEX["user"] or "的识别结果]" not in entry.content:
+        return
+
+    def shorten(match: re.Match) -> str:
+        lines = match.group(2).strip().splitlines()
+        caption = lines[0] if lines else ""
+        if len(caption) > caption_chars or len(lines) > 1:
+            caption = caption[:caption_chars] + "…"
+        return f"[图片{match.group(1)}] {caption}"
+
+    aged = IMAGE_RESULT_PATTERN.sub(shorten, entry.content)
+    if aged == entry.content:
+        return
+    _record_compaction(key, "aged", entry.content, aged)
+    entry.content = aged
+
+def compact_context(key: str):
+    """对已有的上下文整体执行一次压缩：合并重复、截断超长、缩短较早的识图结果"""
+    config = chat_manager.get_context_compaction()
+    compacted: List[ContextMessage] = []
+    for msg in _contexts.get(key, []):
+        if msg.role == ROLE_INDEX["user"]:
+            if compacted and msg.repeat == 1 and _collapse(key, compacted[-1], msg.content, msg.sender):
+                if msg.message_id is not None:
+                    _message_index.setdefault(key, {})[msg.message_id] = compacted[-1]
+                continue
+            msg.content = _truncate(key, msg.content, config["max_chars"])
+        compacted.append(msg)
+    for msg in compacted[:len(compacted) - config["caption_turns"]]:
+        _age_captions(key, msg, config["caption_chars"])
+    _contexts[key] = compacted
+    _build_index(key)
+
+def compact_all_contexts() -> Dict[str, int]:
+    """压缩全部会话的上下文，返回总共减少的字节和Token"""
+    before = {name: sum(stats[name] for stats in _compaction_stats.values()) for name in ("bytes", "tokens")}
+    for key in list(_contexts):
+        compact_context(key)
+    save_contexts()
+    return {name: sum(stats[name] for stats in _compaction_stats.values()) - before[name] for name in ("bytes", "tokens")}
+
+def get_compaction_stats() -> Dict[str, Dict[str, int]]:
+    """获取各会话的上下文压缩统计"""
+    return {key: dict(stats) for key, stats in _compaction_stats.items()}
+
+def get_message(key: str, message_id: str) -> Optional[ContextMessage]:
+    """按消息ID查找上下文中的消息"""
+    return _message_index.get(key, {}).get(message_id)
+
+def select_thread(key: str, message_id: Optional[str], quoted: Optional[str] = None,
+                  targets: Iterable[str] = ()) -> List[Dict[str, str]]:
+    """
+    按当前消息所在的对话线索挑选群聊上下文
+    上下文在Token预算内时原样返回；超出时优先保留被回复的消息及其祖先、
+    发送者和被@用户最近的发言、机器人对这些消息的回复，再用最近的消息填满预算
+    :param key: 会话key
+    :param message_id: 当前消息ID
+    :param quoted: 被回复的消息已不在上下文中时，其文本作为引用补充
+    :param targets: 当前消息@的其他用户
+    """
+    context = _contexts.get(key, [])
+    rendered = [msg.render() for msg in context]
+    config = chat_manager.get_thread_context()
+    if not config["enabled"] or not context:
+        return rendered
+    current = get_message(key, message_id) if message_id else None
+    # 引用的消息放在当前消息之前，找不到当前消息时放在最后一条之前
+    position = next((i for i, msg in enumerate(context) if msg is current), len(context) - 1)
+    quoted_msg = [{"role": "user", "content": f"[被回复的消息] {quoted}"}] if quoted else []
+    if current is None or estimate_messages_tokens(rendered) + estimate_messages_tokens(quoted_msg) <= config["token_budget"]:
+        return rendered[:position] + quoted_msg + rendered[position:]
+
+    # 线索：当前消息沿回复链向上的祖先
+    thread = {id(current)}
+    parent = get_message(key, current.reply_to) if current.reply_to else None
+    while parent is not None and id(parent) not in thread:
+        thread.add(id(parent))
+        parent = get_message(key, parent.reply_to) if parent.reply_to else None
+    # 发送者和被@用户最近的发言
+    speakers = {current.user_id} | set(targets)
+    recent: Dict[str, int] = {}
+    for msg in reversed(context):
+        speaker = msg.user_id
+        if speaker in speakers and recent.get(speaker, 0) < config["recent_turns"]:
+            recent[speaker] = recent.get(speaker, 0) + 1
+            thread.add(id(msg))
+    # 机器人对线索中消息的回复
+    thread_ids = {msg.message_id for msg in context if id(msg) in thread and msg.message_id is not None}
+    for msg in context:
+        if msg.role == ROLE_INDEX["assistant"] and msg.reply_to in thread_ids:
+            thread.add(id(msg))
+
+    # 先放线索，再从新到旧补充其余消息，按原顺序输出
+    budget = config["token_budget"] - estimate_messages_tokens(quoted_msg)
+    selected = set()
+    newest_first = list(reversed(range(len(context))))
+    for candidates in ([i for i in newest_first if id(context[i]) in thread], newest_first):
+        for i in candidates:
+            if i in selected:
+                continue
+            cost = estimate_messages_tokens([rendered[i]])
+            if cost > budget and i != position:
+                continue
+            budget -= cost
+            selected.add(i)
+    ordered = sorted(selected)
+    return [rendered[i] for i in ordered if i < position] + quoted_msg + [rendered[i] for i in ordered if i >= position]
+
+def benchmark_memory(count: int = 100_000) -> Dict[str, Any]:
+    """
+    对比两种方式保存 count 条群聊消息的内存占用：
+    每条消息一个带前缀正文和元数据的字典，与 ContextMessage 记录
+    """
+    rng = random.Random(0)
+    users = [(str(10000 + i), f"群友{i}") for i in range(200)]
+    # 只预先生成发送者下标和正文长度，正文和元数据都在各自的构建过程中生成并计入内存
+    samples = [(rng.randrange(len(users)), rng.randint(3, 15)) for _ in range(count)]
+
+    def measure(build) -> int:
+        tracemalloc.start()
+        try:
+            stored = build()
+            used = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        del stored
+        return used
+
+    def build_dicts():
+        stored = []
+        for i, (user, repeat) in enumerate(samples):
+            user_id, nickname = users[user]
+            stored.append({
+                "role": "user",
+                "content": f"用户{user_id}({nickname})说：: 第{i}条消息 " + "内容" * repeat,
+                "message_id": str(i),
+                "user_id": user_id,
+            })
+        return stored
+
+    def build_records():
+        # 使用本地的驻留表，不受全局驻留表中已有发送者的影响
+        senders: Dict[Tuple[str, Optional[str]], Tuple[str, Optional[str]]] = {}
+        stored = []
+        for i, (user, repeat) in enumerate(samples):
+            sender = senders.setdefault(users[user], users[user])
+            stored.append(ContextMessage(ROLE_INDEX["user"], f"第{i}条消息 " + "内容" * repeat, sender, str(i)))
+        return stored, senders
+
+    dict_bytes = measure(build_dicts)
+    record_bytes = measure(build_records)
+    return {
+        "count": count,
+        "dict_bytes": dict_bytes,
+        "record_bytes": record_bytes,
+        "saved_ratio": 1 - record_bytes / dict_bytes if dict_bytes else 0.0,
+    }
+
 def add_user_message_to_group(group_id: str, user_id: str, nickname: str, content: str):
     """
     专门用于群聊环境添加用户消息
     """
-    key = f"group_{group_id}"
-    user_info = f"用户{user_id}({nickname})"
-    user_message = f"{user_info}: {content}"
-    add_message(key, "user", user_message)
\ No newline at end of file
+    add_message(f"group_{group_id}", "user", content, user_id=user_id, nickname=nickname)
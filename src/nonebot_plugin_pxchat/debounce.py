@@ -0,0 +1,96 @@
+import asyncio
+import time
+from typing import Dict, List, Optional
+from nonebot import logger
+from .manager import chat_manager
+
+# 超过该时间（秒）没有新消息的会话清除打字节奏记录，远大于最大等待窗口，不会清掉正在等待的会话
+IDLE_EVICT_SECONDS = 600.0
+
+
+class MessageDebouncer:
+    """私聊连发合并：同一会话在窗口期内的多条消息合并为一次回复"""
+
+    def __init__(self, alpha: float = 0.3):
+        # 平滑系数，越大越偏向最近的打字间隔
+        self._alpha = alpha
+        # { "会话key": [待合并的消息] }
+        self._pending: Dict[str, List[str]] = {}
+        # { "会话key": 最新消息的序号 }，只有最后一条消息的处理器负责回复
+        self._generation: Dict[str, int] = {}
+        # { "会话key": 上一条消息的时间 }
+        self._last_seen: Dict[str, float] = {}
+        # { "会话key": 平滑后的连发间隔（秒） }
+        self._cadence: Dict[str, float] = {}
+        self._last_sweep = time.monotonic()
+        self._stats = {
+            "messages": 0,   # 进入防抖的消息数
+            "merged": 0,     # 被合并掉（未单独触发回复）的消息数
+        }
+
+    def get_window(self, key: str) -> float:
+        """根据用户的连发节奏计算等待窗口"""
+        window = chat_manager.get_private_debounce_window()
+        cadence = self._cadence.get(key)
+        if cadence is None:
+            return window["base"]
+        # 留出一半余量等下一条消息
+        return min(window["max"], max(window["min"], cadence * 1.5))
+
+    def _observe(self, key: str, now: float):
+        """记录连发间隔，超过最大窗口的间隔视为新一轮对话，不参与统计"""
+        last = self._last_seen.get(key)
+        self._last_seen[key] = now
+        if last is None:
+            return
+        gap = now - last
+        if gap > chat_manager.get_private_debounce_window()["max"]:
+            return
+        previous = self._cadence.get(key)
+        self._cadence[key] = gap if previous is None else self._alpha * gap + (1 - self._alpha) * previous
+
+    async def submit(self, key: str, content: str) -> Optional[str]:
+        """
+        提交一条消息并等待窗口结束
+        :return: 窗口内最后一条消息返回合并后的内容，其余返回None
+        """
+        now = time.monotonic()
+        self._observe(key, now)
+        self._pending.setdefault(key, []).append(content.strip())
+        generation = self._generation.get(key, 0) + 1
+        self._generation[key] = generation
+        self._stats["messages"] += 1
+
+        await asyncio.sleep(self.get_window(key))
+
+        # 窗口内又来了新消息，交给新消息的处理器
+        if self._generation.get(key) != generation:
+            self._stats["merged"] += 1
+            return None
+
+        messages = self._pending.pop(key, [])
+        self._evict_idle()
+        if len(messages) > 1:
+            logger.info(f"会话 {key} 合并 {len(messages)} 条连发消息")
+        return "\n".join(message for message in messages if message)
+
+    def _evict_idle(self):
+        """每分钟最多一次，清除长时间没有消息的会话，避免记录随私聊用户数无限增长"""
+        now = time.monotonic()
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+        for key in [key for key, last in self._last_seen.items() if now - last > IDLE_EVICT_SECONDS]:
+            if key in self._pending:
+                continue
+            del self._last_seen[key]
+            self._cadence.pop(key, None)
+            self._generation.pop(key, None)
+
+    def get_stats(self) -> Dict[str, int]:
+        """获取防抖统计信息"""
+        return {**self._stats, "pending": sum(len(v) for v in self._pending.values())}
+
+
+# 全局防抖器实例
+private_debouncer = MessageDebouncer()
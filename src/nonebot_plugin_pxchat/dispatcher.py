@@ -0,0 +1,182 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Tuple, Union
+from nonebot import logger
+from nonebot.adapters.onebot.v11 import Bot, MessageEvent, Message
+from .send2root import send_error_to_super_users
+from .ratelimit import outbound_limiter
+
+
+class OutboundDispatcher:
+    """出站消息调度器：按会话排队，后台按顺序模拟真人节奏发送"""
+
+    def __init__(self, latency_window: int = 200):
+        # { "会话key": Queue[发送任务] }
+        self._queues: Dict[str, asyncio.Queue] = {}
+        # { "会话key": 该会话的发送协程 }
+        self._workers: Dict[str, asyncio.Task] = {}
+        self._closing = False
+        # 关闭时用于打断段间延迟
+        self._closing_event = asyncio.Event()
+        # 最近的投递延迟（秒）：入队 → 首段送达 / 入队 → 全部送达
+        self._first_latencies: Deque[float] = deque(maxlen=latency_window)
+        self._full_latencies: Deque[float] = deque(maxlen=latency_window)
+        self._stats = {
+            "enqueued": 0,      # 入队的回复数
+            "delivered": 0,     # 完整送达的回复数
+            "segments": 0,      # 已发送的段数
+            "failed": 0,        # 发送失败的段数
+            "dropped": 0,       # 关闭时未能送达的回复数
+        }
+
+    def enqueue(self, bot: Bot, event: MessageEvent, key: str,
+                segments: List[Union[str, Message]], delay_range: Tuple[float, float] = (2, 3)) -> bool:
+        """
+        将分段消息放入会话队列，立即返回
+        :param bot: 发送使用的Bot
+        :param event: 触发事件，用于确定发送目标
+        :param key: 会话key（与上下文key一致），同一key内严格按顺序发送
+        :param segments: 要发送的消息段
+        :param delay_range: 每段消息之间的延迟时间范围（秒）
+        """
+        if self._closing:
+            logger.warning(f"调度器正在关闭，丢弃会话 {key} 的消息")
+            return False
+        if not segments:
+            return False
+
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = asyncio.Queue()
+            self._queues[key] = queue
+
+        queue.put_nowait({
+            "bot": bot,
+            "event": event,
+            "key": key,
+            "segments": segments,
+            "delay_range": delay_range,
+            "enqueued_at": time.monotonic(),
+        })
+        self._stats["enqueued"] += 1
+
+        worker = self._workers.get(key)
+        if worker is None or worker.done():
+            self._workers[key] = asyncio.create_task(self._worker(key, queue))
+        return True
+
+    async def _worker(self, key: str, queue: asyncio.Queue):
+        """单个会话的发送协程，队列清空后自动退出"""
+        try:
+            while not queue.empty():
+                job = queue.get_nowait()
+                try:
+                    await self._deliver(job)
+                except asyncio.CancelledError:
+                    # 发送到一半被取消的回复同样算作未送达
+                    self._stats["dropped"] += 1
+                    raise
+                finally:
+                    queue.task_done()
+        except asyncio.CancelledError:
+            logger.info(f"会话 {key} 发送任务被取消，剩余 {queue.qsize()} 条未发送")
+            raise
+        finally:
+            # 队列为空时才清理，避免清掉新入队的消息
+            if self._workers.get(key) is asyncio.current_task():
+                del self._workers[key]
+                if queue.empty() and self._queues.get(key) is queue:
+                    del self._queues[key]
+
+    async def _deliver(self, job: Dict[str, Any]):
+        """按顺序发送一条回复的所有段落"""
+        bot: Bot = job["bot"]
+        event: MessageEvent = job["event"]
+        segments = job["segments"]
+        enqueued_at = job["enqueued_at"]
+
+        for i, segment in enumerate(segments):
+            try:
+                await self._send(bot, event, job["key"], segment)
+                self._stats["segments"] += 1
+            except Exception as e:
+                self._stats["failed"] += 1
+                logger.error(f"分段消息发送失败: {e}")
+                await send_error_to_super_users(f"分段消息发送失败:\n {str(e)}", event)
+                return
+
+            if i == 0:
+                self._first_latencies.append(time.monotonic() - enqueued_at)
+            # 不是最后一段就延迟，关闭时跳过延迟尽快送达
+            if i < len(segments) - 1:
+                await self._pause(random.uniform(*job["delay_range"]))
+
+        self._stats["delivered"] += 1
+        self._full_latencies.append(time.monotonic() - enqueued_at)
+
+    async def _pause(self, delay: float):
+        """段间延迟，调度器关闭时立即结束"""
+        if self._closing:
+            return
+        try:
+            await asyncio.wait_for(self._closing_event.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _send(self, bot: Bot, event: MessageEvent, key: str, segment: Union[str, Message]):
+        """经过出站限流后调用OneBot发送"""
+        await outbound_limiter.acquire(key)
+        await bot.send(event, segment)
+
+    def get_queue_depth(self) -> Dict[str, int]:
+        """获取各会话的待发送回复数"""
+        return {key: queue.qsize() for key, queue in self._queues.items() if queue.qsize()}
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取调度器统计信息"""
+        def summarize(samples: Deque[float]) -> Tuple[float, float]:
+            if not samples:
+                return 0.0, 0.0
+            ordered = sorted(samples)
+            p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+            return sum(ordered) / len(ordered), p95
+
+        first_avg, first_p95 = summarize(self._first_latencies)
+        full_avg, full_p95 = summarize(self._full_latencies)
+        depth = self.get_queue_depth()
+        return {
+            **self._stats,
+            "queued": sum(depth.values()),
+            "active_chats": len(self._workers),
+            "first_latency_avg": first_avg,
+            "first_latency_p95": first_p95,
+            "full_latency_avg": full_avg,
+            "full_latency_p95": full_p95,
+        }
+
+    async def shutdown(self, timeout: float = 10.0):
+        """停止接收新消息，在超时时间内尽量发完队列中的消息"""
+        self._closing = True
+        self._closing_event.set()
+        logger.info("开始关闭出站消息调度器...")
+        dropped_before = self._stats["dropped"]
+
+        workers = [task for task in self._workers.values() if not task.done()]
+        if workers:
+            done, pending = await asyncio.wait(workers, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+        # 被取消时正在发送的回复已在发送协程中计入
+        self._stats["dropped"] += sum(queue.qsize() for queue in self._queues.values())
+        self._queues.clear()
+        self._workers.clear()
+        logger.info(f"出站消息调度器关闭完成，未送达回复: {self._stats['dropped'] - dropped_before}")
+
+
+# 全局调度器实例
+outbound_dispatcher = OutboundDispatcher()
@@ -0,0 +1,123 @@
+import time
+from typing import Any, Dict
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    AuthenticationError,
+    BadRequestError,
+    NotFoundError,
+    PermissionDeniedError,
+    RateLimitError,
+)
+from .scheduler import AdmissionRejected
+
+# 错误类别
+ERROR_TRANSIENT = "transient"   # 网络、超时、5xx，可重试
+ERROR_RATE_LIMIT = "rate_limit" # 服务商限流
+ERROR_OVERLOAD = "overload"     # 本地准入控制丢弃
+ERROR_CONFIG = "config"         # 密钥、模型、地址等配置问题
+ERROR_OVERFLOW = "overflow"     # 上下文超出模型窗口
+ERROR_POISONED = "poisoned"     # 上下文本身有问题（内容审核、消息格式不被接受）
+ERROR_MALFORMED = "malformed"   # 模型回复格式无法修复
+ERROR_UNKNOWN = "unknown"
+
+ERROR_LABELS = {
+    ERROR_TRANSIENT: "网络或服务暂时异常",
+    ERROR_RATE_LIMIT: "服务商限流",
+    ERROR_OVERLOAD: "负载过高",
+    ERROR_CONFIG: "配置错误",
+    ERROR_OVERFLOW: "上下文超长",
+    ERROR_POISONED: "上下文异常",
+    ERROR_MALFORMED: "回复格式异常",
+    ERROR_UNKNOWN: "未知错误",
+}
+
+# 上下文超长的请求错误特征
+OVERFLOW_MARKERS = ("context_length", "context length", "maximum context", "too long", "too many tokens")
+# 需要清除上下文才能恢复的错误类别
+CONTEXT_ERRORS = (ERROR_OVERFLOW, ERROR_POISONED)
+# 每次都通知管理员的错误类别，其余类别在告警间隔内只通知一次
+ALWAYS_ALERT = CONTEXT_ERRORS + (ERROR_UNKNOWN,)
+ALERT_INTERVAL = 600.0
+
+
+class MalformedReplyError(Exception):
+    """模型回复不是可解析的回复格式，修复和重新生成后仍然失败"""
+
+
+def classify_error(error: BaseException) -> str:
+    """对调用链抛出的异常分类，决定重试、清除上下文还是只通知管理员"""
+    if isinstance(error, AdmissionRejected):
+        return ERROR_OVERLOAD
+    if isinstance(error, MalformedReplyError):
+        return ERROR_MALFORMED
+    if isinstance(error, RateLimitError):
+        return ERROR_RATE_LIMIT
+    if isinstance(error, (AuthenticationError, PermissionDeniedError, NotFoundError)):
+        return ERROR_CONFIG
+    if isinstance(error, BadRequestError):
+        message = str(error).lower()
+        if any(marker in message for marker in OVERFLOW_MARKERS):
+            return ERROR_OVERFLOW
+        # 其余请求错误多半是内容审核或上下文中的消息不被接受，重发同样的上下文仍会失败
+        return ERROR_POISONED
+    if isinstance(error, (APIConnectionError, TimeoutError)):
+        return ERROR_TRANSIENT
+    if isinstance(error, APIStatusError) and error.status_code >= 500:
+        return ERROR_TRANSIENT
+    if isinstance(error, Exception) and "未配置" in str(error):
+        return ERROR_CONFIG
+    return ERROR_UNKNOWN
+
+
+def is_transient(error: BaseException) -> bool:
+    """是否为可以退避重试的临时错误"""
+    return classify_error(error) == ERROR_TRANSIENT
+
+
+class ErrorTracker:
+    """统计错误处理的结果：重试挽回、回复修复、清除上下文和管理员告警"""
+
+    def __init__(self):
+        self._stats = {
+            "retries": 0,           # 临时错误的退避重试次数
+            "recovered": 0,         # 重试后成功的调用数
+            "repaired": 0,          # 本地修复的回复数
+            "regenerated": 0,       # 因格式异常重新生成的次数
+            "cleared": 0,           # 清除上下文的次数
+            "cleared_tokens": 0,    # 清除上下文丢弃的预估Token数
+            "kept": 0,              # 出错但保留了上下文的次数
+            "trimmed": 0,           # 发送前预检超出窗口而裁剪的请求数
+            "trimmed_tokens": 0,    # 预检裁剪掉的预估Token数
+            "alerts": 0,            # 发给管理员的告警数
+            "suppressed": 0,        # 告警间隔内被合并掉的告警数
+        }
+        # { "错误类别": 次数 }
+        self._errors: Dict[str, int] = {}
+        # { "错误类别": 上次告警时间 }
+        self._last_alert: Dict[str, float] = {}
+
+    def record(self, name: str, amount: int = 1):
+        self._stats[name] += amount
+
+    def record_error(self, kind: str):
+        self._errors[kind] = self._errors.get(kind, 0) + 1
+
+    def should_alert(self, kind: str) -> bool:
+        """是否需要通知管理员，临时错误、限流等在告警间隔内只通知一次，其余计入被合并的告警"""
+        if kind in ALWAYS_ALERT:
+            return True
+        now = time.monotonic()
+        if now - self._last_alert.get(kind, -ALERT_INTERVAL) < ALERT_INTERVAL:
+            self._stats["suppressed"] += 1
+            return False
+        self._last_alert[kind] = now
+        return True
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取错误处理统计信息"""
+        return {**self._stats, "errors": dict(self._errors)}
+
+
+# 全局错误统计实例
+error_tracker = ErrorTracker()
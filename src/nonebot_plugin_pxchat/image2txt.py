@@ -1,6 +1,7 @@
-from openai import AsyncOpenAI
 from nonebot import logger
 from .manager import chat_manager
+from .router import provider_router
+from .scheduler import AdmissionRejected
 import asyncio
 import json
 
@@ -18,14 +19,8 @@ async def recognize_image(image_url: str, prompt: str = "请简洁描述这张
         raise Exception("未配置图片识别服务，请使用 'px image ai add' 命令添加配置")
     
     try:
-        # 动态创建客户端
-        client = AsyncOpenAI(
-            api_key=ai_config.get("api_key", ""),
-            base_url=ai_config.get("api_url", ""),
-        )
-        
-        completion = await client.chat.completions.create(
-            model=ai_config.get("model", ""),
+        completion = await provider_router.create(
+            "image",
             messages=[
                 {
                     "role": "user",
@@ -53,6 +48,9 @@ async def recognize_image(image_url: str, prompt: str = "请简洁描述这张
             raise Exception("图片识别返回了空结果")
             
         return result
+    except AdmissionRejected:
+        # 负载过高被丢弃，由调用方决定如何降级
+        raise
     except Exception as e:
         logger.error(f"图片识别服务出现异常: {e}")
         raise Exception(f"图片识别出现异常: {e}")
\ No newline at end of file
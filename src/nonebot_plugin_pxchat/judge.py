@@ -0,0 +1,340 @@
+import asyncio
+import re
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Pattern, Tuple
+from nonebot import logger
+from nonebot.adapters.onebot.v11 import MessageEvent
+from .manager import chat_manager
+from .chat import should_reply_in_group, should_reply_in_groups
+from .scheduler import session_scope
+
+# 提问特征：以问号或句末疑问语气词"吗"结尾；
+# 不匹配句中的疑问词，"没什么""哪怕""谁知道呢"这类说法不是在提问
+QUESTION_PATTERN = re.compile(r"(?:[?？]|吗)[\s~～。.!！]*$")
+# 链接，匹配机器人名字前先去掉，避免域名和路径中的字母误触发
+URL_PATTERN = re.compile(r"(?:https?://|www\.)\S+", re.IGNORECASE)
+# 不含文字内容的消息段类型（表情、图片、戳一戳等）
+NON_TEXT_SEGMENTS = {"image", "face", "mface", "record", "video", "poke", "dice", "rps"}
+
+
+class GroupPreFilter:
+    """群聊回复判断的本地前置过滤，命中规则时直接给出结论，省掉一次大模型判断"""
+
+    def __init__(self):
+        # { "群号": 最近一次回复时间 }
+        self._last_reply: Dict[str, float] = {}
+        self._compiled: Dict[Tuple[str, ...], List[Pattern]] = {}
+        # { "规则:结论": 命中次数 }
+        self._hits: Dict[str, int] = {}
+        self._passed = 0
+
+    def _patterns(self, patterns: List[str]) -> List[Pattern]:
+        """编译并缓存正则，非法正则跳过"""
+        cache_key = tuple(patterns)
+        if cache_key not in self._compiled:
+            compiled = []
+            for pattern in patterns:
+                try:
+                    compiled.append(re.compile(pattern, re.IGNORECASE))
+                except re.error as e:
+                    logger.warning(f"前置过滤正则无效，已跳过: {pattern} ({e})")
+            self._compiled[cache_key] = compiled
+        return self._compiled[cache_key]
+
+    @staticmethod
+    def _name_patterns(names: List[str]) -> List[str]:
+        """
+        机器人名字的匹配规则：在消息开头称呼（"px，""px在吗"），或在消息中作为独立的词出现；
+        不匹配嵌在其他词中的情况，如 "pxx"、"vpx"、"小px子"
+        """
+        patterns = []
+        for name in names:
+            if name:
+                escaped = re.escape(name)
+                patterns.append(rf"^@?{escaped}(?![a-z0-9])|(?<!\w)@?{escaped}(?!\w)")
+        return patterns
+
+    def record_reply(self, group_id: str):
+        """记录机器人在群内的回复时间，用于冷却判断"""
+        self._last_reply[group_id] = time.monotonic()
+
+    def _decide(self, group_id: str, event: MessageEvent) -> Tuple[Optional[bool], str]:
+        rules = chat_manager.get_group_prefilter()
+        text = event.get_plaintext().strip()
+
+        # @了其他人，是在和别人说话
+        self_id = str(event.self_id)
+        if any(seg.type == "at" and str(seg.data.get("qq")) not in (self_id, "all") for seg in event.message):
+            return False, "at_others"
+
+        last_reply = self._last_reply.get(group_id)
+        if last_reply is not None and time.monotonic() - last_reply < rules["cooldown"]:
+            return False, "cooldown"
+
+        # 纯表情包/图片等没有文字的消息
+        if not text and any(seg.type in NON_TEXT_SEGMENTS for seg in event.message):
+            return False, "no_text"
+
+        if any(pattern.search(text) for pattern in self._patterns(rules["no_patterns"])):
+            return False, "no_pattern"
+
+        if len(re.sub(r"\s", "", text)) < rules["min_length"]:
+            return False, "too_short"
+
+        if any(pattern.search(URL_PATTERN.sub(" ", text)) for pattern in self._patterns(self._name_patterns(rules["bot_names"]))):
+            return True, "bot_name"
+
+        if any(pattern.search(text) for pattern in self._patterns(rules["yes_patterns"])):
+            return True, "yes_pattern"
+
+        if rules["question_yes"] and QUESTION_PATTERN.search(text):
+            return True, "question"
+
+        return None, ""
+
+    def check(self, group_id: str, event: MessageEvent) -> Optional[bool]:
+        """
+        用本地规则判断是否回复
+        :return: True/False 为规则直接给出的结论，None 表示需要交给大模型判断
+        """
+        if not chat_manager.get_group_prefilter()["enabled"]:
+            return None
+
+        decision, rule = self._decide(group_id, event)
+        if decision is None:
+            self._passed += 1
+            return None
+
+        label = f"{rule}:{'YES' if decision else 'NO'}"
+        self._hits[label] = self._hits.get(label, 0) + 1
+        logger.info(f"群组 {group_id} 前置过滤命中 {label}，跳过大模型判断")
+        return decision
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取前置过滤统计信息"""
+        short_circuited = sum(self._hits.values())
+        return {
+            "short_circuited": short_circuited,
+            "yes": sum(count for label, count in self._hits.items() if label.endswith(":YES")),
+            "no": sum(count for label, count in self._hits.items() if label.endswith(":NO")),
+            "passed": self._passed,
+            "hits": dict(sorted(self._hits.items(), key=lambda item: item[1], reverse=True)),
+        }
+
+
+class WindowedJudge:
+    """
+    群聊回复判断合并器
+    同一群内短时间的多条消息合并为一个窗口，窗口结束时只做一次判断；
+    判断为需要回复时，只由窗口内最后一条消息的处理器负责回复
+    """
+
+    def __init__(self):
+        # { "群号": {"future": 判断结果, "count": 消息数, "timer": 定时关闭任务, "judge": 判断函数} }
+        self._windows: Dict[str, Dict[str, Any]] = {}
+        # { "群号": 最近一分钟内的判断时间 }
+        self._recent_judgments: Dict[str, Deque[float]] = {}
+        self._stats = {
+            "messages": 0,    # 进入窗口的消息数
+            "windows": 0,     # 关闭的窗口数
+            "judgments": 0,   # 实际发起的判断数
+            "capped": 0,      # 因频率上限跳过判断的窗口数
+        }
+
+    async def submit(self, group_id: str, judge: Callable[[], Awaitable[bool]]) -> bool:
+        """
+        提交一条消息到群的判断窗口，等待窗口判断结果
+        :param group_id: 群号
+        :param judge: 判断函数，窗口关闭时以最新的群聊上下文调用
+        :return: 只有窗口内最后一条消息在判断为需要回复时返回True
+        """
+        # 未开启合并窗口时立即判断，安静的群不必多等一个窗口
+        if not chat_manager.is_group_judge_window_enabled():
+            return await judge()
+
+        config = chat_manager.get_group_judge_window()
+        self._stats["messages"] += 1
+
+        window = self._windows.get(group_id)
+        if window is None:
+            window = {
+                "future": asyncio.get_running_loop().create_future(),
+                "count": 0,
+                "timer": None,
+            }
+            self._windows[group_id] = window
+            window["timer"] = asyncio.create_task(self._close_later(group_id, window, config["interval"]))
+
+        window["count"] += 1
+        window["judge"] = judge
+        position = window["count"]
+
+        if position >= config["max_messages"]:
+            window["timer"].cancel()
+            asyncio.create_task(self._close(group_id, window))
+
+        future: asyncio.Future = window["future"]
+        try:
+            result = await asyncio.shield(future)
+        except Exception:
+            # 判断异常只交给最后一条消息处理，其余静默
+            if position == window["count"]:
+                raise
+            return False
+
+        return result and position == window["count"]
+
+    async def _close_later(self, group_id: str, window: Dict[str, Any], interval: float):
+        try:
+            await asyncio.sleep(interval)
+        except asyncio.CancelledError:
+            return
+        await self._close(group_id, window)
+
+    def _under_cap(self, group_id: str) -> bool:
+        """检查群在最近一分钟内的判断次数是否未超上限"""
+        now = time.monotonic()
+        recent = self._recent_judgments.setdefault(group_id, deque())
+        while recent and now - recent[0] > 60:
+            recent.popleft()
+        if len(recent) >= chat_manager.get_group_judge_window()["max_per_minute"]:
+            return False
+        recent.append(now)
+        return True
+
+    async def _close(self, group_id: str, window: Dict[str, Any]):
+        """关闭窗口并执行一次判断"""
+        if self._windows.get(group_id) is not window:
+            return
+        del self._windows[group_id]
+        self._stats["windows"] += 1
+        future: asyncio.Future = window["future"]
+
+        if not self._under_cap(group_id):
+            self._stats["capped"] += 1
+            logger.info(f"群组 {group_id} 判断次数达到每分钟上限，跳过本窗口 {window['count']} 条消息")
+            future.set_result(False)
+            return
+
+        self._stats["judgments"] += 1
+        logger.info(f"群组 {group_id} 窗口关闭，合并 {window['count']} 条消息进行一次判断")
+        try:
+            future.set_result(await window["judge"]())
+        except Exception as e:
+            future.set_exception(e)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取判断合并统计信息"""
+        return {**self._stats, "open_windows": len(self._windows)}
+
+    async def shutdown(self):
+        """关闭所有未结束的窗口，不再判断"""
+        for window in self._windows.values():
+            window["timer"].cancel()
+            if not window["future"].done():
+                window["future"].set_result(False)
+        self._windows.clear()
+
+
+class JudgmentBatcher:
+    """
+    跨群批量判断：短时间内多个群的判断请求合并为一次请求，
+    分摊系统提示词和单次请求开销；批量结果解析失败时逐个回退判断
+    """
+
+    def __init__(self):
+        # { "群号": {"messages": 群聊上下文, "future": 判断结果} }
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._timer: Optional[asyncio.Task] = None
+        self._stats = {
+            "requests": 0,      # 收到的判断请求数
+            "batches": 0,       # 发出的批量请求数
+            "batched": 0,       # 通过批量请求得到结论的判断数
+            "fallbacks": 0,     # 回退为单独判断的次数
+        }
+
+    async def judge(self, group_id: str, messages: list) -> bool:
+        """提交一个群的判断请求，等待批量结果"""
+        config = chat_manager.get_group_judge_batch()
+        if not config["enabled"]:
+            return await should_reply_in_group(messages)
+
+        self._stats["requests"] += 1
+        entry = self._pending.get(group_id)
+        if entry is None:
+            entry = {"future": asyncio.get_running_loop().create_future()}
+            self._pending[group_id] = entry
+        # 同一个群重复提交时使用最新的上下文
+        entry["messages"] = messages
+
+        if len(self._pending) >= config["max_groups"]:
+            self._flush_now()
+        elif self._timer is None or self._timer.done():
+            self._timer = asyncio.create_task(self._flush_later(config["window"]))
+
+        return await asyncio.shield(entry["future"])
+
+    def _flush_now(self):
+        if self._timer and not self._timer.done():
+            self._timer.cancel()
+        self._timer = None
+        batch, self._pending = self._pending, {}
+        asyncio.create_task(self._run(batch))
+
+    async def _flush_later(self, window: float):
+        try:
+            await asyncio.sleep(window)
+        except asyncio.CancelledError:
+            return
+        self._timer = None
+        batch, self._pending = self._pending, {}
+        await self._run(batch)
+
+    async def _judge_single(self, group_id: str, entry: Dict[str, Any]):
+        # 批量任务继承的是第一个提交的群的会话，单独判断时按实际的群记账
+        session_scope.set(f"group_{group_id}")
+        try:
+            entry["future"].set_result(await should_reply_in_group(entry["messages"]))
+        except Exception as e:
+            entry["future"].set_exception(e)
+
+    async def _run(self, batch: Dict[str, Dict[str, Any]]):
+        """发出一次批量判断，缺失或解析失败的群逐个回退"""
+        if not batch:
+            return
+        if len(batch) == 1:
+            await self._judge_single(*next(iter(batch.items())))
+            return
+
+        self._stats["batches"] += 1
+        results: Dict[str, bool] = {}
+        # 一次调用覆盖多个群，不记在任何一个群名下
+        session_scope.set(None)
+        try:
+            results = await should_reply_in_groups({group_id: entry["messages"] for group_id, entry in batch.items()})
+        except Exception as e:
+            logger.warning(f"批量判断失败，回退为逐个判断: {e}")
+
+        fallbacks = []
+        for group_id, entry in batch.items():
+            if group_id in results:
+                self._stats["batched"] += 1
+                entry["future"].set_result(results[group_id])
+            else:
+                self._stats["fallbacks"] += 1
+                fallbacks.append(self._judge_single(group_id, entry))
+        if fallbacks:
+            await asyncio.gather(*fallbacks)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取批量判断统计信息"""
+        return {**self._stats, "pending": len(self._pending)}
+
+
+# 全局判断合并器实例
+windowed_judge = WindowedJudge()
+# 全局前置过滤实例
+group_prefilter = GroupPreFilter()
+# 全局批量判断实例
+judgment_batcher = JudgmentBatcher()
@@ -8,9 +8,19 @@ from .config import config
 
 MANAGER_FILE = store.get_plugin_config_file("px_chat_manager.json")
 
+# 可单独指定模型的调用阶段: 阶段 -> 说明
+AI_STAGES = {
+    "judge": "群聊判断",
+    "tool": "工具规划",
+    "summary": "总结提取",
+    "reply": "最终回复",
+}
+
 class ChatManager:
     def __init__(self):
         self._data: Dict[str, Any] = {}
+        # { "阶段": AI配置 }，配置变更时清空
+        self._stage_cache: Dict[str, Dict[str, str]] = {}
         self._load_manager_config()
     
     def _load_manager_config(self):
@@ -66,6 +76,7 @@ class ChatManager:
     
     def _save_manager_config(self):
         """保存管理配置"""
+        self._stage_cache.clear()
         try:
             with open(MANAGER_FILE, "w", encoding="utf-8") as f:
                 json.dump(self._data, f, ensure_ascii=False, indent=2)
@@ -249,6 +260,16 @@ class ChatManager:
                 
                 self._data["ai_configs"].pop(i)
                 
+                # 指定了该配置的阶段恢复为当前聊天配置
+                stages = self._data.get("stage_ai_configs", {})
+                for stage in [key for key, value in stages.items() if value == name]:
+                    del stages[stage]
+                
+                # 从路由候选池中移除
+                routing = self._data.get("provider_routing", {})
+                if name in routing.get("pool", []):
+                    routing["pool"].remove(name)
+                
                 current_chat_index = self._data.get("current_ai_config", 0)
                 if current_chat_index >= i:
                     self._data["current_ai_config"] = max(0, current_chat_index - 1)
@@ -271,6 +292,85 @@ class ChatManager:
                 return True
         return False
     
+    def set_ai_config_limits(self, name: str, rpm: int, tpm: int) -> bool:
+        """设置配置的每分钟请求数和Token数限额，0表示不限"""
+        for config in self.get_ai_configs():
+            if config.get("name") == name:
+                config["rpm"] = rpm
+                config["tpm"] = tpm
+                self._save_manager_config()
+                return True
+        return False
+
+    def set_ai_config_window(self, name: str, context_window: int, completion_reserve: int) -> bool:
+        """设置配置的上下文窗口和为回复预留的Token数，用于发送前预检"""
+        for config in self.get_ai_configs():
+            if config.get("name") == name:
+                config["context_window"] = context_window
+                config["completion_reserve"] = completion_reserve
+                self._save_manager_config()
+                return True
+        return False
+
+    def set_ai_config_prices(self, name: str, prompt: float, completion: float, cached: Optional[float] = None) -> bool:
+        """设置配置的价格表（每百万Token），命中缓存的输入未单独定价时按普通输入计"""
+        for config in self.get_ai_configs():
+            if config.get("name") == name:
+                prices = {"prompt": prompt, "completion": completion}
+                if cached is not None:
+                    prices["cached"] = cached
+                config["prices"] = prices
+                self._save_manager_config()
+                return True
+        return False
+
+    def get_reply_wire_format(self) -> str:
+        """获取回复格式: json 为JSON信封 / delimited 为分隔符分段的纯文本"""
+        return self._data.get("reply_wire_format", "json")
+
+    def set_reply_wire_format(self, reply_format: str) -> bool:
+        """设置回复格式"""
+        if reply_format not in ("json", "delimited"):
+            return False
+        if self._data.get("reply_wire_format", "json") != reply_format:
+            self._data["reply_wire_format"] = reply_format
+            self._save_manager_config()
+            return True
+        return False
+
+    def get_stage_ai_config(self, stage: str) -> Dict[str, str]:
+        """获取指定阶段使用的AI配置，未单独指定时使用当前聊天配置"""
+        cached = self._stage_cache.get(stage)
+        if cached is not None:
+            return cached
+        name = self._data.get("stage_ai_configs", {}).get(stage)
+        config = {}
+        if name:
+            config = next((c for c in self.get_ai_configs() if c.get("name") == name), {})
+        if not config:
+            config = self.get_current_ai_config()
+        self._stage_cache[stage] = config
+        return config
+
+    def get_stage_ai_config_names(self) -> Dict[str, str]:
+        """获取各阶段单独指定的配置名"""
+        return dict(self._data.get("stage_ai_configs", {}))
+
+    def set_stage_ai_config(self, stage: str, name: Optional[str]) -> bool:
+        """为阶段指定AI配置，name为None时恢复为当前聊天配置"""
+        if stage not in AI_STAGES:
+            return False
+        stages = self._data.get("stage_ai_configs", {})
+        if name is None:
+            stages.pop(stage, None)
+        else:
+            if not any(c.get("name") == name for c in self.get_ai_configs()):
+                return False
+            stages[stage] = name
+        self._data["stage_ai_configs"] = stages
+        self._save_manager_config()
+        return True
+
     def get_current_config_index(self) -> int:
         """获取当前配置索引"""
         return self._data.get("current_ai_config", 0)
@@ -355,5 +455,451 @@ class ChatManager:
         """获取当前图片识别配置索引"""
         return self._data.get("current_image_recognition_config", 0)
 
+    # 出站限流配置
+    def get_outbound_rate_limit(self) -> Dict[str, float]:
+        """获取出站消息限流配置（每秒条数与突发上限）"""
+        limit = {
+            "global_rate": 2.0,   # 全局每秒发送条数
+            "global_burst": 5,    # 全局突发上限
+            "group_rate": 0.5,    # 单个会话每秒发送条数
+            "group_burst": 3,     # 单个会话突发上限
+        }
+        limit.update(self._data.get("outbound_rate_limit", {}))
+        return limit
+
+    def set_outbound_rate_limit(self, scope: str, rate: float, burst: int) -> bool:
+        """设置出站消息限流，scope 为 global 或 group"""
+        if scope not in ("global", "group") or rate <= 0 or burst < 1:
+            return False
+        limit = self._data.get("outbound_rate_limit", {})
+        limit[f"{scope}_rate"] = rate
+        limit[f"{scope}_burst"] = burst
+        self._data["outbound_rate_limit"] = limit
+        self._save_manager_config()
+        return True
+
+    def get_group_send_weight(self, group_id: str) -> float:
+        """获取群聊出站发送权重，权重越大分到的发送份额越多"""
+        return self._data.get("outbound_group_weights", {}).get(group_id, 1.0)
+
+    def set_group_send_weight(self, group_id: str, weight: float) -> bool:
+        """设置群聊出站发送权重"""
+        if weight <= 0:
+            return False
+        weights = self._data.get("outbound_group_weights", {})
+        if weights.get(group_id, 1.0) == weight:
+            return False
+        weights[group_id] = weight
+        self._data["outbound_group_weights"] = weights
+        self._save_manager_config()
+        return True
+
+    # 私聊防抖配置
+    def is_private_debounce_enabled(self) -> bool:
+        """检查私聊连发合并是否启用"""
+        return self._data.get("private_debounce_enabled", False)
+
+    def set_private_debounce_enabled(self, enabled: bool) -> bool:
+        """设置私聊连发合并开关"""
+        if self._data.get("private_debounce_enabled", False) != enabled:
+            self._data["private_debounce_enabled"] = enabled
+            self._save_manager_config()
+            return True
+        return False
+
+    def get_private_debounce_window(self) -> Dict[str, float]:
+        """获取私聊防抖窗口配置（秒）"""
+        window = {
+            "base": 1.5,  # 没有打字节奏数据时的默认等待时间
+            "min": 0.8,   # 自适应窗口下限
+            "max": 5.0,   # 自适应窗口上限
+        }
+        window.update(self._data.get("private_debounce_window", {}))
+        return window
+
+    def set_private_debounce_window(self, base: float, min_window: float = None, max_window: float = None) -> bool:
+        """设置私聊防抖窗口"""
+        window = self.get_private_debounce_window()
+        window["base"] = base
+        if min_window is not None:
+            window["min"] = min_window
+        if max_window is not None:
+            window["max"] = max_window
+        if not 0 < window["min"] <= window["base"] <= window["max"]:
+            return False
+        self._data["private_debounce_window"] = window
+        self._save_manager_config()
+        return True
+
+    # 群聊回复判断窗口配置
+    def is_group_judge_window_enabled(self) -> bool:
+        """群聊回复判断合并窗口是否开启，关闭时每条消息立即判断"""
+        return self._data.get("group_judge_window_enabled", False)
+
+    def set_group_judge_window_enabled(self, enabled: bool) -> bool:
+        """设置群聊回复判断合并窗口开关"""
+        if self._data.get("group_judge_window_enabled", False) != enabled:
+            self._data["group_judge_window_enabled"] = enabled
+            self._save_manager_config()
+            return True
+        return False
+
+    def get_group_judge_window(self) -> Dict[str, float]:
+        """获取群聊回复判断的合并窗口配置"""
+        window = {
+            "interval": 3.0,      # 窗口时长（秒）
+            "max_messages": 5,    # 窗口内消息数达到该值时立即判断
+            "max_per_minute": 6,  # 每个群每分钟最多判断次数
+        }
+        window.update(self._data.get("group_judge_window", {}))
+        return window
+
+    def set_group_judge_window(self, interval: float, max_messages: int, max_per_minute: int) -> bool:
+        """设置群聊回复判断的合并窗口"""
+        if interval < 0 or max_messages < 1 or max_per_minute < 1:
+            return False
+        self._data["group_judge_window"] = {
+            "interval": interval,
+            "max_messages": max_messages,
+            "max_per_minute": max_per_minute,
+        }
+        self._save_manager_config()
+        return True
+
+    # 群聊判断前置过滤配置
+    def get_group_prefilter(self) -> Dict[str, Any]:
+        """获取群聊回复判断的本地前置过滤规则"""
+        prefilter = {
+            "enabled": False,
+            "bot_names": ["px"],    # 在开头称呼或作为独立的词提到这些名字时直接回复
+            "min_length": 2,        # 去掉空白后短于该长度的消息不回复
+            "cooldown": 20,         # 刚回复过的群在该秒数内不主动参与
+            "question_yes": False,  # 识别为提问（问号或"吗"结尾）时直接回复
+            "yes_patterns": [],     # 命中时直接回复的正则
+            "no_patterns": [        # 命中时直接不回复的正则
+                r"^(哈|h|嘿|呵|嘻)+$",
+                r"^[6６]+$",
+                r"^(草|笑死|确实|好的?|嗯+|哦+|噢+|ok|OK)$",
+                r"^[\W_]+$",
+            ],
+        }
+        prefilter.update(self._data.get("group_prefilter", {}))
+        return prefilter
+
+    def update_group_prefilter(self, **changes) -> bool:
+        """更新群聊前置过滤规则中的部分字段"""
+        prefilter = self._data.get("group_prefilter", {})
+        current = self.get_group_prefilter()
+        if all(current.get(k) == v for k, v in changes.items()):
+            return False
+        prefilter.update(changes)
+        self._data["group_prefilter"] = prefilter
+        self._save_manager_config()
+        return True
+
+    # 本地判断模型配置
+    def get_judge_classifier_mode(self) -> str:
+        """获取本地判断模型模式: off 仅收集样本 / gate 高置信度时代替AI判断 / replace 完全代替AI判断"""
+        return self._data.get("judge_classifier_mode", "off")
+
+    def set_judge_classifier_mode(self, mode: str) -> bool:
+        """设置本地判断模型模式"""
+        if mode not in ("off", "gate", "replace"):
+            return False
+        if self._data.get("judge_classifier_mode", "off") != mode:
+            self._data["judge_classifier_mode"] = mode
+            self._save_manager_config()
+            return True
+        return False
+
+    def get_judge_classifier_threshold(self) -> float:
+        """获取本地判断模型的置信度阈值"""
+        return self._data.get("judge_classifier_threshold", 0.85)
+
+    def set_judge_classifier_threshold(self, threshold: float) -> bool:
+        """设置本地判断模型的置信度阈值"""
+        if not 0.5 <= threshold <= 1:
+            return False
+        if self._data.get("judge_classifier_threshold", 0.85) != threshold:
+            self._data["judge_classifier_threshold"] = threshold
+            self._save_manager_config()
+            return True
+        return False
+
+    # 推测式回复配置
+    def get_speculative_reply(self) -> Dict[str, Any]:
+        """获取推测式回复配置：判断的同时提前生成回复"""
+        speculative = {
+            "enabled": False,
+            "min_reply_rate": 0.5,   # 群内最近判断为需要回复的比例达到该值才推测
+            "min_samples": 5,        # 计算回复比例所需的最少判断次数
+        }
+        speculative.update(self._data.get("speculative_reply", {}))
+        return speculative
+
+    def update_speculative_reply(self, **changes) -> bool:
+        """更新推测式回复配置中的部分字段"""
+        speculative = self._data.get("speculative_reply", {})
+        current = self.get_speculative_reply()
+        if all(current.get(k) == v for k, v in changes.items()):
+            return False
+        speculative.update(changes)
+        self._data["speculative_reply"] = speculative
+        self._save_manager_config()
+        return True
+
+    # 群聊判断流程
+    def get_group_judge_mode(self) -> str:
+        """获取群聊主动参与的判断流程: two_step 先判断再回复 / fused 回复调用中同时判断"""
+        return self._data.get("group_judge_mode", "two_step")
+
+    def set_group_judge_mode(self, mode: str) -> bool:
+        """设置群聊主动参与的判断流程"""
+        if mode not in ("two_step", "fused"):
+            return False
+        if self._data.get("group_judge_mode", "two_step") != mode:
+            self._data["group_judge_mode"] = mode
+            self._save_manager_config()
+            return True
+        return False
+
+    # 跨群批量判断配置
+    def get_group_judge_batch(self) -> Dict[str, Any]:
+        """获取跨群批量判断配置"""
+        batch = {
+            "enabled": False,
+            "window": 0.5,      # 收集其他群判断请求的等待时间（秒）
+            "max_groups": 8,    # 单次请求最多包含的群数
+        }
+        batch.update(self._data.get("group_judge_batch", {}))
+        return batch
+
+    def update_group_judge_batch(self, **changes) -> bool:
+        """更新跨群批量判断配置中的部分字段"""
+        batch = self._data.get("group_judge_batch", {})
+        current = self.get_group_judge_batch()
+        if all(current.get(k) == v for k, v in changes.items()):
+            return False
+        batch.update(changes)
+        self._data["group_judge_batch"] = batch
+        self._save_manager_config()
+        return True
+
+    # 多服务商路由配置
+    def get_provider_routing(self) -> Dict[str, Any]:
+        """获取多服务商路由与故障切换配置"""
+        routing = {
+            "enabled": False,
+            "pool": [],              # 可互相替代的配置名
+            "timeout": 60.0,         # 单次调用超时（秒），超时后切换到下一个配置
+            "failure_threshold": 3,  # 连续失败多少次后暂停使用该配置
+            "cooldown": 60.0,        # 暂停使用的时长（秒）
+            "slow_factor": 2.0,      # 阶段配置延迟超过最健康候选的倍数时改用候选
+            "retry_attempts": 2,     # 所有候选都遇到临时错误时的退避重试轮数
+            "retry_base_delay": 1.0, # 首次退避时间（秒），之后逐轮翻倍并加随机抖动
+            "retry_deadline": 30.0,  # 重试的总时限（秒），超出后不再重试
+        }
+        routing.update(self._data.get("provider_routing", {}))
+        return routing
+
+    def update_provider_routing(self, **changes) -> bool:
+        """更新多服务商路由配置中的部分字段"""
+        routing = self._data.get("provider_routing", {})
+        current = self.get_provider_routing()
+        if all(current.get(k) == v for k, v in changes.items()):
+            return False
+        routing.update(changes)
+        self._data["provider_routing"] = routing
+        self._save_manager_config()
+        return True
+
+    # 对冲请求配置
+    def get_request_hedging(self) -> Dict[str, Any]:
+        """获取对冲请求配置"""
+        hedging = {
+            "enabled": False,
+            "percentile": 0.95,   # 首选配置超过最近延迟的该分位数仍未返回时发出对冲请求
+            "min_delay": 1.0,     # 对冲前至少等待的时间（秒）
+            "max_ratio": 0.1,     # 对冲请求占全部调用的比例上限
+        }
+        hedging.update(self._data.get("request_hedging", {}))
+        return hedging
+
+    def update_request_hedging(self, **changes) -> bool:
+        """更新对冲请求配置中的部分字段"""
+        hedging = self._data.get("request_hedging", {})
+        current = self.get_request_hedging()
+        if all(current.get(k) == v for k, v in changes.items()):
+            return False
+        hedging.update(changes)
+        self._data["request_hedging"] = hedging
+        self._save_manager_config()
+        return True
+
+    # 调用准入控制配置
+    def get_admission_control(self) -> Dict[str, Any]:
+        """获取LLM调用准入控制配置"""
+        admission = {
+            "enabled": False,
+            "max_concurrency": 4,   # 每个配置同时进行的调用数
+            "max_queue": 20,        # 每个配置最多排队的调用数，超出时丢弃最低优先级
+        }
+        admission.update(self._data.get("admission_control", {}))
+        return admission
+
+    def update_admission_control(self, **changes) -> bool:
+        """更新调用准入控制配置中的部分字段"""
+        admission = self._data.get("admission_control", {})
+        current = self.get_admission_control()
+        if all(current.get(k) == v for k, v in changes.items()):
+            return False
+        admission.update(changes)
+        self._data["admission_control"] = admission
+        self._save_manager_config()
+        return True
+
+    # 回复缓存配置
+    def get_response_cache(self) -> Dict[str, Any]:
+        """获取回复精确缓存配置"""
+        cache = {
+            "enabled": False,
+            "ttl": 3600.0,        # 缓存有效期（秒）
+            "max_entries": 512,   # 最多缓存的回复数
+            "last_n": 1,          # 参与缓存键计算的最近消息数
+        }
+        cache.update(self._data.get("response_cache", {}))
+        return cache
+
+    def update_response_cache(self, **changes) -> bool:
+        """更新回复缓存配置中的部分字段"""
+        cache = self._data.get("response_cache", {})
+        current = self.get_response_cache()
+        if all(current.get(k) == v for k, v in changes.items()):
+            return False
+        cache.update(changes)
+        self._data["response_cache"] = cache
+        self._save_manager_config()
+        return True
+
+    # 语义缓存配置
+    def get_semantic_cache(self) -> Dict[str, Any]:
+        """获取语义回复缓存配置"""
+        cache = {
+            "enabled": False,
+            "threshold": 0.85,    # 复用回答所需的最低余弦相似度
+            "ttl": 1800.0,        # 缓存有效期（秒）
+            "max_entries": 200,   # 每个会话最多缓存的问答数
+            "min_length": 4,      # 参与缓存的问题最少字数，太短的问题依赖上下文
+        }
+        cache.update(self._data.get("semantic_cache", {}))
+        return cache
+
+    def update_semantic_cache(self, **changes) -> bool:
+        """更新语义缓存配置中的部分字段"""
+        cache = self._data.get("semantic_cache", {})
+        current = self.get_semantic_cache()
+        if all(current.get(k) == v for k, v in changes.items()):
+            return False
+        cache.update(changes)
+        self._data["semantic_cache"] = cache
+        self._save_manager_config()
+        return True
+
+    def get_long_term_memory(self) -> Dict[str, Any]:
+        """获取用户长期记忆配置"""
+        memory = {
+            "enabled": False,
+            "top_k": 3,             # 每次最多注入的记忆条数
+            "token_budget": 150,    # 注入记忆的Token预算
+            "min_similarity": 0.15, # 注入记忆所需的最低相似度
+            "extract_every": 6,     # 每个用户攒够多少条消息提取一次记忆
+            "max_per_user": 50,     # 每个用户最多保留的记忆条数
+        }
+        memory.update(self._data.get("long_term_memory", {}))
+        return memory
+
+    def update_long_term_memory(self, **changes) -> bool:
+        """更新用户长期记忆配置中的部分字段"""
+        memory = self._data.get("long_term_memory", {})
+        current = self.get_long_term_memory()
+        if all(current.get(k) == v for k, v in changes.items()):
+            return False
+        memory.update(changes)
+        self._data["long_term_memory"] = memory
+        self._save_manager_config()
+        return True
+
+    def get_thread_context(self) -> Dict[str, Any]:
+        """获取群聊回复链上下文配置"""
+        thread = {
+            "enabled": False,
+            "token_budget": 1500,  # 群聊回复使用的上下文Token预算
+            "recent_turns": 4,     # 优先保留发送者和被@用户最近的发言条数
+        }
+        thread.update(self._data.get("thread_context", {}))
+        return thread
+
+    def update_thread_context(self, **changes) -> bool:
+        """更新群聊回复链上下文配置中的部分字段"""
+        thread = self._data.get("thread_context", {})
+        current = self.get_thread_context()
+        if all(current.get(k) == v for k, v in changes.items()):
+            return False
+        thread.update(changes)
+        self._data["thread_context"] = thread
+        self._save_manager_config()
+        return True
+
+    def get_context_compaction(self) -> Dict[str, Any]:
+        """获取上下文压缩配置"""
+        compaction = {
+            "enabled": False,
+            "max_chars": 600,      # 单条消息最多保留的字数
+            "caption_turns": 4,    # 识图结果完整保留的轮数（之后的消息条数）
+            "caption_chars": 30,   # 识图结果缩短后的摘要字数
+        }
+        compaction.update(self._data.get("context_compaction", {}))
+        return compaction
+
+    def update_context_compaction(self, **changes) -> bool:
+        """更新上下文压缩配置中的部分字段"""
+        compaction = self._data.get("context_compaction", {})
+        current = self.get_context_compaction()
+        if all(current.get(k) == v for k, v in changes.items()):
+            return False
+        compaction.update(changes)
+        self._data["context_compaction"] = compaction
+        self._save_manager_config()
+        return True
+
+    def get_usage_quota(self) -> Dict[str, Any]:
+        """获取群聊每日Token配额配置"""
+        quota = {
+            "action": "downgrade",  # 超出配额时主动参与的处理方式: downgrade 降级 / skip 跳过
+            "groups": {},           # { "群号": 每日Token上限 }，未列出的群不限
+        }
+        quota.update(self._data.get("usage_quota", {}))
+        return quota
+
+    def update_usage_quota(self, **changes) -> bool:
+        """更新群聊每日Token配额配置中的部分字段"""
+        quota = self._data.get("usage_quota", {})
+        current = self.get_usage_quota()
+        if all(current.get(k) == v for k, v in changes.items()):
+            return False
+        quota.update(changes)
+        self._data["usage_quota"] = quota
+        self._save_manager_config()
+        return True
+
+    def set_group_usage_quota(self, group_id: str, daily_tokens: int) -> bool:
+        """设置群聊的每日Token上限，0表示取消配额"""
+        groups = dict(self.get_usage_quota()["groups"])
+        if daily_tokens > 0:
+            groups[group_id] = daily_tokens
+        elif groups.pop(group_id, None) is None:
+            return False
+        return self.update_usage_quota(groups=groups)
+
 # 全局管理器实例
 chat_manager = ChatManager()
\ No newline at end of file
@@ -0,0 +1,222 @@
+import asyncio
+import json
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional, Set
+import numpy as np
+from nonebot import logger
+import nonebot_plugin_localstore as store
+from .manager import chat_manager
+from .chat import record_usage
+from .router import provider_router
+from .scheduler import request_priority, PRIORITY_AMBIENT
+from .tokens import estimate_tokens
+from .vectorizer import HashingVectorizer
+
+MEMORY_DB = store.get_plugin_data_file("px_chat_memory.db")
+# 注入提示词中的记忆块标题
+MEMORY_HEADER = "关于当前用户你记得以下信息（仅供参考，不要刻意提起）:"
+# 相似度超过该值的新记忆视为已有记忆的更新
+MERGE_THRESHOLD = 0.9
+
+EXTRACT_PROMPT = (
+    "从下面同一位用户的聊天消息中提取值得长期记住的关于该用户的事实，"
+    "如称呼、身份、喜好、经历、计划等，每条一句话，使用第三人称\"用户\"描述；"
+    "闲聊、提问和一次性的内容不要提取。"
+    "只输出JSON: {\"facts\": [\"...\"]}，没有值得记住的内容时输出 {\"facts\": []}"
+)
+
+
+class MemoryStore:
+    """
+    用户长期记忆：定期从用户的消息中异步提取事实，
+    元数据存放在SQLite中，向量由离线向量化器计算后按用户缓存为NumPy矩阵，
+    回复时按与最新消息的相似度取前几条，在Token预算内注入提示词
+    """
+
+    def __init__(self, dim: int = 1 << 12):
+        self._vectorizer = HashingVectorizer(dim=dim)
+        self._db = sqlite3.connect(MEMORY_DB)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS memories ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, content TEXT NOT NULL, "
+            "created REAL NOT NULL, last_used REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_memories_user ON memories (user_id)")
+        self._db.commit()
+        # { "用户ID": {"ids": 记忆ID数组, "vectors": 向量矩阵, "contents": 记忆内容} }，首次用到时从数据库加载
+        self._index: Dict[str, Dict[str, Any]] = {}
+        # { "用户ID": 尚未提取的消息 }
+        self._pending: Dict[str, List[str]] = {}
+        self._extracting: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._stats = {
+            "extractions": 0,     # 提取调用次数
+            "failures": 0,        # 提取失败次数
+            "added": 0,           # 新增记忆数
+            "merged": 0,          # 与已有记忆合并的次数
+            "recalls": 0,         # 检索次数
+            "recalled": 0,        # 检索到并注入的记忆条数
+            "injected_tokens": 0, # 注入提示词的预估Token数
+        }
+
+    def _load(self, user_id: str) -> Dict[str, Any]:
+        index = self._index.get(user_id)
+        if index is None:
+            rows = self._db.execute("SELECT id, content FROM memories WHERE user_id = ? ORDER BY id", (user_id,)).fetchall()
+            index = {
+                "ids": np.array([row[0] for row in rows], dtype=np.int64),
+                "vectors": np.array([self._vectorizer.transform_dense(row[1]) for row in rows], dtype=np.float32).reshape(len(rows), self._vectorizer.dim),
+                "contents": [row[1] for row in rows],
+            }
+            self._index[user_id] = index
+        return index
+
+    def observe(self, user_id: str, content: str):
+        """记录一条用户消息，攒够条数后在后台提取记忆"""
+        config = chat_manager.get_long_term_memory()
+        if not config["enabled"] or not content.strip():
+            return
+        pending = self._pending.setdefault(user_id, [])
+        pending.append(content.strip())
+        if len(pending) < config["extract_every"] or user_id in self._extracting:
+            return
+        self._pending[user_id] = []
+        self._extracting.add(user_id)
+        task = asyncio.create_task(self._extract(user_id, pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _extract(self, user_id: str, lines: List[str]):
+        """调用总结阶段的模型提取事实并写入记忆"""
+        # 提取不影响当前回复，按低优先级排队
+        request_priority.set(PRIORITY_AMBIENT)
+        self._stats["extractions"] += 1
+        try:
+            response = await provider_router.create(
+                "summary",
+                messages=[
+                    {"role": "system", "content": EXTRACT_PROMPT},
+                    {"role": "user", "content": "\n".join(lines)},
+                ],
+                response_format={"type": "json_object"},
+                max_tokens=256,
+            )
+            record_usage("记忆提取", response)
+            facts = json.loads(response.choices[0].message.content or "{}").get("facts", [])
+            for fact in facts:
+                if isinstance(fact, str) and fact.strip():
+                    self.add(user_id, fact.strip())
+        except Exception as e:
+            self._stats["failures"] += 1
+            logger.warning(f"用户 {user_id} 的记忆提取失败: {e}")
+        finally:
+            self._extracting.discard(user_id)
+
+    def add(self, user_id: str, content: str):
+        """写入一条记忆，与已有记忆高度相似时更新原记忆，超出上限时淘汰最久未用到的记忆"""
+        index = self._load(user_id)
+        vector = self._vectorizer.transform_dense(content)
+        now = time.time()
+        if len(index["contents"]):
+            similarities = index["vectors"] @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] >= MERGE_THRESHOLD:
+                self._db.execute("UPDATE memories SET content = ?, last_used = ? WHERE id = ?", (content, now, int(index["ids"][best])))
+                self._db.commit()
+                index["vectors"][best] = vector
+                index["contents"][best] = content
+                self._stats["merged"] += 1
+                return
+
+        cursor = self._db.execute(
+            "INSERT INTO memories (user_id, content, created, last_used) VALUES (?, ?, ?, ?)", (user_id, content, now, now)
+        )
+        index["ids"] = np.append(index["ids"], cursor.lastrowid)
+        index["vectors"] = np.vstack([index["vectors"], vector[np.newaxis, :]])
+        index["contents"].append(content)
+        self._stats["added"] += 1
+
+        overflow = len(index["contents"]) - chat_manager.get_long_term_memory()["max_per_user"]
+        if overflow > 0:
+            stale = [row[0] for row in self._db.execute(
+                "SELECT id FROM memories WHERE user_id = ? ORDER BY last_used LIMIT ?", (user_id, overflow)
+            )]
+            self._db.executemany("DELETE FROM memories WHERE id = ?", [(memory_id,) for memory_id in stale])
+            keep = ~np.isin(index["ids"], stale)
+            index["ids"] = index["ids"][keep]
+            index["vectors"] = index["vectors"][keep]
+            index["contents"] = [memory for memory, kept in zip(index["contents"], keep) if kept]
+        self._db.commit()
+
+    def recall(self, user_id: str, query: str) -> Optional[str]:
+        """
+        检索与查询相关的记忆，按相似度从高到低在Token预算内拼成记忆块
+        :return: 记忆块文本，没有相关记忆时返回None
+        """
+        config = chat_manager.get_long_term_memory()
+        if not config["enabled"]:
+            return None
+        index = self._load(user_id)
+        if not len(index["contents"]):
+            return None
+        self._stats["recalls"] += 1
+
+        similarities = index["vectors"] @ self._vectorizer.transform_dense(query)
+        budget = config["token_budget"] - estimate_tokens(MEMORY_HEADER)
+        selected = []
+        for i in np.argsort(-similarities)[:config["top_k"]]:
+            if similarities[i] < config["min_similarity"]:
+                break
+            line = f"- {index['contents'][i]}"
+            cost = estimate_tokens(line)
+            if cost > budget:
+                break
+            budget -= cost
+            selected.append((int(i), line))
+        if not selected:
+            return None
+
+        now = time.time()
+        self._db.executemany(
+            "UPDATE memories SET last_used = ?, hits = hits + 1 WHERE id = ?",
+            [(now, int(index["ids"][i])) for i, _ in selected],
+        )
+        self._db.commit()
+        block = "\n".join([MEMORY_HEADER] + [line for _, line in selected])
+        self._stats["recalled"] += len(selected)
+        self._stats["injected_tokens"] += estimate_tokens(block)
+        return block
+
+    def with_memory(self, user_id: str, messages: list) -> list:
+        """
+        返回注入了相关记忆的消息副本，记忆作为系统消息放在最新一条消息之前，
+        不影响前面历史的前缀缓存，也不写入上下文
+        """
+        if not messages:
+            return messages
+        block = self.recall(user_id, str(messages[-1].get("content", "")))
+        if block is None:
+            return messages
+        return messages[:-1] + [{"role": "system", "content": block}, messages[-1]]
+
+    def get_memories(self, user_id: str) -> List[str]:
+        """列出用户的全部记忆"""
+        return list(self._load(user_id)["contents"])
+
+    def clear(self, user_id: str) -> int:
+        """清除用户的全部记忆，返回清除的条数"""
+        count = self._db.execute("DELETE FROM memories WHERE user_id = ?", (user_id,)).rowcount
+        self._db.commit()
+        self._index.pop(user_id, None)
+        self._pending.pop(user_id, None)
+        return count
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取长期记忆统计信息"""
+        users, total = self._db.execute("SELECT COUNT(DISTINCT user_id), COUNT(*) FROM memories").fetchone()
+        return {**self._stats, "users": users, "memories": total}
+
+
+# 全局长期记忆实例
+memory_store = MemoryStore()
@@ -0,0 +1,324 @@
+import asyncio
+import itertools
+import random
+import time
+from typing import Any, Dict, List, Optional
+from nonebot import logger
+from .manager import chat_manager
+
+
+class TokenBucket:
+    """令牌桶：按固定速率补充令牌，容量即允许的突发量"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def configure(self, rate: float, capacity: float):
+        """更新速率和容量，保留当前令牌数"""
+        self._refill()
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = min(self._tokens, capacity)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def available(self, amount: float = 1) -> bool:
+        """是否有足够令牌"""
+        self._refill()
+        return self._tokens >= amount
+
+    def take(self, amount: float = 1) -> bool:
+        """尝试取出令牌，不足时不扣除"""
+        self._refill()
+        if self._tokens >= amount:
+            self._tokens -= amount
+            return True
+        return False
+
+    def time_until(self, amount: float = 1) -> float:
+        """距离攒够令牌还需要的秒数"""
+        self._refill()
+        if self._tokens >= amount:
+            return 0.0
+        return (amount - self._tokens) / self.rate
+
+    def debit(self, amount: float):
+        """直接扣除令牌（可为负数以退还），允许透支，透支部分按速率慢慢补回"""
+        self._refill()
+        self._tokens = min(self.capacity, self._tokens - amount)
+
+
+class OutboundRateLimiter:
+    """
+    OneBot出站调用限流器
+    全局令牌桶限制总发送速率，每个会话另有令牌桶限制单群速率；
+    排队时按加权公平队列（虚拟完成时间）在会话间轮转，活跃群不会饿死其他群
+    """
+
+    def __init__(self):
+        limit = chat_manager.get_outbound_rate_limit()
+        self._global = TokenBucket(limit["global_rate"], limit["global_burst"])
+        self._buckets: Dict[str, TokenBucket] = {}
+        # 等待中的请求: {"finish": 虚拟完成时间, "seq": 序号, "key": 会话key, "future": Future}
+        self._waiters: List[Dict[str, Any]] = []
+        self._last_finish: Dict[str, float] = {}
+        self._virtual_time = 0.0
+        self._seq = itertools.count()
+        self._scheduler: Optional[asyncio.Task] = None
+        # 关闭后不再限流，让调度器能尽快发完剩余消息
+        self._closing = False
+        self._stats = {
+            "granted": 0,       # 放行的调用数
+            "throttled": 0,     # 需要排队的调用数
+            "delay_total": 0.0, # 累计排队时间（秒）
+            "delay_max": 0.0,   # 最长排队时间（秒）
+        }
+        self._throttled_by_key: Dict[str, int] = {}
+
+    def _sync_config(self):
+        """从管理器同步限流配置，支持运行时修改"""
+        limit = chat_manager.get_outbound_rate_limit()
+        if (self._global.rate, self._global.capacity) != (limit["global_rate"], limit["global_burst"]):
+            self._global.configure(limit["global_rate"], limit["global_burst"])
+        for bucket in self._buckets.values():
+            if (bucket.rate, bucket.capacity) != (limit["group_rate"], limit["group_burst"]):
+                bucket.configure(limit["group_rate"], limit["group_burst"])
+
+    def _bucket(self, key: str) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            limit = chat_manager.get_outbound_rate_limit()
+            bucket = TokenBucket(limit["group_rate"], limit["group_burst"])
+            self._buckets[key] = bucket
+        return bucket
+
+    def _weight(self, key: str) -> float:
+        if key.startswith("group_"):
+            return chat_manager.get_group_send_weight(key[len("group_"):])
+        return 1.0
+
+    async def acquire(self, key: str):
+        """
+        获取一次发送许可，必要时排队等待
+        :param key: 会话key，群聊为 group_{群号}，私聊为QQ号
+        """
+        if self._closing:
+            return
+        self._sync_config()
+        bucket = self._bucket(key)
+
+        # 没有排队者时直接放行
+        if not self._waiters and self._global.available() and bucket.available():
+            self._global.take()
+            bucket.take()
+            self._stats["granted"] += 1
+            return
+
+        # 计算虚拟完成时间，权重越大推进越慢
+        finish = max(self._virtual_time, self._last_finish.get(key, 0.0)) + 1.0 / self._weight(key)
+        self._last_finish[key] = finish
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append({"finish": finish, "seq": next(self._seq), "key": key, "future": future})
+        self._stats["throttled"] += 1
+        self._throttled_by_key[key] = self._throttled_by_key.get(key, 0) + 1
+
+        if self._scheduler is None or self._scheduler.done():
+            self._scheduler = asyncio.create_task(self._schedule())
+
+        started = time.monotonic()
+        try:
+            await future
+        finally:
+            waited = time.monotonic() - started
+            self._stats["delay_total"] += waited
+            self._stats["delay_max"] = max(self._stats["delay_max"], waited)
+
+    async def _schedule(self):
+        """按虚拟完成时间依次放行排队的请求"""
+        try:
+            while self._waiters:
+                # 清理已取消的等待者
+                self._waiters = [w for w in self._waiters if not w["future"].done()]
+                if not self._waiters:
+                    break
+
+                wait = self._global.time_until()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+
+                # 选出虚拟完成时间最小、且所在会话还有令牌的请求
+                self._waiters.sort(key=lambda w: (w["finish"], w["seq"]))
+                chosen = None
+                for waiter in self._waiters:
+                    if self._buckets[waiter["key"]].available():
+                        chosen = waiter
+                        break
+
+                if chosen is None:
+                    # 所有排队会话都达到单群上限，等最早恢复的那个
+                    await asyncio.sleep(min(self._buckets[w["key"]].time_until() for w in self._waiters))
+                    continue
+
+                self._global.take()
+                self._buckets[chosen["key"]].take()
+                self._waiters.remove(chosen)
+                self._virtual_time = chosen["finish"]
+                self._stats["granted"] += 1
+                chosen["future"].set_result(None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"出站限流调度异常: {e}")
+            # 出错时放行所有等待者，避免消息永久卡住
+            for waiter in self._waiters:
+                if not waiter["future"].done():
+                    waiter["future"].set_result(None)
+            self._waiters.clear()
+        finally:
+            if not self._waiters:
+                # 空闲时重置虚拟时间，避免无限增长
+                self._virtual_time = 0.0
+                self._last_finish.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取限流统计信息"""
+        throttled = self._stats["throttled"]
+        top_keys = sorted(self._throttled_by_key.items(), key=lambda item: item[1], reverse=True)[:3]
+        return {
+            **self._stats,
+            "waiting": len(self._waiters),
+            "delay_avg": self._stats["delay_total"] / throttled if throttled else 0.0,
+            "top_throttled": top_keys,
+        }
+
+    async def shutdown(self):
+        """放行所有等待者并停止调度，之后的发送不再限流"""
+        self._closing = True
+        for waiter in self._waiters:
+            if not waiter["future"].done():
+                waiter["future"].set_result(None)
+        self._waiters.clear()
+        if self._scheduler and not self._scheduler.done():
+            self._scheduler.cancel()
+
+
+class ProviderRateLimiter:
+    """
+    服务商调用限流：按AI配置中的每分钟请求数(rpm)和Token数(tpm)在发送前排队，
+    收到429时按 Retry-After 暂停该配置的所有调用，把突发平滑为排队延迟
+    """
+
+    # 令牌桶容量为每分钟额度的比例，即允许的突发量
+    BURST_RATIO = 0.25
+
+    def __init__(self):
+        # { "配置名": (请求令牌桶, Token令牌桶) }，未设置的限额为None
+        self._buckets: Dict[str, Dict[str, Optional[TokenBucket]]] = {}
+        # { "配置名": 暂停到的时间 }
+        self._blocked_until: Dict[str, float] = {}
+        # { "配置名": 锁 }，同一配置的等待者按到达顺序放行
+        self._locks: Dict[str, asyncio.Lock] = {}
+        # { "配置名": 统计 }
+        self._stats: Dict[str, Dict[str, Any]] = {}
+
+    def _provider_stats(self, name: str) -> Dict[str, Any]:
+        return self._stats.setdefault(name, {"throttled": 0, "delay_total": 0.0, "rate_limited": 0, "retries": 0})
+
+    def _sync_bucket(self, buckets: Dict[str, Optional[TokenBucket]], kind: str, per_minute: float):
+        """按配置创建或更新令牌桶，限额为0表示不限"""
+        if not per_minute or per_minute <= 0:
+            buckets[kind] = None
+            return
+        rate, capacity = per_minute / 60, max(1.0, per_minute * self.BURST_RATIO)
+        bucket = buckets.get(kind)
+        if bucket is None:
+            buckets[kind] = TokenBucket(rate, capacity)
+        elif (bucket.rate, bucket.capacity) != (rate, capacity):
+            bucket.configure(rate, capacity)
+
+    def _buckets_for(self, ai_config: Dict[str, Any]) -> Dict[str, Optional[TokenBucket]]:
+        buckets = self._buckets.setdefault(ai_config.get("name", ""), {})
+        self._sync_bucket(buckets, "requests", ai_config.get("rpm", 0))
+        self._sync_bucket(buckets, "tokens", ai_config.get("tpm", 0))
+        return buckets
+
+    def _wait_time(self, name: str, buckets: Dict[str, Optional[TokenBucket]], tokens: int) -> float:
+        wait = self._blocked_until.get(name, 0.0) - time.monotonic()
+        if buckets["requests"]:
+            wait = max(wait, buckets["requests"].time_until(1))
+        if buckets["tokens"]:
+            # 超过桶容量的大请求只需等桶满即可放行
+            wait = max(wait, buckets["tokens"].time_until(min(tokens, buckets["tokens"].capacity)))
+        return wait
+
+    async def acquire(self, ai_config: Dict[str, Any], tokens: int):
+        """
+        发送前按限额排队
+        :param ai_config: AI配置
+        :param tokens: 预估的本次请求Token数（提示加补全预留）
+        """
+        name = ai_config.get("name", "")
+        buckets = self._buckets_for(ai_config)
+        if not buckets["requests"] and not buckets["tokens"] and self._blocked_until.get(name, 0.0) <= time.monotonic():
+            return
+
+        lock = self._locks.setdefault(name, asyncio.Lock())
+        started = time.monotonic()
+        async with lock:
+            while True:
+                wait = self._wait_time(name, buckets, tokens)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if buckets["requests"]:
+                buckets["requests"].debit(1)
+            if buckets["tokens"]:
+                buckets["tokens"].debit(tokens)
+
+        waited = time.monotonic() - started
+        if waited > 0.01:
+            stats = self._provider_stats(name)
+            stats["throttled"] += 1
+            stats["delay_total"] += waited
+
+    def settle(self, ai_config: Dict[str, Any], estimated: int, actual: int):
+        """按实际消耗修正Token令牌桶，多退少补"""
+        bucket = self._buckets.get(ai_config.get("name", ""), {}).get("tokens")
+        if bucket and actual:
+            bucket.debit(actual - estimated)
+
+    def block(self, name: str, delay: float):
+        """收到429后暂停该配置的调用，加入随机抖动避免同时恢复"""
+        delay = delay * random.uniform(1.0, 1.25)
+        self._blocked_until[name] = max(self._blocked_until.get(name, 0.0), time.monotonic() + delay)
+        self._provider_stats(name)["rate_limited"] += 1
+        logger.warning(f"配置 {name} 触发服务商限流，暂停 {delay:.1f} 秒")
+        return delay
+
+    def record_retry(self, name: str):
+        self._provider_stats(name)["retries"] += 1
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """获取各配置的限流统计信息"""
+        now = time.monotonic()
+        return {
+            name: {
+                **stats,
+                "delay_avg": stats["delay_total"] / stats["throttled"] if stats["throttled"] else 0.0,
+                "blocked": max(0.0, self._blocked_until.get(name, 0.0) - now),
+            }
+            for name, stats in self._stats.items()
+        }
+
+
+# 全局出站限流器实例
+outbound_limiter = OutboundRateLimiter()
+# 全局服务商限流器实例
+provider_limiter = ProviderRateLimiter()
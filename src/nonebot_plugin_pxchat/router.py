@@ -0,0 +1,342 @@
+import asyncio
+import itertools
+import random
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Deque, Dict, List, Optional
+from openai import AsyncOpenAI, RateLimitError
+from nonebot import logger
+from .manager import chat_manager
+from .scheduler import admission_scheduler, get_priority, AdmissionRejected
+from .ratelimit import provider_limiter
+from .tokens import estimate_request_tokens, fit_request, DEFAULT_CONTEXT_WINDOW, DEFAULT_COMPLETION_BUDGET
+from .errors import error_tracker, is_transient, classify_error, ERROR_TRANSIENT, ERROR_RATE_LIMIT
+from .usage import usage_ledger
+
+# 未指定max_tokens时为补全预留的Token数，用于限流预估
+COMPLETION_RESERVE = 512
+# 收到429后在同一配置上重试的最多次数
+MAX_RATE_LIMIT_RETRIES = 2
+
+# { (api_key, api_url): 客户端 }，复用连接池避免每次请求重新建立连接
+_clients: Dict[tuple, AsyncOpenAI] = {}
+
+def get_client(ai_config: dict) -> AsyncOpenAI:
+    """获取AI配置对应的客户端"""
+    cache_key = (ai_config.get("api_key", ""), ai_config.get("api_url", ""))
+    client = _clients.get(cache_key)
+    if client is None:
+        # 客户端自身不重试，否则SDK会在准入槽位内等待Retry-After且绕过限流统计；
+        # 429由 _call 在槽位外按Retry-After重试，连接错误和5xx由 create 退避重试
+        client = AsyncOpenAI(api_key=cache_key[0], base_url=cache_key[1], max_retries=0)
+        _clients[cache_key] = client
+    return client
+
+def can_fail_over(error: BaseException) -> bool:
+    """
+    是否换下一个配置重试：只有网络、超时、5xx和持续限流这类与配置本身有关的错误才换；
+    请求参数错误、上下文超长等请求本身的问题换配置也同样失败，直接抛出
+    """
+    return classify_error(error) in (ERROR_TRANSIENT, ERROR_RATE_LIMIT)
+
+def retry_after(error: RateLimitError, attempt: int) -> float:
+    """从429响应头读取建议的等待时间，没有时按重试次数指数退避"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    return float(min(30, 2 ** attempt))
+
+
+class ProviderRouter:
+    """
+    多服务商路由：按配置统计平滑延迟和错误率，
+    优先使用阶段指定的配置，慢或不可用时切换到候选池中最健康的配置，出错或超时自动换下一个
+    """
+
+    def __init__(self, alpha: float = 0.2, window: int = 20):
+        # 平滑系数，越大越偏向最近的延迟
+        self._alpha = alpha
+        self._window = window
+        # { "配置名": 健康状态 }
+        self._health: Dict[str, Dict[str, Any]] = {}
+        self._stats = {
+            "requests": 0,    # 路由的调用次数
+            "failovers": 0,   # 切换到其他配置重试的次数
+            "rerouted": 0,    # 因阶段配置慢或不可用，直接使用其他配置的次数
+            "hedged": 0,      # 发出对冲请求的次数
+            "hedge_wins": 0,  # 对冲请求先于首选配置返回的次数
+        }
+
+    def _entry(self, name: str) -> Dict[str, Any]:
+        entry = self._health.get(name)
+        if entry is None:
+            entry = {
+                "ewma": None,           # 平滑后的成功调用延迟（秒）
+                "requests": 0,
+                "errors": 0,
+                "recent": deque(maxlen=self._window),  # 最近调用是否成功
+                "latencies": deque(maxlen=100),        # 最近成功调用的延迟
+                "consecutive_failures": 0,
+                "cooldown_until": 0.0,
+            }
+            self._health[name] = entry
+        return entry
+
+    def record_success(self, name: str, latency: float):
+        entry = self._entry(name)
+        entry["requests"] += 1
+        entry["recent"].append(True)
+        entry["latencies"].append(latency)
+        entry["consecutive_failures"] = 0
+        entry["ewma"] = latency if entry["ewma"] is None else self._alpha * latency + (1 - self._alpha) * entry["ewma"]
+
+    def record_failure(self, name: str):
+        entry = self._entry(name)
+        entry["requests"] += 1
+        entry["errors"] += 1
+        entry["recent"].append(False)
+        entry["consecutive_failures"] += 1
+        config = chat_manager.get_provider_routing()
+        if entry["consecutive_failures"] >= config["failure_threshold"]:
+            entry["cooldown_until"] = time.monotonic() + config["cooldown"]
+            logger.warning(f"配置 {name} 连续失败 {entry['consecutive_failures']} 次，暂停使用 {config['cooldown']} 秒")
+
+    def error_rate(self, name: str) -> float:
+        recent: Deque[bool] = self._entry(name)["recent"]
+        if not recent:
+            return 0.0
+        return 1 - sum(recent) / len(recent)
+
+    def is_available(self, name: str) -> bool:
+        return time.monotonic() >= self._entry(name)["cooldown_until"]
+
+    def latency_percentile(self, name: str, percentile: float) -> Optional[float]:
+        """最近成功调用延迟的分位数，样本不足时返回None"""
+        latencies = sorted(self._entry(name)["latencies"])
+        if len(latencies) < 5:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile))]
+
+    def _score(self, name: str) -> float:
+        """健康评分，越小越好：平滑延迟按错误率加权，没有样本的配置优先试用"""
+        ewma = self._entry(name)["ewma"]
+        if ewma is None:
+            return 0.0
+        return ewma * (1 + 2 * self.error_rate(name))
+
+    def candidates(self, stage: str) -> List[Dict[str, str]]:
+        """
+        获取阶段按优先级排列的候选配置
+        图片识别只使用识别配置，其余阶段在开启路由时追加候选池中的配置
+        """
+        if stage == "image":
+            primary = chat_manager.get_current_image_recognition_config()
+            return [primary] if primary else []
+
+        primary = chat_manager.get_stage_ai_config(stage)
+        config = chat_manager.get_provider_routing()
+        if not config["enabled"]:
+            return [primary] if primary else []
+
+        pool = [c for c in chat_manager.get_ai_configs()
+                if c.get("name") in config["pool"] and c.get("name") != primary.get("name")]
+        pool.sort(key=lambda c: self._score(c["name"]))
+        healthy = [c for c in pool if self.is_available(c["name"])]
+        cooling = [c for c in pool if not self.is_available(c["name"])]
+        if not primary:
+            return healthy + cooling
+
+        # 阶段配置可用且不明显慢于最健康的候选时保持优先
+        primary_name = primary.get("name", "")
+        measured = [c for c in healthy if self._entry(c["name"])["ewma"] is not None]
+        primary_ewma = self._entry(primary_name)["ewma"]
+        slow = (measured and primary_ewma is not None
+                and primary_ewma > config["slow_factor"] * self._score(measured[0]["name"]))
+        if self.is_available(primary_name) and not slow:
+            return [primary] + healthy + cooling
+        self._stats["rerouted"] += 1
+        return healthy + [primary] + cooling
+
+    async def _call(self, stage: str, ai_config: Dict[str, str], params: Dict[str, Any], timeout: Optional[float], priority: int):
+        """
+        向单个配置发起调用并记录健康状态和用量，429时按Retry-After在同一配置上重试
+        排队等待准入和限流的时间不计入延迟，被取消或被准入控制拒绝的调用不计入统计
+        """
+        name = ai_config.get("name", "")
+        # 发送前预检，超出该配置的上下文窗口时先在本地裁剪，避免请求被拒后清空对话
+        window = int(ai_config.get("context_window") or DEFAULT_CONTEXT_WINDOW)
+        reserve = params.get("max_tokens") or int(ai_config.get("completion_reserve") or DEFAULT_COMPLETION_BUDGET)
+        params, trimmed = fit_request(params, window - reserve)
+        if trimmed:
+            error_tracker.record("trimmed")
+            error_tracker.record("trimmed_tokens", trimmed)
+            logger.warning(f"配置 {name} 的请求超出上下文窗口 {window} (预留{reserve})，已裁剪约 {trimmed} Token")
+        estimated = estimate_request_tokens(params) + (params.get("max_tokens") or COMPLETION_RESERVE)
+        for attempt in itertools.count():
+            # 按配置的rpm/tpm排队，收到429后的暂停也在这里等待；都在准入槽位之外，等待时不占用并发名额
+            await provider_limiter.acquire(ai_config, estimated)
+            async with admission_scheduler.slot(name, priority):
+                started = time.monotonic()
+                try:
+                    response = await asyncio.wait_for(
+                        get_client(ai_config).chat.completions.create(model=ai_config.get("model", ""), **params),
+                        timeout,
+                    )
+                except RateLimitError as e:
+                    delay = provider_limiter.block(name, retry_after(e, attempt))
+                    if attempt < MAX_RATE_LIMIT_RETRIES and (timeout is None or delay <= timeout):
+                        provider_limiter.record_retry(name)
+                        continue
+                    self.record_failure(name)
+                    logger.warning(f"配置 {name} 持续限流，放弃重试: {e}")
+                    raise
+                except asyncio.TimeoutError:
+                    self.record_failure(name)
+                    logger.warning(f"配置 {name} 调用超时 ({timeout}秒)")
+                    raise TimeoutError(f"配置 {name} 调用超时 ({timeout}秒)")
+                except Exception as e:
+                    self.record_failure(name)
+                    logger.warning(f"配置 {name} 调用失败: {type(e).__name__} {e}")
+                    raise
+                self.record_success(name, time.monotonic() - started)
+                usage = getattr(response, "usage", None)
+                provider_limiter.settle(ai_config, estimated, getattr(usage, "total_tokens", 0) or 0)
+                usage_ledger.record(ai_config, stage, response)
+                return response
+
+    def _hedge_delay(self, name: str) -> Optional[float]:
+        """对冲等待时间，未开启、样本不足或超出对冲比例上限时返回None"""
+        config = chat_manager.get_request_hedging()
+        if not config["enabled"]:
+            return None
+        if self._stats["hedged"] >= config["max_ratio"] * max(self._stats["requests"], 1):
+            return None
+        threshold = self.latency_percentile(name, config["percentile"])
+        if threshold is None:
+            return None
+        return max(config["min_delay"], threshold)
+
+    async def _hedged(self, stage: str, ai_config: Dict[str, str], remaining: List[Dict[str, str]],
+                      params: Dict[str, Any], timeout: Optional[float], priority: int, delay: float):
+        """
+        首选配置超过等待时间仍未返回时，向下一个候选发出相同请求，
+        取先成功的结果并取消另一个
+        """
+        primary = asyncio.create_task(self._call(stage, ai_config, params, timeout, priority))
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+        if done:
+            return primary.result()
+
+        secondary = remaining.pop(0)
+        self._stats["hedged"] += 1
+        logger.info(f"配置 {ai_config.get('name')} 超过 {delay:.2f}秒 未返回，向 {secondary.get('name')} 发出对冲请求")
+        hedge = asyncio.create_task(self._call(stage, secondary, params, timeout, priority))
+        pending = {primary, hedge}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self._stats["hedge_wins"] += 1
+                        return task.result()
+                    error = task.exception()
+                    if not can_fail_over(error):
+                        raise error
+        finally:
+            for task in pending:
+                task.cancel()
+        raise error
+
+    async def _route(self, stage: str, candidates: List[Dict[str, str]], params: Dict[str, Any],
+                     timeout: Optional[float], priority: int):
+        """按候选顺序尝试一轮调用，失败时切换到下一个候选"""
+        remaining = list(candidates)
+        last_error: Optional[BaseException] = None
+        while remaining:
+            ai_config = remaining.pop(0)
+            if ai_config is not candidates[0]:
+                self._stats["failovers"] += 1
+                logger.warning(f"阶段 {stage} 切换到配置 {ai_config.get('name')} 重试")
+            # 只有首次尝试且还有其他候选时才考虑对冲
+            delay = self._hedge_delay(ai_config.get("name", "")) if ai_config is candidates[0] and remaining else None
+            try:
+                if delay is not None:
+                    return await self._hedged(stage, ai_config, remaining, params, timeout, priority, delay)
+                return await self._call(stage, ai_config, params, timeout, priority)
+            except AdmissionRejected:
+                # 被准入控制丢弃的调用不算故障，也不换配置再排一次队
+                raise
+            except Exception as e:
+                if not can_fail_over(e):
+                    raise
+                last_error = e
+        raise last_error
+
+    async def create(self, stage: str, **params):
+        """
+        按路由顺序发起一次对话补全调用，失败或超时时切换到下一个候选配置；
+        所有候选都遇到临时错误时在时限内退避重试
+        :param stage: 调用阶段，决定首选配置
+        :param params: 除model外的请求参数
+        """
+        candidates = self.candidates(stage)
+        if not candidates:
+            raise Exception("未配置服务，请使用 'px ai add' 命令添加配置")
+
+        self._stats["requests"] += 1
+        config = chat_manager.get_provider_routing()
+        priority = get_priority(stage)
+        deadline = time.monotonic() + config["retry_deadline"]
+        # 未开启路由时没有可切换的配置，保持原来不设超时的行为
+        timeout = config["timeout"] if config["enabled"] else None
+        for attempt in itertools.count():
+            try:
+                response = await self._route(stage, candidates, params, timeout, priority)
+            except Exception as e:
+                if not is_transient(e) or attempt >= config["retry_attempts"]:
+                    raise
+                backoff = config["retry_base_delay"] * (2 ** attempt) * random.uniform(0.5, 1.5)
+                if time.monotonic() + backoff > deadline:
+                    raise
+                error_tracker.record("retries")
+                logger.warning(f"阶段 {stage} 遇到临时错误，{backoff:.1f}秒后第{attempt + 1}次重试: {e}")
+                await asyncio.sleep(backoff)
+                continue
+            if attempt > 0:
+                error_tracker.record("recovered")
+            return response
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取路由统计信息及各配置的健康状态"""
+        now = time.monotonic()
+        providers = {}
+        for name, entry in self._health.items():
+            providers[name] = {
+                "requests": entry["requests"],
+                "errors": entry["errors"],
+                "error_rate": self.error_rate(name),
+                "ewma": entry["ewma"],
+                "p95": self.latency_percentile(name, 0.95),
+                "cooldown": max(0.0, entry["cooldown_until"] - now),
+            }
+        return {**self._stats, "providers": providers}
+
+
+# 全局服务商路由实例
+provider_router = ProviderRouter()
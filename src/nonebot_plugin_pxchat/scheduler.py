@@ -0,0 +1,163 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from nonebot import logger
+from .manager import chat_manager
+
+# 调用优先级，数值越小越优先
+PRIORITY_DIRECT = 0     # 私聊和被@的回复
+PRIORITY_TOOL = 1       # 工具规划
+PRIORITY_AMBIENT = 2    # 群聊主动参与（判断及其回复）
+PRIORITY_IMAGE = 3      # 图片识别
+
+PRIORITY_LABELS = {
+    PRIORITY_DIRECT: "私聊/@",
+    PRIORITY_TOOL: "工具调用",
+    PRIORITY_AMBIENT: "群聊判断",
+    PRIORITY_IMAGE: "图片识别",
+}
+
+# 各阶段的默认优先级
+STAGE_PRIORITIES = {
+    "reply": PRIORITY_DIRECT,
+    "summary": PRIORITY_DIRECT,
+    "tool": PRIORITY_TOOL,
+    "judge": PRIORITY_AMBIENT,
+    "image": PRIORITY_IMAGE,
+}
+
+# 当前调用链的优先级，群聊主动参与的处理器设为 PRIORITY_AMBIENT，其派生的调用都随之降级
+request_priority: ContextVar[int] = ContextVar("request_priority", default=PRIORITY_DIRECT)
+# 当前调用链所属的会话key，语义缓存按它隔离，用量按它记账；不属于任何会话的调用为None
+session_scope: ContextVar[Optional[str]] = ContextVar("session_scope", default=None)
+
+
+def get_priority(stage: str) -> int:
+    """阶段默认优先级与调用链优先级取较低者"""
+    return max(STAGE_PRIORITIES.get(stage, PRIORITY_DIRECT), request_priority.get())
+
+
+class AdmissionRejected(Exception):
+    """排队已满，调用被拒绝或被更高优先级的调用挤出"""
+
+
+class AdmissionScheduler:
+    """
+    LLM调用准入控制：每个配置限制并发数，超出的调用按优先级排队，
+    队列满时优先丢弃最低优先级、最晚到达的调用
+    """
+
+    def __init__(self):
+        # { "配置名": 进行中的调用数 }
+        self._active: Dict[str, int] = {}
+        # { "配置名": [(优先级, 序号, future)] } 小顶堆
+        self._waiters: Dict[str, List[Tuple[int, int, asyncio.Future]]] = {}
+        self._sequence = itertools.count()
+        self._peak_depth = 0
+        # { 优先级: 统计 }
+        self._stats: Dict[int, Dict[str, Any]] = {
+            priority: {"admitted": 0, "shed": 0, "waits": deque(maxlen=200)} for priority in PRIORITY_LABELS
+        }
+
+    def _depth(self) -> int:
+        return sum(len(queue) for queue in self._waiters.values())
+
+    def _shed(self, priority: int, reason: str):
+        self._stats[priority]["shed"] += 1
+        logger.warning(f"调用排队已满，丢弃{PRIORITY_LABELS[priority]}调用 ({reason})")
+
+    async def acquire(self, provider: str, priority: int) -> bool:
+        """
+        获取配置的调用名额
+        :return: 是否占用了名额（未开启准入控制时返回False，无需释放）
+        """
+        config = chat_manager.get_admission_control()
+        if not config["enabled"]:
+            return False
+
+        started = time.monotonic()
+        queue = self._waiters.setdefault(provider, [])
+        if self._active.get(provider, 0) < config["max_concurrency"] and not queue:
+            self._active[provider] = self._active.get(provider, 0) + 1
+            self._record_admitted(priority, 0.0)
+            return True
+
+        if len(queue) >= config["max_queue"]:
+            lowest = max(queue)
+            if lowest[0] <= priority:
+                self._shed(priority, "新到达")
+                raise AdmissionRejected(f"配置 {provider} 调用排队已满")
+            queue.remove(lowest)
+            heapq.heapify(queue)
+            self._shed(lowest[0], "被更高优先级挤出")
+            lowest[2].set_exception(AdmissionRejected(f"配置 {provider} 调用排队已满"))
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._sequence), future)
+        heapq.heappush(queue, entry)
+        self._peak_depth = max(self._peak_depth, self._depth())
+        try:
+            await future
+        except asyncio.CancelledError:
+            if entry in queue:
+                queue.remove(entry)
+                heapq.heapify(queue)
+            elif future.done() and not future.cancelled() and future.exception() is None:
+                # 已分到名额但调用方被取消，交还名额
+                self.release(provider)
+            raise
+        self._record_admitted(priority, time.monotonic() - started)
+        return True
+
+    def release(self, provider: str):
+        """释放名额，直接转交给排队中优先级最高的调用"""
+        queue = self._waiters.get(provider, [])
+        while queue:
+            _, _, future = heapq.heappop(queue)
+            if not future.done():
+                future.set_result(True)
+                return
+        self._active[provider] = max(0, self._active.get(provider, 0) - 1)
+
+    def _record_admitted(self, priority: int, wait: float):
+        self._stats[priority]["admitted"] += 1
+        self._stats[priority]["waits"].append(wait)
+
+    @asynccontextmanager
+    async def slot(self, provider: str, priority: int):
+        """在名额内执行调用"""
+        acquired = await self.acquire(provider, priority)
+        try:
+            yield
+        finally:
+            if acquired:
+                self.release(provider)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取准入控制统计信息"""
+        classes = {}
+        for priority, stats in self._stats.items():
+            waits: Deque[float] = stats["waits"]
+            ordered = sorted(waits)
+            classes[PRIORITY_LABELS[priority]] = {
+                "admitted": stats["admitted"],
+                "shed": stats["shed"],
+                "waiting": sum(1 for queue in self._waiters.values() for entry in queue if entry[0] == priority),
+                "wait_avg": sum(ordered) / len(ordered) if ordered else 0.0,
+                "wait_p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] if ordered else 0.0,
+            }
+        return {
+            "active": {name: count for name, count in self._active.items() if count},
+            "depth": self._depth(),
+            "peak_depth": self._peak_depth,
+            "classes": classes,
+        }
+
+
+# 全局准入控制实例
+admission_scheduler = AdmissionScheduler()
@@ -0,0 +1,117 @@
+import json
+import re
+from typing import List, Optional, Tuple
+
+# 回复格式：json 为 {"reply": [...]} 信封并开启 JSON 模式；delimited 为分隔符分段的纯文本
+REPLY_FORMATS = {
+    "json": "JSON信封",
+    "delimited": "分隔符分段",
+}
+# 分段格式中单独占一行的分段标记
+SEGMENT_DELIMITER = "|||"
+# 分段格式中表示不发言的标记
+SILENCE_MARKER = "[沉默]"
+
+DELIMITER_PATTERN = re.compile(r"^[ \t]*\|\|\|[ \t]*$", re.M)
+FENCE_PATTERN = re.compile(r"^```(?:json)?\s*(.*?)\s*```$", re.S)
+
+
+def clean_segments(segments: List[object]) -> List[str]:
+    """去掉空段，非字符串的段转为字符串"""
+    return [str(segment) for segment in segments if segment is not None and str(segment).strip()]
+
+
+def format_segments(segments: List[str], reply_format: str) -> str:
+    """将分段渲染为指定格式的回复文本，用于历史消息和示例"""
+    if reply_format == "delimited":
+        return f"\n{SEGMENT_DELIMITER}\n".join(segments) if segments else SILENCE_MARKER
+    return json.dumps({"reply": list(segments)}, ensure_ascii=False)
+
+
+def _parse_json(text: str) -> Optional[Tuple[List[str], bool]]:
+    """
+    解析 JSON 信封，处理代码块包裹、JSON前后多余文字、reply为字符串等情况
+    :return: (分段, 是否原样可用)，不是可用的 JSON 信封时返回None
+    """
+    stripped = text.strip()
+    fence = FENCE_PATTERN.match(stripped)
+    if fence:
+        stripped = fence.group(1)
+
+    candidates = [stripped]
+    start, end = stripped.find("{"), stripped.rfind("}")
+    if 0 <= start < end:
+        candidates.append(stripped[start:end + 1])
+    for candidate in candidates:
+        try:
+            data = json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        if not isinstance(data, dict):
+            continue
+        segments = data.get("reply")
+        if isinstance(segments, str):
+            segments = [segments]
+        if isinstance(segments, list):
+            exact = candidate == text and segments is data["reply"] and all(isinstance(s, str) for s in segments)
+            return clean_segments(segments), exact
+    return None
+
+
+def parse_reply(text: str, reply_format: str) -> Tuple[Optional[List[str]], bool]:
+    """
+    将模型回复解析为分段，两种格式都能识别，按要求的格式判断是否需要修复
+    :return: (分段，空列表表示不发言；JSON 信封残缺无法修复时为None, 是否按要求格式原样可用)
+    """
+    stripped = text.strip()
+    if reply_format == "delimited":
+        if stripped == SILENCE_MARKER:
+            return [], True
+        # 仍按 JSON 信封回复的模型（如沿用历史格式）也能接受
+        if stripped.startswith(("{", "```")):
+            parsed = _parse_json(text)
+            if parsed is not None:
+                return parsed[0], False
+        return clean_segments([part.strip("\n") for part in DELIMITER_PATTERN.split(stripped)]), True
+
+    parsed = _parse_json(text)
+    if parsed is not None:
+        return parsed
+    # 明显不是 JSON 的纯文本整体作为一段回复；残缺的 JSON 无法修复
+    if "{" not in stripped:
+        return clean_segments([stripped]), False
+    return None, False
+
+
+def get_format_instructions(reply_format: str) -> Tuple[str, str]:
+    """
+    获取回复格式的提示词
+    :return: (不发言的说明, 格式说明)
+    """
+    if reply_format == "delimited":
+        silence = f"如果不需要参与，只输出 {SILENCE_MARKER} 保持沉默，不要解释\n"
+        instructions = f"""
+请直接输出回复内容，不要包含任何其他内容；需要分段时，段与段之间单独一行写 {SEGMENT_DELIMITER} 分隔，例如：
+第一段内容
+{SEGMENT_DELIMITER}
+第二段内容
+
+内容要求：
+1. 不要使用markdown格式，不要使用JSON
+"""
+    else:
+        silence = '如果不需要参与，返回空数组 {"reply": []} 保持沉默，不要解释\n'
+        instructions = """
+请严格按照以下JSON格式回复，不要包含任何其他内容：
+{
+  "reply": [
+    "第一段内容",
+    "第二段内容",
+    "可能还有更多段..."
+  ]
+}
+
+内容要求：
+1. 不要使用markdown格式，只返回纯JSON
+"""
+    return silence, instructions
@@ -1,6 +1,8 @@
 from nonebot import logger, get_bot
 from nonebot.adapters.onebot.v11 import MessageEvent
 from .manager import chat_manager
+from .ratelimit import outbound_limiter
+from .errors import error_tracker
 
 
 async def send_forward_message(user_id: int = None, group_id: int = None, messages: list = None):
@@ -25,6 +27,7 @@ async def send_forward_message(user_id: int = None, group_id: int = None, messag
         params["user_id"] = user_id
         params["group_id"] = group_id
         
+        await outbound_limiter.acquire(f"group_{group_id}" if group_id else str(user_id))
         result = await bot.call_api("send_forward_msg", **params)
         logger.info(f"合并转发消息发送成功")
         return result
@@ -98,6 +101,7 @@ async def send_error_to_super_users(error_msg: str, event: MessageEvent = None):
     
     bot = get_bot()
     error_summary = extract_error_summary(error_msg)
+    error_tracker.record("alerts")
     
     messages = []
     
@@ -125,6 +129,7 @@ async def send_error_to_super_users(error_msg: str, event: MessageEvent = None):
             logger.error(f"发送错误信息给管理员 {user_id} 失败: {e}")
             try:
                 fallback_msg = f"聊天插件错误:\n{error_summary[:100]}..."
+                await outbound_limiter.acquire(str(user_id))
                 await bot.send_private_msg(user_id=int(user_id), message=fallback_msg)
             except Exception as fallback_e:
                 logger.error(f"备用消息发送失败: {fallback_e}")
\ No newline at end of file
@@ -0,0 +1,179 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+from nonebot import logger
+from .manager import chat_manager
+from .chat import usage_recorder, is_silent_reply, should_reply_in_group, get_chat_reply_with_tools
+
+
+class SpeculativeReplier:
+    """
+    推测式回复：群聊判断的同时提前生成回复
+    判断为需要回复时直接使用已生成（或生成中）的回复，判断为不需要时取消生成
+    """
+
+    def __init__(self, history_size: int = 20):
+        # { "群号": 最近的判断结果 }
+        self._history: Dict[str, Deque[bool]] = {}
+        self._history_size = history_size
+        # { "群号": 判断为需要回复后等待处理器取走的回复任务 }
+        self._ready: Dict[str, asyncio.Future] = {}
+        self._stats = {
+            "speculated": 0,       # 发起推测生成的次数
+            "used": 0,             # 推测结果被采用的次数
+            "cancelled": 0,        # 判断为不需要、生成中途取消的次数
+            "discarded": 0,        # 判断为不需要、但已生成完毕被丢弃的次数
+            "used_tokens": 0,      # 被采用的推测回复消耗的Token
+            "wasted_tokens": 0,    # 被丢弃的推测回复消耗的Token（中途取消的无法统计）
+            "saved_seconds": 0.0,  # 判断与生成并行节省的时间
+            "fused_calls": 0,      # 合并判断模式的调用次数
+            "fused_silent": 0,     # 其中模型选择不发言的次数
+        }
+
+    def reply_rate(self, group_id: str) -> Optional[float]:
+        history = self._history.get(group_id)
+        if not history:
+            return None
+        return sum(history) / len(history)
+
+    def _should_speculate(self, group_id: str) -> bool:
+        """按群内最近的回复比例决定是否推测"""
+        config = chat_manager.get_speculative_reply()
+        if not config["enabled"]:
+            return False
+        history = self._history.get(group_id)
+        if not history or len(history) < config["min_samples"]:
+            return False
+        return self.reply_rate(group_id) >= config["min_reply_rate"]
+
+    def _record_decision(self, group_id: str, decision: bool):
+        history = self._history.setdefault(group_id, deque(maxlen=self._history_size))
+        history.append(decision)
+
+    async def _generate(self, generate: Callable[[], Awaitable[str]], tokens: list) -> str:
+        """在独立任务中生成回复，并收集该任务的Token消耗"""
+        usage_recorder.set(tokens)
+        return await generate()
+
+    async def judge(self, group_id: str, judge: Callable[[], Awaitable[bool]],
+                    generate: Callable[[], Awaitable[str]]) -> bool:
+        """
+        执行一次群聊判断，满足策略时同时推测生成回复
+        :param group_id: 群号
+        :param judge: 判断函数
+        :param generate: 回复生成函数
+        """
+        if not self._should_speculate(group_id):
+            decision = await judge()
+            self._record_decision(group_id, decision)
+            return decision
+
+        self._stats["speculated"] += 1
+        tokens: list = []
+        started = time.monotonic()
+        task = asyncio.create_task(self._generate(generate, tokens))
+        try:
+            decision = await judge()
+        except BaseException:
+            task.cancel()
+            raise
+        judged_at = time.monotonic()
+        self._record_decision(group_id, decision)
+
+        if decision:
+            self._stats["used"] += 1
+            stale = self._ready.pop(group_id, None)
+            if stale:
+                stale.cancel()
+            self._ready[group_id] = task
+
+            def on_done(done_task: asyncio.Task):
+                # 并行节省的时间即判断耗时与生成耗时的重叠部分
+                self._stats["saved_seconds"] += min(judged_at, time.monotonic()) - started
+                self._stats["used_tokens"] += sum(tokens)
+            task.add_done_callback(on_done)
+        elif task.done():
+            self._stats["discarded"] += 1
+            self._stats["wasted_tokens"] += sum(tokens)
+            if not task.cancelled():
+                task.exception()  # 取出异常，避免未处理异常的警告
+        else:
+            self._stats["cancelled"] += 1
+            task.cancel()
+            logger.info(f"群组 {group_id} 判断不需要回复，取消推测生成")
+        return decision
+
+    async def fused_judge(self, group_id: str, generate: Callable[[], Awaitable[str]]) -> bool:
+        """
+        合并判断：一次回复调用同时决定是否发言，空回复即不参与
+        需要发言时回复放入就绪队列，由处理器直接取走发送
+        """
+        self._stats["fused_calls"] += 1
+        reply = await generate()
+        decision = not is_silent_reply(reply)
+        self._record_decision(group_id, decision)
+        if not decision:
+            self._stats["fused_silent"] += 1
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(reply)
+        stale = self._ready.pop(group_id, None)
+        if stale:
+            stale.cancel()
+        self._ready[group_id] = future
+        return True
+
+    def take(self, group_id: str) -> Optional[asyncio.Future]:
+        """取走判断后已就绪的推测回复任务"""
+        return self._ready.pop(group_id, None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取推测式回复统计信息"""
+        return {**self._stats}
+
+
+async def _measure(call: Callable[[], Awaitable[Any]]) -> Dict[str, Any]:
+    """在独立任务中执行调用，统计调用次数、Token和耗时"""
+    tokens: list = []
+
+    async def run():
+        usage_recorder.set(tokens)
+        return await call()
+
+    started = time.monotonic()
+    result = await asyncio.create_task(run())
+    return {"result": result, "calls": len(tokens), "tokens": sum(tokens), "seconds": time.monotonic() - started}
+
+
+async def benchmark_judge_flows(messages: list, rounds: int = 3) -> Dict[str, Dict[str, float]]:
+    """
+    用同一段群聊上下文对比两种判断流程
+    two_step: 先判断，需要时再生成回复；fused: 一次调用同时判断和回复
+    :return: { 流程: {"calls", "tokens", "seconds", "reply_rate"} } 均为每轮平均值
+    """
+    async def two_step():
+        if await should_reply_in_group(messages):
+            return await get_chat_reply_with_tools(messages, True)
+        return None
+
+    async def fused():
+        reply = await get_chat_reply_with_tools(messages, True, allow_silence=True)
+        return None if is_silent_reply(reply) else reply
+
+    report = {}
+    for name, flow in (("two_step", two_step), ("fused", fused)):
+        totals = {"calls": 0, "tokens": 0, "seconds": 0.0, "reply_rate": 0.0}
+        for _ in range(rounds):
+            measured = await _measure(flow)
+            totals["calls"] += measured["calls"]
+            totals["tokens"] += measured["tokens"]
+            totals["seconds"] += measured["seconds"]
+            totals["reply_rate"] += 1 if measured["result"] else 0
+        report[name] = {k: v / rounds for k, v in totals.items()}
+    return report
+
+
+# 全局推测式回复实例
+speculative_replier = SpeculativeReplier()
@@ -0,0 +1,126 @@
+import json
+import re
+from typing import Any, Dict, List, Tuple
+
+# 中日韩文字及全角符号，每个字大约一个Token
+CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+# 每条消息的角色、分隔符等固定开销
+MESSAGE_OVERHEAD = 4
+# 一张图片按高精度识别的大致开销
+IMAGE_TOKENS = 765
+# 未设置上下文窗口的配置按该值预检
+DEFAULT_CONTEXT_WINDOW = 32768
+# 未指定 max_tokens 时为回复预留的Token数
+DEFAULT_COMPLETION_BUDGET = 2048
+# 截断时每条消息至少保留的Token数
+MIN_KEEP_TOKENS = 64
+TRUNCATION_MARKER = "…[已截断]"
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的Token数：中文按字计，其余字符约4个一个Token"""
+    if not text:
+        return 0
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def estimate_content_tokens(content: Any) -> int:
+    """估算消息内容的Token数，支持多模态的分段内容"""
+    if isinstance(content, str):
+        return estimate_tokens(content)
+    if isinstance(content, list):
+        total = 0
+        for part in content:
+            if not isinstance(part, dict):
+                continue
+            if part.get("type") == "text":
+                total += estimate_tokens(part.get("text", ""))
+            elif part.get("type") == "image_url":
+                total += IMAGE_TOKENS
+        return total
+    return 0
+
+
+def estimate_messages_tokens(messages: List[Dict[str, Any]]) -> int:
+    """估算消息列表的Token数"""
+    total = 0
+    for message in messages:
+        total += MESSAGE_OVERHEAD + estimate_content_tokens(message.get("content"))
+        for tool_call in message.get("tool_calls") or []:
+            function = tool_call.get("function", {})
+            total += estimate_tokens(function.get("name", "")) + estimate_tokens(function.get("arguments", ""))
+    return total
+
+
+def estimate_request_tokens(params: Dict[str, Any]) -> int:
+    """估算一次补全请求的提示Token数（消息和工具定义）"""
+    total = estimate_messages_tokens(params.get("messages", []))
+    if params.get("tools"):
+        total += estimate_tokens(json.dumps(params["tools"], ensure_ascii=False))
+    return total
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """将文本截断到预估不超过 max_tokens，末尾加截断标记"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    budget = max(max_tokens - estimate_tokens(TRUNCATION_MARKER), 0)
+    keep = len(text)
+    while keep > 0:
+        tokens = estimate_tokens(text[:keep])
+        if tokens <= budget:
+            break
+        # 按比例估算保留的字数，至少减少一个字保证收敛
+        keep = min(keep - 1, keep * budget // tokens)
+    return text[:keep] + TRUNCATION_MARKER
+
+
+def fit_messages(messages: List[Dict[str, Any]], budget: int) -> List[Dict[str, Any]]:
+    """
+    将消息列表裁剪到预估不超过 budget：
+    先从最早的历史开始丢弃，开头的系统提示词和当前这一轮（最后一条用户消息及之后的工具调用）保留；
+    仍然超出时，从最长的文本（工具结果、粘贴的长文、识图结果）开始截断
+    """
+    messages = list(messages)
+    total = estimate_messages_tokens(messages)
+    if total <= budget:
+        return messages
+
+    head = 0
+    while head < len(messages) and messages[head].get("role") == "system":
+        head += 1
+    tail = max((i for i, msg in enumerate(messages) if msg.get("role") == "user"), default=len(messages) - 1)
+    while head < tail and total > budget:
+        total -= estimate_messages_tokens([messages.pop(head)])
+        tail -= 1
+        # 工具结果不能脱离发起调用的消息单独存在
+        while head < tail and messages[head].get("role") == "tool":
+            total -= estimate_messages_tokens([messages.pop(head)])
+            tail -= 1
+
+    while total > budget:
+        candidates = [
+            (estimate_tokens(msg["content"]), i) for i, msg in enumerate(messages)
+            if i >= head and isinstance(msg.get("content"), str) and estimate_tokens(msg["content"]) > MIN_KEEP_TOKENS
+        ]
+        if not candidates:
+            break
+        tokens, i = max(candidates)
+        content = truncate_to_tokens(messages[i]["content"], max(MIN_KEEP_TOKENS, tokens - (total - budget)))
+        messages[i] = {**messages[i], "content": content}
+        total += estimate_tokens(content) - tokens
+    return messages
+
+
+def fit_request(params: Dict[str, Any], budget: int) -> Tuple[Dict[str, Any], int]:
+    """
+    预检一次补全请求的提示Token数，超出 budget 时裁剪消息
+    :return: (裁剪后的请求参数, 裁剪掉的预估Token数)
+    """
+    before = estimate_request_tokens(params)
+    if before <= budget:
+        return params, 0
+    tools_tokens = before - estimate_messages_tokens(params.get("messages", []))
+    fitted = {**params, "messages": fit_messages(params.get("messages", []), budget - tools_tokens)}
+    return fitted, before - estimate_request_tokens(fitted)
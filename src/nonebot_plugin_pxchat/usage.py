@@ -0,0 +1,195 @@
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from nonebot import logger
+import nonebot_plugin_localstore as store
+from .manager import chat_manager
+from .scheduler import session_scope
+
+USAGE_FILE = store.get_plugin_data_file("px_chat_usage.json")
+# 按小时汇总，保留最近30天
+BUCKET_SECONDS = 3600
+RETENTION_HOURS = 30 * 24
+# 有新记录时最多间隔多久写一次文件（秒）
+SAVE_INTERVAL = 60.0
+# 不属于任何会话的调用（如管理指令触发的调用）记在这个名下
+NO_SCOPE = "-"
+# 可查询的时间窗口: { "名称": (显示名, 小时数) }，today 为本地时间当天
+USAGE_WINDOWS = {
+    "1h": ("最近1小时", 1),
+    "today": ("今天", None),
+    "24h": ("最近24小时", 24),
+    "7d": ("最近7天", 7 * 24),
+    "30d": ("最近30天", RETENTION_HOURS),
+}
+# 可排行的维度: { "名称": (显示名, 记录键中的下标) }
+USAGE_DIMENSIONS = {
+    "scope": ("会话", 3),
+    "provider": ("配置", 0),
+    "model": ("模型", 1),
+    "stage": ("阶段", 2),
+}
+# 超出配额时主动参与的处理方式
+QUOTA_ACTIONS = {
+    "downgrade": "降级（活跃度减半，只用简短判断）",
+    "skip": "跳过主动参与",
+}
+
+# 每条记录的计数: 调用次数, 提示Token, 其中命中前缀缓存的Token, 补全Token, 费用
+FIELDS = ("calls", "prompt_tokens", "cached_tokens", "completion_tokens", "cost")
+
+
+def get_cost(ai_config: Dict[str, Any], prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> float:
+    """按配置的价格表计算费用，价格为每百万Token的价格，命中缓存的输入未单独定价时按普通输入计"""
+    prices = ai_config.get("prices") or {}
+    prompt_price = prices.get("prompt", 0.0)
+    cached_price = prices.get("cached", prompt_price)
+    return ((prompt_tokens - cached_tokens) * prompt_price + cached_tokens * cached_price
+            + completion_tokens * prices.get("completion", 0.0)) / 1_000_000
+
+
+class UsageLedger:
+    """
+    Token与费用账本：每次调用按 (配置, 模型, 阶段, 会话) 累加到小时桶中，
+    定期写入文件；另外维护当天各会话的Token总数，用于群聊每日配额
+    """
+
+    def __init__(self):
+        # { 小时起点: { (配置, 模型, 阶段, 会话): [调用次数, 提示Token, 缓存Token, 补全Token, 费用] } }
+        self._buckets: Dict[int, Dict[Tuple[str, str, str, str], List[float]]] = {}
+        # (当天日期, { 会话: Token总数 })
+        self._today: Tuple[str, Dict[str, int]] = ("", {})
+        self._dirty = False
+        self._last_save = time.monotonic()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(USAGE_FILE):
+            return
+        try:
+            with open(USAGE_FILE, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            for hour, rows in data.get("hours", {}).items():
+                self._buckets[int(hour)] = {tuple(row[:4]): list(row[4:]) for row in rows}
+        except Exception as e:
+            self._buckets = {}
+            logger.warning(f"用量记录读取失败，从空记录开始: {e}")
+        self._prune()
+
+    def _prune(self):
+        oldest = self._hour(time.time()) - (RETENTION_HOURS - 1) * BUCKET_SECONDS
+        for hour in [hour for hour in self._buckets if hour < oldest]:
+            del self._buckets[hour]
+
+    @staticmethod
+    def _hour(timestamp: float) -> int:
+        return int(timestamp // BUCKET_SECONDS * BUCKET_SECONDS)
+
+    @staticmethod
+    def _day_start(timestamp: float) -> float:
+        local = time.localtime(timestamp)
+        return time.mktime((local.tm_year, local.tm_mon, local.tm_mday, 0, 0, 0, 0, 0, -1))
+
+    def _today_totals(self) -> Dict[str, int]:
+        """当天各会话的Token总数，跨天后从小时桶重新汇总"""
+        now = time.time()
+        day = time.strftime("%Y-%m-%d", time.localtime(now))
+        if self._today[0] != day:
+            totals: Dict[str, int] = {}
+            start = self._hour(self._day_start(now))
+            for hour, entries in self._buckets.items():
+                if hour >= start:
+                    for key, values in entries.items():
+                        totals[key[3]] = totals.get(key[3], 0) + int(values[1] + values[3])
+            self._today = (day, totals)
+        return self._today[1]
+
+    def record(self, ai_config: Dict[str, Any], stage: str, response):
+        """记录一次成功调用的用量，会话取自当前调用链的会话key"""
+        usage = getattr(response, "usage", None)
+        if not usage:
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", 0) or 0
+        key = (ai_config.get("name", ""), ai_config.get("model", ""), stage, session_scope.get() or NO_SCOPE)
+
+        # 先取当天汇总，跨天重建时不会把本次调用算两遍
+        totals = self._today_totals()
+        now = time.time()
+        values = self._buckets.setdefault(self._hour(now), {}).setdefault(key, [0, 0, 0, 0, 0.0])
+        values[0] += 1
+        values[1] += prompt_tokens
+        values[2] += cached_tokens
+        values[3] += completion_tokens
+        values[4] += get_cost(ai_config, prompt_tokens, cached_tokens, completion_tokens)
+        totals[key[3]] = totals.get(key[3], 0) + prompt_tokens + completion_tokens
+
+        self._dirty = True
+        if time.monotonic() - self._last_save >= SAVE_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """有未保存的记录时写入文件"""
+        if not self._dirty:
+            return
+        self._prune()
+        data = {"hours": {
+            str(hour): [list(key) + values for key, values in entries.items()]
+            for hour, entries in sorted(self._buckets.items())
+        }}
+        try:
+            with open(USAGE_FILE, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            self._dirty = False
+        except Exception as e:
+            logger.warning(f"用量记录保存失败: {e}")
+        self._last_save = time.monotonic()
+
+    def _entries(self, window: str):
+        now = time.time()
+        hours = USAGE_WINDOWS[window][1]
+        start = self._hour(self._day_start(now)) if hours is None else self._hour(now) - (hours - 1) * BUCKET_SECONDS
+        for hour, entries in self._buckets.items():
+            if hour >= start:
+                yield from entries.items()
+
+    def summary(self, window: str) -> Dict[str, float]:
+        """时间窗口内的用量合计"""
+        total = dict.fromkeys(FIELDS, 0)
+        for _, values in self._entries(window):
+            for field, value in zip(FIELDS, values):
+                total[field] += value
+        return total
+
+    def top(self, window: str, dimension: str, limit: int = 10) -> List[Tuple[str, Dict[str, float]]]:
+        """时间窗口内按维度汇总，按Token总数从高到低取前几名"""
+        index = USAGE_DIMENSIONS[dimension][1]
+        grouped: Dict[str, Dict[str, float]] = {}
+        for key, values in self._entries(window):
+            total = grouped.setdefault(key[index], dict.fromkeys(FIELDS, 0))
+            for field, value in zip(FIELDS, values):
+                total[field] += value
+        ranked = sorted(grouped.items(), key=lambda item: item[1]["prompt_tokens"] + item[1]["completion_tokens"], reverse=True)
+        return ranked[:limit]
+
+    def get_today_tokens(self, scope: str) -> int:
+        """会话当天已消耗的Token"""
+        return self._today_totals().get(scope, 0)
+
+    def quota_action(self, group_id: str) -> Optional[str]:
+        """
+        群聊超出每日Token配额时主动参与的处理方式
+        :return: downgrade/skip，未设置配额或未超出时返回None
+        """
+        quota = chat_manager.get_usage_quota()
+        limit = quota["groups"].get(group_id)
+        if not limit or self.get_today_tokens(f"group_{group_id}") < limit:
+            return None
+        return quota["action"]
+
+
+# 全局用量账本实例
+usage_ledger = UsageLedger()
@@ -0,0 +1,61 @@
+import re
+import zlib
+from typing import Dict, Iterable, Tuple
+import numpy as np
+
+# 群聊记录中的用户前缀，如 "用户123(昵称)说：: "，对模型只是噪声
+USER_PREFIX_PATTERN = re.compile(r"用户\d+\(.*?\)说：:?\s*")
+BOT_PREFIX_PATTERN = re.compile(r"你\(px\)回复说:\s*")
+
+
+def normalize_text(text: str) -> str:
+    """去掉用户前缀、统一大小写和空白"""
+    text = USER_PREFIX_PATTERN.sub("", text)
+    text = BOT_PREFIX_PATTERN.sub("@", text)
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class HashingVectorizer:
+    """
+    离线文本向量化：字符n-gram哈希到固定维度，无需下载模型
+    使用crc32保证跨进程稳定，另取一位作为符号减少哈希冲突的偏差
+    """
+
+    def __init__(self, dim: int = 1 << 16, ngram_range: Tuple[int, int] = (1, 3)):
+        self.dim = dim
+        self.ngram_range = ngram_range
+
+    def _count(self, counts: Dict[int, float], text: str, namespace: str = ""):
+        low, high = self.ngram_range
+        for n in range(low, high + 1):
+            for i in range(len(text) - n + 1):
+                h = zlib.crc32(f"{namespace}{n}{text[i:i + n]}".encode("utf-8"))
+                index = h % self.dim
+                sign = 1.0 if (h >> 31) & 1 else -1.0
+                counts[index] = counts.get(index, 0.0) + sign
+
+    def transform_sparse(self, parts: Iterable[Tuple[str, str]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        将若干 (命名空间, 文本) 片段向量化为稀疏表示
+        :return: (索引数组, 值数组)，值已做对数缩放和L2归一化
+        """
+        counts: Dict[int, float] = {}
+        for namespace, text in parts:
+            self._count(counts, normalize_text(text), namespace)
+        if not counts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        raw = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+        values = np.sign(raw) * np.log1p(np.abs(raw))
+        norm = np.linalg.norm(values)
+        if norm > 0:
+            values /= norm
+        return indices, values.astype(np.float32)
+
+    def transform_dense(self, text: str) -> np.ndarray:
+        """将单段文本向量化为稠密向量（L2归一化）"""
+        vector = np.zeros(self.dim, dtype=np.float32)
+        indices, values = self.transform_sparse([("", text)])
+        np.add.at(vector, indices, values)
+        return vector